@@ -0,0 +1,313 @@
+""" End-to-end failover time, from uplink loss to traffic on the survivors.
+
+Runs the real Application against the in-memory kernel, link events are sent
+as syslog datagrams to its UDP endpoint. No root or network access needed,
+run from the monitor directory:
+
+    python -m bench.failover [runs] [links] [delay] [fast]
+
+`delay` is route.delay in seconds, `fast` turns on route.fast_disconnect.
+"""
+
+import asyncio
+from datetime import datetime
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from core.application import Application, DEFAULT_SETTINGS
+from bench.fake_kernel import FakeCommandBackend, FakeKernel, FakeProbeEngine
+from bench.scale import address_of, cancel_pending, gateway_of
+
+FLOWS_PER_LINK = 1000
+
+
+class TracingKernel(FakeKernel):
+    """ remembers when the gateways used by lan traffic changed """
+
+    timeline = None
+
+    def __init__(self):
+        super().__init__()
+        self.timeline = []
+
+
+    def ip(self, tokens):
+        try:
+            super().ip(tokens)
+        finally:
+            self.observe()
+
+
+    def iptables_restore(self, payload):
+        super().iptables_restore(payload)
+        self.observe()
+
+
+    def observe(self):
+        state = (self.lan_gateways(), self.live_gateways())
+        if not self.timeline or self.timeline[-1][1:] != state:
+            self.timeline.append((time.perf_counter(),) + state)
+
+
+def black_hole(timeline, start, end):
+    """ seconds without a usable route while some link was up """
+    total = 0.0
+    for index, (timestamp, gateways, live) in enumerate(timeline):
+        if index + 1 < len(timeline):
+            until = min(timeline[index + 1][0], end)
+        else:
+            until = end
+        since = max(timestamp, start)
+        if until <= since or not live:
+            continue
+        if gateways is None or not gateways & live:
+            total += until - since
+    return total
+
+
+def settled_at(timeline, start, expected):
+    """ when lan traffic reached `expected` gateways for good """
+    settled = None
+    for timestamp, gateways, _ in timeline:
+        if gateways != expected:
+            settled = None
+        elif settled is None:
+            settled = max(timestamp, start)
+    return settled
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Simulation(object):
+
+    loop = None
+    kernel = None
+    commands = None
+    app = None
+    sock = None
+    address = None
+    names = None
+
+    def __init__(self, loop, links, delay, fast, state_dir):
+        self.loop = loop
+        self.kernel = TracingKernel()
+        self.commands = FakeCommandBackend(loop, self.kernel)
+        self.names = ['ppp%i' % ii for ii in range(links)]
+
+        self.app = Application(loop, os.path.dirname(os.path.abspath(
+                __file__)), {
+            'monitored_networks': dict((name, {'active': True})
+                    for name in self.names),
+            'events': dict(DEFAULT_SETTINGS['events'], source='syslog',
+                    syslog_port=0),
+            'route': dict(DEFAULT_SETTINGS['route'], delay=delay,
+                    fast_disconnect=fast),
+            'telemetry': dict(DEFAULT_SETTINGS['telemetry'], enabled=False),
+            'state_dir': state_dir,
+        }, commands=self.commands)
+        self.app.probe_engine = FakeProbeEngine(self.kernel)
+
+
+    async def start(self):
+        self.app.startup()
+        while self.app.syslog_handler is None:
+            await asyncio.sleep(0.001)
+        self.address = self.app.syslog_handler.get_extra_info('sockname')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # the first datagram only starts monitoring, events in it are lost
+        self.syslog('sshd[1]', 'hello')
+        while not self.app.is_monitoring:
+            await asyncio.sleep(0.001)
+
+        for index in range(len(self.names)):
+            self.link_up(index)
+        await self.settle(self.kernel.live_gateways())
+
+
+    def close(self):
+        self.sock.close()
+        self.app.is_active = False
+        self.loop.run_until_complete(self.app.close())
+
+
+    def syslog(self, prog, message):
+        date = datetime.now().strftime('%b %d %H:%M:%S')
+        self.sock.sendto(('<30>%s gateway %s: %s' % (date, prog,
+                message)).encode(), self.address)
+
+
+    def link_up(self, index):
+        name = self.names[index]
+        self.kernel.link_up(name, address_of(index), 24, gateway_of(index))
+        self.kernel.flows[address_of(index)] = FLOWS_PER_LINK
+        self.kernel.observe()
+        self.syslog('dhcpcd[433]', '%s: adding default route via %s' % (
+                name, gateway_of(index)))
+        return time.perf_counter()
+
+
+    def link_down(self, index):
+        name = self.names[index]
+        self.kernel.link_down(name)
+        self.kernel.observe()
+        self.syslog('dhcpcd[433]', '%s: removing interface' % name)
+        return time.perf_counter()
+
+
+    def usable_gateways(self):
+        """ live gateways, less those flap damping holds back """
+        return frozenset(link[2] for name, link in self.kernel.links.items()
+                if self.app.networks.get(name).is_usable())
+
+
+    def idle(self):
+        return self.app.reroute_handle is None and\
+                not self.app.is_defining_route and self.app.queue.empty()
+
+
+    async def settle(self, expected, timeout=30):
+        expected = expected or None
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(0.002)
+            if self.kernel.lan_gateways() == expected and self.idle():
+                return True
+        return False
+
+
+    async def measure(self, start, expected):
+        """ (latency, black hole, execs) since `start` """
+        before = self.commands.count
+        ok = await self.settle(expected)
+        # trailing commands of the reroute that got us there
+        await asyncio.sleep(0.01)
+        end = time.perf_counter()
+        timeline = self.kernel.timeline
+        settled = settled_at(timeline, start, expected or None)
+        if not ok or settled is None:
+            return None, black_hole(timeline, start, end), None
+        return settled - start, black_hole(timeline, start, end),\
+                self.commands.count - before
+
+
+async def single_loss(sim):
+    start = sim.link_down(0)
+    return await sim.measure(start, sim.kernel.live_gateways())
+
+
+async def flapping(sim, flaps=5, interval=0.05):
+    first = time.perf_counter()
+    before = sim.commands.count
+    for _ in range(flaps):
+        sim.link_down(0)
+        await asyncio.sleep(interval)
+        sim.link_up(0)
+        await asyncio.sleep(interval)
+    latency, _, execs = await sim.measure(time.perf_counter(),
+            sim.usable_gateways())
+    # black hole and commands count for the whole flapping period
+    end = time.perf_counter()
+    if execs is not None:
+        execs = sim.commands.count - before
+    return latency, black_hole(sim.kernel.timeline, first, end), execs
+
+
+async def all_down(sim):
+    for index in range(len(sim.names)):
+        start = sim.link_down(index)
+    return await sim.measure(start, None)
+
+
+async def recovery(sim):
+    await all_down(sim)
+    start = sim.link_up(0)
+    return await sim.measure(start, sim.kernel.live_gateways())
+
+
+SCENARIOS = [
+    ('single link loss', single_loss),
+    ('flapping', flapping),
+    ('all links down', all_down),
+    ('recovery from all down', recovery),
+]
+
+
+def run_scenario(loop, scenario, runs, links, delay, fast):
+    latencies = []
+    black_holes = []
+    execs = []
+    flows = []
+    failed = 0
+    lost = 0
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as state_dir:
+            sim = Simulation(loop, links, delay, fast, state_dir)
+            try:
+                loop.run_until_complete(sim.start())
+                latency, hole, count = loop.run_until_complete(scenario(sim))
+                flows.append(sum(sim.kernel.flows.values()))
+                # the lan route in main has to outlive every reroute
+                if not sim.kernel.lan_connected():
+                    lost += 1
+            finally:
+                sim.close()
+                cancel_pending(loop)
+
+        black_holes.append(hole)
+        if latency is None:
+            failed += 1
+            continue
+        latencies.append(latency)
+        execs.append(count)
+
+    return latencies, black_holes, execs, flows, failed, lost
+
+
+def report(name, latencies, black_holes, execs, flows, failed, lost):
+    print('%s:' % name)
+    print('  failover p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  max %8.1fms' % (
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            max(latencies or [float('nan')]) * 1000))
+    print('  black hole p50 %6.1fms  max %6.1fms' % (
+            percentile(black_holes, 0.5) * 1000,
+            max(black_holes or [float('nan')]) * 1000))
+    print('  subprocesses %.1f per run, %i runs did not converge' % (
+            sum(execs) / float(len(execs)) if execs else float('nan'),
+            failed))
+    print('  conntrack entries kept p50 %i, min %i' % (
+            percentile(flows, 0.5), min(flows)))
+    print('  %i runs lost the lan route in main' % lost)
+
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 20
+    links = int(argv[2]) if len(argv) > 2 else 3
+    delay = float(argv[3]) if len(argv) > 3 else 0.1
+    fast = len(argv) > 4 and argv[4] == 'fast'
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        print(('%i runs, %i links, route.delay %.3fs, fast_disconnect %s, ' +\
+                '%i conntrack entries per link') % (runs, links, delay, fast,
+                FLOWS_PER_LINK))
+        for name, scenario in SCENARIOS:
+            report(name, *run_scenario(loop, scenario, runs, links, delay,
+                    fast))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
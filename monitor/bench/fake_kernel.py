@@ -0,0 +1,398 @@
+""" In-memory stand-in for ip, iptables and friends.
+
+Understands the commands the monitor issues and keeps rules, routes and nat
+rules in memory, so benchmarks run without root or network access.
+"""
+
+import ipaddress
+from json import dumps as json_dumps
+import shlex
+
+from core.commands import CommandBackend, CommandResult
+from core.probes import ProbeResult
+
+# what a freshly booted kernel has, the lan is connected to main
+STOCK_RULES = (
+    {'priority': 0, 'src': 'all', 'table': 'local'},
+    {'priority': 32766, 'src': 'all', 'table': 'main'},
+    {'priority': 32767, 'src': 'all', 'table': 'default'},
+)
+LAN_ROUTE = {'dst': '192.168.1.0/24', 'dev': 'lan0', 'protocol': 'kernel',
+        'scope': 'link', 'prefsrc': '192.168.1.1', 'table': 'main'}
+
+
+def take(tokens, name, default=None):
+    """ value following keyword `name` in tokens """
+    if name in tokens:
+        index = tokens.index(name) + 1
+        if index < len(tokens):
+            return tokens[index]
+    return default
+
+
+def route_key(route):
+    return (route['table'], route['dst'], route.get('metric'))
+
+
+class FakeKernel(object):
+
+    rules = None
+    routes = None
+    nat = None
+    mangle = None
+    links = None
+    link_metrics = None
+    flows = None
+
+    def __init__(self):
+        self.rules = [dict(rule) for rule in STOCK_RULES]
+        # (table, dst, metric) -> route dict
+        self.routes = {route_key(LAN_ROUTE): dict(LAN_ROUTE)}
+        self.nat = []
+        self.mangle = []
+        # interface name -> (local_ip, prefixlen, gateway) when connected
+        self.links = {}
+        # interface name -> metric of the default route dhcp adds to main
+        self.link_metrics = {}
+        # masqueraded address -> conntrack entries
+        self.flows = {}
+
+
+    def link_up(self, name, local_ip, prefixlen, gateway):
+        """ the link gets its address and dhcp a default route in main """
+        self.links[name] = (local_ip, prefixlen, gateway)
+        metric = self.link_metrics.setdefault(name,
+                202 + len(self.link_metrics))
+        self.routes[('main', 'default', metric)] = {'dst': 'default',
+                'protocol': 'dhcp', 'table': 'main', 'gateway': gateway,
+                'prefsrc': local_ip, 'metric': metric, 'dev': name}
+
+
+    def link_down(self, name):
+        self.links.pop(name, None)
+        for key, route in list(self.routes.items()):
+            if key[0] == 'main' and route.get('dev') == name:
+                del self.routes[key]
+
+
+    def ip(self, tokens):
+        """ apply one `ip` command, raises ValueError on failure """
+        if tokens[:2] == ['rule', 'add']:
+            rule = {
+                'priority': int(take(tokens, 'prio')),
+                'src': take(tokens, 'from', 'all'),
+                'table': take(tokens, 'lookup'),
+            }
+            if 'fwmark' in tokens:
+                rule['fwmark'] = take(tokens, 'fwmark')
+            self.rules.append(rule)
+
+        elif tokens[:2] == ['rule', 'del']:
+            prio = int(take(tokens, 'prio'))
+            src = take(tokens, 'from')
+            table = take(tokens, 'lookup')
+            fwmark = take(tokens, 'fwmark')
+            for rule in self.rules:
+                if rule['priority'] == prio and src in (None, rule['src']) and\
+                        table in (None, rule['table']) and\
+                        fwmark == rule.get('fwmark'):
+                    self.rules.remove(rule)
+                    break
+            else:
+                raise ValueError('RTNETLINK answers: No such file or directory')
+
+        elif tokens[:2] in (['route', 'replace'], ['route', 'add']):
+            route = self.parse_route(tokens[2:])
+            key = route_key(route)
+            if tokens[1] == 'add' and key in self.routes:
+                raise ValueError('RTNETLINK answers: File exists')
+            self.routes[key] = route
+
+        elif tokens[:2] == ['route', 'del']:
+            table = take(tokens, 'table', 'main')
+            metric = take(tokens, 'metric')
+            key = (table, 'default', None if metric is None else int(metric))
+            if key not in self.routes:
+                raise ValueError('RTNETLINK answers: No such process')
+            del self.routes[key]
+
+        elif tokens[:3] == ['route', 'flush', 'table']:
+            for key in [key for key in self.routes if key[0] == tokens[3]]:
+                del self.routes[key]
+
+        elif tokens[:2] == ['route', 'flush'] or tokens[:2] == ['link', 'set']:
+            pass
+
+        else:
+            raise ValueError('Unknown command %r' % tokens)
+
+
+    def parse_route(self, tokens):
+        route = {'dst': 'default', 'protocol': take(tokens, 'proto', 'boot'),
+                'table': take(tokens, 'table', 'main')}
+        if tokens[0] != 'default':
+            route['type'] = tokens[0]
+        if 'src' in tokens:
+            route['prefsrc'] = take(tokens, 'src')
+        if 'dev' in tokens:
+            route['dev'] = take(tokens, 'dev')
+        if 'metric' in tokens:
+            route['metric'] = int(take(tokens, 'metric'))
+        if 'nexthop' in tokens:
+            hops = []
+            for index, token in enumerate(tokens):
+                if token != 'nexthop':
+                    continue
+                hop = tokens[index + 1:]
+                if 'nexthop' in hop:
+                    hop = hop[:hop.index('nexthop')]
+                hops.append({'gateway': take(hop, 'via'),
+                        'weight': int(take(hop, 'weight', 1))})
+            route['nexthops'] = hops
+        elif 'via' in tokens:
+            route['gateway'] = take(tokens, 'via')
+        return route
+
+
+    def iptables_restore(self, payload):
+        rules = self.nat
+        for line in payload.splitlines():
+            line = line.strip()
+            if line == '*mangle':
+                rules = self.mangle
+            elif line == '*nat':
+                rules = self.nat
+            if not line or line[0] in '*#:' or line == 'COMMIT':
+                continue
+            if line == '-F' or line == '-F POSTROUTING':
+                del rules[:]
+            elif line.startswith('-A '):
+                rules.append(line)
+            elif line.startswith('-D '):
+                rule = '-A ' + line[3:]
+                if rule not in rules:
+                    raise ValueError('iptables: Bad rule')
+                rules.remove(rule)
+
+
+    def routes_json(self, table):
+        routes = []
+        for route in self.routes.values():
+            if table not in ('all', route['table']):
+                continue
+            route = dict(route)
+            # ip leaves out what the query already implies
+            if table != 'all' or route['table'] == 'main':
+                del route['table']
+            routes.append(route)
+        return json_dumps(routes)
+
+
+    def route_text(self, route):
+        if route.get('type', 'unicast') != 'unicast':
+            line = '%s %s' % (route['type'], route['dst'])
+        elif 'nexthops' in route:
+            line = route['dst'] + ''.join(' nexthop via %s weight %i' % (
+                    hop['gateway'], hop['weight'])
+                    for hop in route['nexthops'])
+        elif 'gateway' in route:
+            line = '%s via %s' % (route['dst'], route['gateway'])
+        else:
+            line = '%s dev %s' % (route['dst'], route.get('dev'))
+        line += ' proto %s' % route['protocol']
+        if 'scope' in route:
+            line += ' scope %s' % route['scope']
+        if 'prefsrc' in route:
+            line += ' src %s' % route['prefsrc']
+        if route.get('metric') is not None:
+            line += ' metric %i' % route['metric']
+        return line
+
+
+    def dev_routes_text(self, name):
+        """ `ip route list dev`, main table only like the real one """
+        lines = [self.route_text(route) for route in self.routes.values()
+                if route['table'] == 'main' and route.get('dev') == name]
+        link = self.links.get(name)
+        if link is not None:
+            local_ip, prefixlen, _ = link
+            network = ipaddress.ip_interface('%s/%i' % (local_ip, prefixlen))
+            lines.append('%s proto kernel scope link src %s' % (
+                    network.network, local_ip))
+        return ''.join(line + '\n' for line in lines)
+
+
+    def table_routes_text(self, table):
+        return ''.join(self.route_text(route) + '\n'
+                for route in self.routes.values() if route['table'] == table)
+
+
+    def addr_text(self, name):
+        link = self.links.get(name)
+        if link is None:
+            return ''
+        local_ip, prefixlen, _ = link
+        return '3: %s: <POINTOPOINT,UP,LOWER_UP> mtu 1500\n' % name +\
+                '    inet %s/%i scope global %s\n' % (local_ip, prefixlen,
+                name)
+
+
+    def main_routes_text(self):
+        return '\n'.join(self.route_text(route)
+                for route in self.routes.values() if route['table'] == 'main')
+
+
+    def lan_connected(self):
+        """ False once something flushed main """
+        return route_key(LAN_ROUTE) in self.routes
+
+
+    def black_hole(self):
+        """ True if a packet from the lan finds no default route """
+        for rule in sorted(self.rules, key=lambda rule: rule['priority']):
+            if rule['src'] != 'all' or 'fwmark' in rule:
+                continue
+            for route in self.default_routes():
+                if route['table'] == rule['table'] and\
+                        route.get('type', 'unicast') == 'unicast':
+                    return False
+        return not any(route['table'] == 'main' and
+                route.get('type', 'unicast') == 'unicast'
+                for route in self.default_routes())
+
+
+    def lan_gateways(self):
+        """ gateways a packet from the lan is spread over, None if none """
+        tables = [rule['table'] for rule in sorted(self.rules,
+                key=lambda rule: rule['priority'])
+                if rule['src'] == 'all' and 'fwmark' not in rule]
+        tables.append('main')
+        for table in tables:
+            for route in self.default_routes():
+                if route['table'] != table or\
+                        route.get('type', 'unicast') != 'unicast':
+                    continue
+                if 'nexthops' in route:
+                    return frozenset(hop['gateway']
+                            for hop in route['nexthops'])
+                return frozenset((route.get('gateway'),))
+        return None
+
+
+    def default_routes(self):
+        return [route for route in self.routes.values()
+                if route['dst'] == 'default']
+
+
+    def live_gateways(self):
+        return frozenset(link[2] for link in self.links.values())
+
+
+class FakeCommandBackend(CommandBackend):
+    """ answers commands from a FakeKernel instead of running them """
+
+    kernel = None
+
+    def __init__(self, loop, kernel=None, settings=None):
+        super().__init__(loop, settings)
+        if kernel is None:
+            kernel = FakeKernel()
+        self.kernel = kernel
+        self.recorded = []
+
+
+    async def execute(self, args, payload, timeout):
+        start = self.loop.time()
+        returncode = 0
+        out = ''
+        err = ''
+        args = list(args)
+        try:
+            out = self.dispatch(args, payload) or ''
+        except ValueError as exc:
+            returncode = 1
+            err = str(exc)
+
+        return CommandResult(returncode, out, err, self.loop.time() - start)
+
+
+    def dispatch(self, args, payload):
+        kernel = self.kernel
+        if args == ['ip', '-json', 'rule', 'show']:
+            return json_dumps(kernel.rules)
+
+        if args[:5] == ['ip', '-json', 'route', 'show', 'table']:
+            return kernel.routes_json(args[5])
+
+        if args == ['ip', 'route', 'show']:
+            return kernel.main_routes_text()
+
+        if args[:4] == ['ip', 'route', 'list', 'dev']:
+            return kernel.dev_routes_text(args[4])
+
+        if args[:4] == ['ip', 'route', 'show', 'table']:
+            return kernel.table_routes_text(args[4])
+
+        if args[:5] == ['ip', '-4', 'addr', 'show', 'dev']:
+            return kernel.addr_text(args[5])
+
+        if args[:4] == ['iptables', '-t', 'nat', '-S']:
+            return '-P POSTROUTING ACCEPT\n' + ''.join(line + '\n'
+                    for line in kernel.nat)
+
+        if args[:4] == ['iptables', '-t', 'mangle', '-S']:
+            return '-P PREROUTING ACCEPT\n' + ''.join(line +\
+                    ' --nfmask 0xffffffff --ctmask 0xffffffff\n'
+                    for line in kernel.mangle)
+
+        if args[:3] == ['ip', '-force', '-batch']:
+            errors = []
+            for line in payload.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    kernel.ip(shlex.split(line))
+                except ValueError as exc:
+                    errors.append(str(exc))
+            if errors:
+                raise ValueError('\n'.join(errors))
+            return ''
+
+        if args[0] == 'iptables-restore':
+            kernel.iptables_restore(payload)
+            return ''
+
+        if args[0] == 'ip':
+            kernel.ip(args[1:])
+            return ''
+
+        if args[:3] == ['conntrack', '-D', '-q']:
+            return '%i flow entries have been deleted.' % kernel.flows.pop(
+                    args[3], 0)
+
+        if args[:3] == ['conntrack', '-U', '-q']:
+            return '%i flow entries have been updated.' % kernel.flows.get(
+                    args[3], 0)
+
+        if args == ['conntrack', '-C']:
+            return str(sum(kernel.flows.values()))
+
+        # init scripts and the like just succeed
+        return ''
+
+
+class FakeProbeEngine(object):
+    """ stand-in ping, probes succeed while the link is up in the kernel """
+
+    kernel = None
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+
+
+    async def run(self, network):
+        target = network.settings['test_ip']
+        if network.interface_name in self.kernel.links:
+            return [ProbeResult('icmp', target, True, 0.01, 0.0, 0.0, None)]
+        return [ProbeResult('icmp', target, False, None, 1.0, None,
+                'timeout')]
@@ -0,0 +1,156 @@
+""" Takeover time of an HA pair, from the primary going silent to routes on
+the standby.
+
+Two Applications on one loop, each with its own in-memory kernel, talk over
+UDP on localhost. The primary drains ppp0 first, so the standby has to take
+over replicated state, not only routes. Run from the monitor directory:
+
+    python -m bench.ha [runs] [links] [interval] [dead_interval]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from core.application import Application, DEFAULT_SETTINGS
+from bench.failover import percentile
+from bench.fake_kernel import FakeCommandBackend, FakeKernel, FakeProbeEngine
+from bench.scale import address_of, cancel_pending, gateway_of
+
+
+class Node(object):
+
+    loop = None
+    kernel = None
+    commands = None
+    app = None
+
+    def __init__(self, loop, role, links, interval, dead_interval, state_dir):
+        self.loop = loop
+        self.kernel = FakeKernel()
+        names = ['ppp%i' % ii for ii in range(links)]
+        for index, name in enumerate(names):
+            self.kernel.link_up(name, address_of(index), 24,
+                    gateway_of(index))
+        self.commands = FakeCommandBackend(loop, self.kernel)
+
+        self.app = Application(loop, os.path.dirname(os.path.abspath(
+                __file__)), {
+            'monitored_networks': dict((name, {'active': True})
+                    for name in names),
+            'events': dict(DEFAULT_SETTINGS['events'], source='syslog',
+                    syslog_port=0),
+            'telemetry': dict(DEFAULT_SETTINGS['telemetry'], enabled=False),
+            'state_dir': state_dir,
+            'ha': dict(DEFAULT_SETTINGS['ha'], enabled=True, role=role,
+                    address='127.0.0.1', port=0, peer='127.0.0.1',
+                    interval=interval, dead_interval=dead_interval,
+                    key='bench'),
+        }, commands=self.commands)
+        self.app.probe_engine = FakeProbeEngine(self.kernel)
+
+
+    async def start(self):
+        self.app.startup()
+        while self.app.ha.transport is None or not self.app.is_monitoring:
+            await asyncio.sleep(0.001)
+
+
+    def pair(self, other):
+        self.app.ha.peer = ('127.0.0.1', other.app.ha.local_address()[1])
+
+
+    def close(self):
+        self.app.is_active = False
+        self.loop.run_until_complete(self.app.close())
+
+
+async def wait_for(condition, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(0.001)
+    return False
+
+
+async def takeover(primary, standby, links):
+    await primary.start()
+    await standby.start()
+    primary.pair(standby)
+    standby.pair(primary)
+
+    everything = frozenset(gateway_of(index) for index in range(links))
+    if not await wait_for(lambda: primary.kernel.lan_gateways() ==
+            everything):
+        return None, None, None
+
+    await primary.app.drain(primary.app.networks.get('ppp0'))
+    expected = everything - frozenset((gateway_of(0),))
+    ha = standby.app.ha
+    if not await wait_for(lambda: ha.takeover_plan is not None and
+            standby.app.networks.get('ppp0').draining and
+            ha.plan_inputs is not None and not ha.preparing):
+        return None, None, None
+    # the plan after the drain made it over
+    await asyncio.sleep(primary.app.ha.interval * 2)
+
+    primary.app.ha.close()
+    start = time.perf_counter()
+    if not await wait_for(lambda: ha.active and
+            standby.kernel.lan_gateways() == expected):
+        return None, None, None
+    return time.perf_counter() - start, ha.takeover_time,\
+            standby.commands.count
+
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 5
+    links = int(argv[2]) if len(argv) > 2 else 3
+    interval = float(argv[3]) if len(argv) > 3 else 0.1
+    dead_interval = float(argv[4]) if len(argv) > 4 else 0.3
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    totals = []
+    applies = []
+    failed = 0
+    try:
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as primary_dir,\
+                    tempfile.TemporaryDirectory() as standby_dir:
+                primary = Node(loop, 'primary', links, interval,
+                        dead_interval, primary_dir)
+                standby = Node(loop, 'standby', links, interval,
+                        dead_interval, standby_dir)
+                try:
+                    total, apply, _ = loop.run_until_complete(
+                            takeover(primary, standby, links))
+                finally:
+                    primary.close()
+                    standby.close()
+                    cancel_pending(loop)
+
+            if total is None:
+                failed += 1
+                continue
+            totals.append(total)
+            applies.append(apply)
+    finally:
+        loop.close()
+
+    print('%i runs, %i links, ha.interval %.3fs, ha.dead_interval %.3fs' % (
+            runs, links, interval, dead_interval))
+    print('  silence to routes p50 %7.1fms  max %7.1fms' % (
+            percentile(totals, 0.5) * 1000,
+            max(totals or [float('nan')]) * 1000))
+    print('  plan applied in   p50 %7.1fms  max %7.1fms' % (
+            percentile(applies, 0.5) * 1000,
+            max(applies or [float('nan')]) * 1000))
+    print('  %i runs did not take over' % failed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,260 @@
+""" Feed a recorded journal back through the monitor.
+
+Syslog lines go through SyslogHandler, netlink events straight to
+push_event, probes answer what was recorded for the network, in order. The
+in-memory kernel follows the addressing recorded after each link event, so
+the real Application reroutes against it. Run from the monitor directory:
+
+    python -m bench.replay var/journal.jsonl [speed] [max_gap]
+
+Time runs `speed` times faster, durations in the settings are scaled to
+match, and no gap between events lasts longer than `max_gap` seconds.
+Prints the reroutes of the recording next to those of the replay.
+"""
+
+import asyncio
+from collections import deque
+from copy import deepcopy
+from datetime import datetime
+import os
+import sys
+import tempfile
+import time
+
+from core.application import Application, DEFAULT_SETTINGS
+from core.journal import read_journal
+from core.probes import ProbeResult
+from bench.failover import percentile
+from bench.fake_kernel import FakeCommandBackend, FakeKernel, FakeProbeEngine
+from bench.scale import cancel_pending
+
+SOURCES = ('syslog', 'netlink')
+
+# seconds, divided by the replay speed
+TIME_SETTINGS = (
+    'route.delay',
+    'probe.interval',
+    'probe.suspect_interval',
+    'probe.max_backoff',
+    'probe.coalesce',
+    'probe.budget_window',
+    'recovery.settle',
+    'recovery.stagger',
+    'health.half_life',
+)
+
+
+class ReplayProbeEngine(FakeProbeEngine):
+    """ recorded probe rounds first, then whatever the kernel says """
+
+    rounds = None
+
+    def __init__(self, kernel, rounds):
+        super().__init__(kernel)
+        self.rounds = rounds
+
+
+    async def run(self, network):
+        recorded = self.rounds.get(network.interface_name)
+        if not recorded:
+            return await super().run(network)
+
+        target = network.settings['test_ip']
+        return [ProbeResult(kind, target, success, latency,
+                0.0 if success else 1.0, None, None if success else 'replay')
+                for kind, success, latency in recorded.popleft()]
+
+
+def replay_settings(recorded, speed, state_dir):
+    """ nested settings of the recording, fit for a local replay """
+    settings = deepcopy(DEFAULT_SETTINGS)
+    for key, value in recorded.items():
+        section = settings
+        parts = key.split('.')
+        for part in parts[:-1]:
+            section = section.setdefault(part, {})
+        section[parts[-1]] = value
+
+    for key in TIME_SETTINGS:
+        section, name = key.split('.')
+        settings[section][name] = settings[section][name] / float(speed)
+
+    settings['events'].update(source='syslog', syslog_port=0)
+    settings['metrics']['enabled'] = False
+    settings['telemetry']['enabled'] = False
+    # one node on its own, the recorded key is redacted anyway
+    settings['ha']['enabled'] = False
+    settings['reload']['watch'] = 0
+    # the recorded path is the live monitor's socket, binding it would
+    # take the socket away from that monitor
+    settings['control'].update(enabled=False, path=None)
+    settings['commands'].update(dry_run=False, record=False)
+    settings['journal'].update(enabled=True, flush_interval=0.1,
+            max_bytes=1 << 30)
+    settings['state_dir'] = state_dir
+    return settings
+
+
+def kernel_link(record):
+    gateway = record['route'].split()[-1]
+    prefixlen = int(record['network'].split('/')[1])
+    return (record['local_ip'], prefixlen, gateway)
+
+
+def link_updates(records):
+    """ source record index -> the addressing recorded after its event """
+    updates = {}
+    waiting = {}
+    for index, record in enumerate(records):
+        if record['k'] in SOURCES:
+            waiting.setdefault(record['name'], []).append(index)
+        elif record['k'] == 'link' and record['cause'] == 'event':
+            for source in waiting.pop(record['name'], ()):
+                updates[source] = record
+    return updates
+
+
+def summary(records):
+    reroutes = [record for record in records if record['k'] == 'reroute']
+    durations = [record['duration'] for record in reroutes]
+    return {
+        'events': len([record for record in records
+                if record['k'] in SOURCES]),
+        'reroutes': len(reroutes),
+        'errors': len([record for record in reroutes
+                if record['result'] != 'success']),
+        'commands': sum(record['commands'] for record in reroutes),
+        'p50': percentile(durations, 0.5) * 1000,
+        'max': max(durations or [float('nan')]) * 1000,
+        'failovers': len([record for record in records
+                if record['k'] == 'failover']),
+        'restarts': len([record for record in records
+                if record['k'] == 'restart']),
+    }
+
+
+def report(name, numbers):
+    print(('%-9s %4i events %4i reroutes (%i failed) %6i commands ' +\
+            'p50 %7.1fms max %7.1fms %4i failover plans %3i restarts') % (
+            name, numbers['events'], numbers['reroutes'], numbers['errors'],
+            numbers['commands'], numbers['p50'], numbers['max'],
+            numbers['failovers'], numbers['restarts']))
+
+
+class Replay(object):
+
+    loop = None
+    records = None
+    speed = 1
+    max_gap = 5
+    kernel = None
+    app = None
+
+    def __init__(self, loop, records, speed, max_gap, state_dir):
+        self.loop = loop
+        self.records = records
+        self.speed = speed
+        self.max_gap = max_gap
+        self.kernel = FakeKernel()
+
+        start = [record for record in records if record['k'] == 'start']
+        if not start:
+            raise ValueError('The journal has no start record.')
+
+        rounds = {}
+        for record in records:
+            if record['k'] == 'link' and record['cause'] == 'adopt' and\
+                    record['connected']:
+                self.kernel.link_up(record['name'], *kernel_link(record))
+            elif record['k'] == 'probe':
+                rounds.setdefault(record['name'], deque()).append(
+                        record['results'])
+
+        self.app = Application(loop, os.path.dirname(os.path.abspath(
+                __file__)), replay_settings(start[0]['settings'], speed,
+                state_dir), commands=FakeCommandBackend(loop, self.kernel))
+        self.app.probe_engine = ReplayProbeEngine(self.kernel, rounds)
+
+
+    def idle(self):
+        return self.app.reroute_handle is None and\
+                not self.app.is_defining_route and self.app.queue.empty()
+
+
+    async def run(self, settle=1.0):
+        app = self.app
+        app.startup()
+        while app.syslog_protocol is None or not app.is_monitoring:
+            await asyncio.sleep(0.001)
+
+        updates = link_updates(self.records)
+        previous = None
+        for index, record in enumerate(self.records):
+            if record['k'] not in SOURCES:
+                continue
+            if previous is not None:
+                await asyncio.sleep(min((record['t'] - previous) / self.speed,
+                        self.max_gap))
+            previous = record['t']
+
+            link = updates.get(index)
+            if link is not None and link['connected']:
+                self.kernel.link_up(record['name'], *kernel_link(link))
+            elif not record['active']:
+                self.kernel.link_down(record['name'])
+
+            if record['k'] == 'syslog':
+                app.syslog_protocol.datagram_received(
+                        record['message'].encode('utf-8'), None)
+            else:
+                app.push_event(record['active'], record['name'],
+                        datetime.now(), record['details'], ('netlink', None))
+
+        # until nothing happened for `settle` seconds
+        quiet = time.perf_counter()
+        while time.perf_counter() - quiet < settle:
+            await asyncio.sleep(0.01)
+            if not self.idle():
+                quiet = time.perf_counter()
+
+
+    def close(self):
+        self.app.is_active = False
+        self.loop.run_until_complete(self.app.close())
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+
+    records = list(read_journal(argv[1]))
+    speed = float(argv[2]) if len(argv) > 2 else 10.0
+    max_gap = float(argv[3]) if len(argv) > 3 else 5.0
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            replay = Replay(loop, records, speed, max_gap, state_dir)
+            start = time.perf_counter()
+            try:
+                loop.run_until_complete(replay.run())
+            finally:
+                replay.close()
+                cancel_pending(loop)
+
+            replayed = list(read_journal(os.path.join(state_dir,
+                    'journal.jsonl')))
+
+        print('%i records replayed at %.1fx in %.1f seconds' % (
+                len(records), speed, time.perf_counter() - start))
+        report('recorded', summary(records))
+        report('replayed', summary(replayed))
+    finally:
+        loop.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,124 @@
+""" Reroute and event dispatch time at 10, 100 and 500 interfaces.
+
+Runs the real Application against the in-memory command backend, from the
+monitor directory:
+
+    python -m bench.scale [count ...]
+"""
+
+import asyncio
+from datetime import datetime
+import os
+import sys
+import tempfile
+import time
+
+from core.application import Application, DEFAULT_SETTINGS
+from bench.fake_kernel import FakeCommandBackend
+
+
+def address_of(index):
+    return '10.%i.%i.2' % (index // 256, index % 256)
+
+
+def gateway_of(index):
+    return '10.%i.%i.1' % (index // 256, index % 256)
+
+
+async def measure(loop, count, state_dir):
+    commands = FakeCommandBackend(loop)
+    names = ['ppp%i' % ii for ii in range(count)]
+    route = dict(DEFAULT_SETTINGS['route'], max_tables=count + 10)
+    app = Application(loop, os.path.dirname(os.path.abspath(__file__)), {
+        'monitored_networks': dict((name, {'active': True}) for name in names),
+        'route': route,
+        'state_dir': state_dir,
+    }, commands=commands)
+
+    for name, settings in app.settings['monitored_networks'].items():
+        app.add_network(name, settings)
+
+    timestamp = datetime.now()
+    start = time.perf_counter()
+    for ii, name in enumerate(names):
+        app.push_event(True, name, timestamp, {
+            'local_ip': address_of(ii),
+            'network': address_of(ii)[:-1] + '0/24',
+            'route': 'via ' + gateway_of(ii),
+        })
+    while not app.queue.empty():
+        await app.handle_event(*app.queue.get_nowait())
+    dispatch = time.perf_counter() - start
+    app.reroute_handle.cancel()
+
+    before = commands.count
+    start = time.perf_counter()
+    await app.do_reroute()
+    full = time.perf_counter() - start
+    full_commands = app.reroute_commands
+    full_execs = commands.count - before
+
+    # one link goes away, the rest must stay untouched; the failover plan
+    # goes in with the event, the reroute after it has to find nothing left
+    plan = app.plans.get(names[count // 2])
+    before = commands.count
+    start = time.perf_counter()
+    await app.handle_event(False, names[count // 2], timestamp, None)
+    failover = time.perf_counter() - start
+    failover_execs = commands.count - before
+    app.reroute_handle.cancel()
+    before = commands.count
+    start = time.perf_counter()
+    await app.do_reroute()
+    single = time.perf_counter() - start
+    single_commands = app.reroute_commands
+    single_execs = commands.count - before
+
+    # nothing changed at all
+    before = commands.count
+    start = time.perf_counter()
+    await app.do_reroute()
+    idle = time.perf_counter() - start
+    idle_execs = commands.count - before
+
+    app.is_active = False
+
+    print('%4i interfaces: dispatch %7.2fms (%.1fus/event)' % (count,
+            dispatch * 1000, dispatch * 1e6 / count))
+    print('      full reroute   %8.2fms, %4i commands, %i execs' % (
+            full * 1000, full_commands, full_execs))
+    if plan is not None:
+        print('      link down plan %8.2fms, %4i commands, %i execs' % (
+                failover * 1000, plan.commands_issued, failover_execs))
+    else:
+        print('      link down, no plan past route.plan_limit')
+    print('      then reroute   %8.2fms, %4i commands, %i execs' % (
+            single * 1000, single_commands, single_execs))
+    print('      no change      %8.2fms, %4i execs' % (idle * 1000,
+            idle_execs))
+
+
+def cancel_pending(loop):
+    """ probes and restarts started by the reroutes """
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    tasks = list(all_tasks(loop))
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+def main(argv):
+    counts = [int(arg) for arg in argv[1:]] or [10, 100, 500]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for count in counts:
+            with tempfile.TemporaryDirectory() as state_dir:
+                loop.run_until_complete(measure(loop, count, state_dir))
+                cancel_pending(loop)
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
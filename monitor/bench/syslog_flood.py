@@ -0,0 +1,166 @@
+""" Fire synthetic syslog floods at SyslogHandler.
+
+Reports events per second and memory, run from the monitor directory:
+
+    python -m bench.syslog_flood [datagrams] [udp]
+"""
+
+import asyncio
+from datetime import datetime
+import random
+import socket
+import sys
+import time
+import tracemalloc
+
+from core.application import DEFAULT_SETTINGS
+from core.event_queue import EventQueue
+from core.journal import EventJournal
+from core.syslog_handler import SyslogHandler
+from misc.configuration import flatten_dict
+from bench.scale import cancel_pending
+
+INTERFACES = ['ppp%i' % ii for ii in range(6)]
+
+TEMPLATES = [
+    # noise, the bulk of a chatty wpa_supplicant
+    (40, 'wpa_supplicant[812]', 'wlan0: CTRL-EVENT-SCAN-RESULTS'),
+    (20, 'wpa_supplicant[812]', 'wlan0: WPA: Group rekeying completed'),
+    (10, 'sshd[1102]', 'Accepted publickey for root from 10.0.0.5'),
+    (10, 'dhcpcd[433]', '{intf}: adding default route via 10.0.0.1'),
+    (5, 'dhcpcd[433]', '{intf}: removing interface'),
+    (5, 'wpa_cli', 'interface {intf} CONNECTED'),
+    (5, 'kernel', '{intf}: link becomes ready'),
+    (5, None, 'garbage that is not syslog at all'),
+]
+
+
+class FloodApp(object):
+    """ just enough Application for the handler """
+
+    loop = None
+    queue = None
+    journal = None
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = EventQueue(loop)
+        # disabled, as by default
+        self.journal = EventJournal(loop, None, dict(flatten_dict(None,
+                {'journal': DEFAULT_SETTINGS['journal']})))
+
+
+    def push_event(self, active, name, timestamp, details=None, source=None):
+        self.queue.put_nowait((active, name, timestamp, details, source))
+
+
+    async def on_syslog_connected(self):
+        pass
+
+
+def make_datagrams(count, seed=1):
+    rand = random.Random(seed)
+    population = []
+    for weight, prog, message in TEMPLATES:
+        population.extend([(prog, message)] * weight)
+
+    datagrams = []
+    date = datetime.now().strftime('%b %d %H:%M:%S')
+    for _ in range(count):
+        prog, message = rand.choice(population)
+        message = message.format(intf=rand.choice(INTERFACES))
+        if prog is None:
+            datagrams.append(message.encode())
+        else:
+            datagrams.append(('<30>%s gateway %s: %s' % (date, prog,
+                    message)).encode())
+    return datagrams
+
+
+def flood_direct(loop, datagrams):
+    app = FloodApp(loop)
+    handler = SyslogHandler(app)
+    start = time.perf_counter()
+    for data in datagrams:
+        handler.datagram_received(data, ('127.0.0.1', 514))
+    return time.perf_counter() - start, app, handler
+
+
+async def flood_udp(loop, datagrams):
+    app = FloodApp(loop)
+    handler = SyslogHandler(app)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sock.bind(('127.0.0.1', 0))
+    transport, _ = await loop.create_datagram_endpoint(handler, sock=sock)
+
+    address = transport.get_extra_info('sockname')
+
+    def send():
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for data in datagrams:
+                sender.sendto(data, address)
+        finally:
+            sender.close()
+
+    start = time.perf_counter()
+    try:
+        # a real flood does not wait for us, what the socket buffer cannot
+        # hold is lost in the kernel
+        await loop.run_in_executor(None, send)
+        while True:
+            before = handler.received
+            await asyncio.sleep(0.05)
+            if handler.received == before:
+                break
+    finally:
+        transport.close()
+    return time.perf_counter() - start, app, handler
+
+
+def report(name, elapsed, app, handler, peak=None, sent=None):
+    print('%s: %i datagrams in %.3fs, %.0f datagrams/s, %.0f events/s' % (
+            name, handler.received, elapsed, handler.received / elapsed,
+            app.queue.received / elapsed))
+    print('  parsed %i, unparsed %i, events %i, coalesced %i, dropped %i, '
+            'queue depth %i' % (handler.parsed, handler.unparsed,
+            app.queue.received, app.queue.coalesced, app.queue.dropped,
+            app.queue.qsize()))
+    if peak is not None:
+        print('  peak traced memory %.1f KiB' % (peak / 1024.0))
+    if sent is not None:
+        print('  lost in socket buffer %i' % (sent - handler.received))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    use_udp = len(argv) > 2 and argv[2] == 'udp'
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    datagrams = make_datagrams(count)
+
+    try:
+        elapsed, app, handler = flood_direct(loop, datagrams)
+        report('direct', elapsed, app, handler)
+
+        tracemalloc.start()
+        elapsed, app, handler = flood_direct(loop, datagrams)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report('direct, traced', elapsed, app, handler, peak)
+
+        if use_udp:
+            elapsed, app, handler = loop.run_until_complete(
+                    flood_udp(loop, datagrams))
+            report('udp', elapsed, app, handler, sent=len(datagrams))
+    finally:
+        # the on_syslog_connected tasks of every flood, never run in the
+        # direct ones
+        cancel_pending(loop)
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
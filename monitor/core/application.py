@@ -1,24 +1,238 @@
 import asyncio
-from copy import copy
 from datetime import datetime
 from logging import getLogger
 import os
-
-from misc.configuration import flatten_dict, load_files_from_shell
+import re
+
+from misc.configuration import config_files_from_shell
+from .commands import CommandBackend
+from .control import ControlServer
+from .event_queue import EventQueue
+from .ha import HaNode
+from .icmp_prober import HostResolver, IcmpProber
+from .journal import EventJournal
+from .metrics import LoopLagMonitor, MetricsServer, MonitorMetrics
 from .monitored_network import MonitoredNetwork
+from .monitored_network import DEFAULT_SETTINGS as NETWORK_SETTINGS
+from .netlink_handler import NetlinkHandler
+from .netlink_handler import open_socket as netlink_open_socket
+from .probe_scheduler import ProbeScheduler
+from .probes import ProbeEngine
+from .profiling import configure_logging, logging_configured, Profiler
+from .recovery import RecoveryLadder
+from .registry import NetworkRegistry
+from .reconciler import desired_state, keep_live_table, keep_pending_routes
+from .reconciler import live_multipath_table
+from .reconciler import managed_tables, multipath_route, multipath_tables
+from .reconciler import read_state, read_table, reconcile, route_args
+from .reconciler import routes_in, switch_multipath_table, table_mark
+from .route_batch import RouteBatch
+from .settings import is_restart_setting, load_settings, redact_networks
+from .settings import redact_settings, validate_settings
+from .snapshot import load_snapshot, save_snapshot, take_snapshot
 from .syslog_handler import SyslogHandler
+from .telemetry import TrafficSampler
+from .weighting import WeightEngine
 
 DEFAULT_SETTINGS = {
     'monitored_networks': {},
-    'poll_interval': 5,
+    'events': {
+        # netlink, syslog or both, syslog is used when netlink fails
+        'source': 'netlink',
+        'syslog_address': '127.0.0.1',
+        'syslog_port': 1979,
+        # pending events are coalesced per interface, the queue grows to
+        # the number of monitored networks if that is larger
+        'queue_size': 256,
+    },
+    'probe': {
+        'dns_ttl': 300,
+        'concurrency': 16,
+        # seconds between probes of a healthy link, +/- jitter fraction
+        'interval': 60,
+        'jitter': 0.1,
+        # re-probe after a failure, this many times
+        'suspect_interval': 5,
+        'suspect_probes': 3,
+        # then back off exponentially up to max_backoff seconds
+        'max_backoff': 600,
+        # probes due this close together start in one wakeup
+        'coalesce': 0.5,
+        # probe rounds per budget_window seconds, over all networks
+        'budget': 120,
+        'budget_window': 60,
+    },
     'route': {
+        # seconds after the last event of a burst
         'delay': 10,
+        # reroute right away when a link goes down
+        'fast_disconnect': False,
         'multipath_table': 323,
+        'multipath_standby_table': 324,
         'base_table': 200,
+        # per-interface tables are allocated from base_table + 1 on
+        'max_tables': 250,
+        # keep the commands for every single link loss ready, applied right
+        # away on disconnect, the full reroute follows after `delay`
+        'failover_plans': True,
+        # no plans with more connected networks, they cost O(n^2) to build
+        'plan_limit': 16,
+        # drop the conntrack entries masqueraded to the address of a lost
+        # link, flows of the other links are kept
+        'conntrack_flush': True,
+    },
+    'restart': {
+        # interfaces restarted at the same time
+        'concurrency': 4,
+    },
+    'recovery': {
+        # cheapest first, see core.recovery.RECOVERY_ACTIONS
+        'ladder': ['dhcp_rebind', 'link_bounce', 'init_restart'],
+        # seconds between an action and the probe that verifies it
+        'settle': 5,
+        # seconds between the start of recoveries of different interfaces
+        'stagger': 5,
+    },
+    'startup': {
+        # adopt the addressing interfaces already have instead of
+        # restarting all of them, failing health checks still restart
+        'warm': True,
+        # restore nexthop weights of the previous run from state_dir
+        'snapshot': True,
+        # seconds, older snapshots are ignored
+        'snapshot_max_age': 3600,
+    },
+    'reload': {
+        # seconds between checks of the configuration files for changes,
+        # 0 only reloads on SIGHUP
+        'watch': 0,
+    },
+    # table ids and other state kept across restarts, default is var/ in
+    # the root directory
+    'state_dir': None,
+    'health': {
+        # failed probe rounds before a link is down and gets recovered
+        'fail_threshold': 3,
+        # good rounds before a down or recovering link is used again
+        'success_threshold': 2,
+        # flap damping, a flap adds flap_penalty which halves every
+        # half_life seconds, links above suppress are kept out of the
+        # multipath route until they decay below reuse
+        'flap_penalty': 1000,
+        'suppress': 2000,
+        'reuse': 750,
+        'half_life': 60,
+    },
+    'weights': {
+        'enabled': True,
+        # ewma factor of new rtt/loss samples
+        'smoothing': 0.3,
+        # weight change per update
+        'max_step': 2,
+        # update multipath route once any weight is this far off target
+        'threshold': 2,
+        'max_weight': 10,
+        'rtt_floor': 0.005,
+        # quality multiplier of links above telemetry.saturation
+        'saturated_penalty': 0.25,
+    },
+    'telemetry': {
+        'enabled': True,
+        'sysfs_root': '/sys/class/net',
+        'interval': 2,
+        # samples kept per interface
+        'history': 60,
+        # fraction of the network's capacity
+        'saturation': 0.9,
+        # samples averaged for the saturation check
+        'window': 3,
+    },
+    'commands': {
+        # seconds before a command is killed
+        'timeout': 30,
+        # commands running at the same time
+        'concurrency': 8,
+        # per command kind, the program name or init.d for init scripts
+        'kinds': {
+            'init.d': {'timeout': 180},
+            # xtables lock
+            'iptables-restore': {'concurrency': 1},
+        },
+        # log commands without running them, for tests
+        'dry_run': False,
+        'record': False,
+        # recent commands kept for inspection
+        'trace_size': 100,
+    },
+    'metrics': {
+        # prometheus text format on http://address:port/metrics
+        'enabled': False,
+        'address': '127.0.0.1',
+        'port': 9323,
+        # seconds between event loop lag probes
+        'lag_interval': 1,
+    },
+    'control': {
+        # unix socket for monitorctl.py, default state_dir/control.sock
+        'enabled': False,
+        'path': None,
+    },
+    'ha': {
+        # active/standby pair, see core/ha.py
+        'enabled': False,
+        # primary starts active, standby waits for a dead primary
+        'role': 'primary',
+        # the higher one stays active, default 200 for primary, 100 standby
+        'priority': None,
+        'address': '0.0.0.0',
+        'port': 1980,
+        'peer': None,
+        'peer_port': 1980,
+        'interval': 1,
+        # silence before the standby takes over
+        'dead_interval': 3,
+        # shared secret, heartbeats are signed when set
+        'key': None,
+        # seconds a heartbeat timestamp may be off, older ones are replays
+        'max_skew': 30,
+    },
+    'logging': {
+        # level of the root logger, applies on reload too
+        'level': 'INFO',
+        'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+        # logger name -> level
+        'levels': {},
+        # per command and per batch debug lines at DEBUG level, they cost
+        # more than the commands on big tables
+        'hot_path_debug': False,
+    },
+    'profile': {
+        # log event loop stalls longer than this many seconds, 0 for never
+        'lag_threshold': 0.25,
+        # asyncio debug mode, logs callbacks slower than this, 0 for off
+        'slow_callback': 0,
+        # SIGUSR1/SIGUSR2 write cProfile and tracemalloc output here,
+        # default state_dir
+        'dir': None,
+        'tracemalloc_frames': 10,
+    },
+    'journal': {
+        # link events, probes, reroutes and restarts as JSONL in state_dir,
+        # for bench.replay
+        'enabled': False,
+        'max_bytes': 4194304,
+        'backups': 3,
+        'flush_interval': 1,
+        # records waiting for the writer, newer ones are dropped beyond
+        'max_pending': 10000,
     },
 }
 
 
+CONNTRACK_DELETED_RE = re.compile(r'(\d+) flow entries have been deleted')
+CONNTRACK_UPDATED_RE = re.compile(r'(\d+) flow entries have been updated')
+
+
 class Application(object):
 
     logger = None
@@ -26,6 +240,7 @@ class Application(object):
     settings = None
     is_active = True
     is_defining_route = False
+    is_monitoring = False
 
     networks = None
     networks_hash = None
@@ -33,80 +248,209 @@ class Application(object):
 
     base_dir = None
     root_dir = None
+    state_dir = None
 
     reroute_timestamp = None
+    reroute_handle = None
+    reroute_again = False
+    execute_task = None
+    reroute_commands = 0
+    reroute_duration = 0
+    reroute_plan = None
+    # held by the control socket, failover plans still apply
+    reroute_suppressed = False
+    reroute_held = False
+    reroute_forced = False
+    suppress_handle = None
     future = None
     syslog_handler = None
-
-
-    def __init__(self, loop, base_dir, user_settings=None):
+    syslog_protocol = None
+    netlink_handler = None
+    prober = None
+    commands = None
+    restart_semaphore = None
+    recovery = None
+    probe_engine = None
+    scheduler = None
+    weights = None
+    telemetry = None
+    multipath_table = None
+    # interface name -> RouteBatch that takes it out of the live routes
+    plans = None
+    # addresses of lost links whose conntrack entries are still there
+    stale_addresses = None
+    flows_dropped = 0
+    flows_preserved = None
+    metrics = None
+    metrics_server = None
+    loop_lag = None
+    journal = None
+    profiler = None
+    control_server = None
+    ha = None
+    user_settings = None
+    config_mtimes = None
+    watch_handle = None
+
+
+    def __init__(self, loop, base_dir, user_settings=None, commands=None):
         self.logger = getLogger(type(self).__name__)
         self.loop = loop
         self.base_dir = base_dir
         self.root_dir = os.environ.get('ROOT_DIR', os.path.dirname(base_dir))
-        self.networks = []
-        self.queue = asyncio.Queue()
 
-        settings = copy(DEFAULT_SETTINGS)
-        load_files_from_shell(settings)
-        if user_settings is not None:
-            settings.update(user_settings)
+        self.user_settings = user_settings
+        self.settings = load_settings(DEFAULT_SETTINGS, user_settings)
+        validate_settings(self.settings, DEFAULT_SETTINGS, NETWORK_SETTINGS)
+        self.config_mtimes = self.read_config_mtimes()
+
+        if commands is None:
+            commands = CommandBackend(loop, self.settings)
+        self.commands = commands
+
+        self.state_dir = self.settings['state_dir'] or\
+                os.path.join(self.root_dir, 'var')
+
+        self.networks = NetworkRegistry(self.settings['route.base_table'],
+                self.settings['route.max_tables'],
+                multipath_tables(self.settings),
+                os.path.join(self.state_dir, 'route_tables.json'))
+
+        self.queue = EventQueue(loop, self.settings['events.queue_size'])
+        self.restart_semaphore = asyncio.Semaphore(
+                self.settings['restart.concurrency'])
+        self.recovery = RecoveryLadder(self)
+
+        self.prober = IcmpProber(loop, HostResolver(loop,
+                self.settings['probe.dns_ttl']))
+
+        self.probe_engine = ProbeEngine(loop, self.prober,
+                self.settings['probe.concurrency'])
+        self.scheduler = ProbeScheduler(loop, self.settings,
+                self.check_network)
+
+        if self.settings['telemetry.enabled']:
+            self.telemetry = TrafficSampler(loop, self.settings,
+                    self.check_weights)
+
+        self.weights = WeightEngine(self.settings, self.telemetry)
+        self.plans = {}
+        self.stale_addresses = set()
 
-        self.settings = dict(flatten_dict(
-                None,
-                settings,
-                exclude=
-                (
-                    'monitored_networks',
-                )))
+        self.journal = EventJournal(loop, os.path.join(self.state_dir,
+                'journal.jsonl'), self.settings)
+        self.profiler = Profiler(loop, self.state_dir, self.settings)
 
+        if self.settings['ha.enabled']:
+            self.ha = HaNode(self)
 
-    async def on_network_connected(self, name, timestamp):
-        await self.queue.put((1, name, timestamp))
+        self.metrics = MonitorMetrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        for metric in self.commands.metrics():
+            self.metrics.add(metric)
+
+
+    def push_event(self, active, name, timestamp, details=None, source=None):
+        """ called by the event sources, never blocks
+
+        `source` is a (kind, message) pair for the journal, recorded once the
+        event is handled so coalesced ones cost nothing.
+        """
+        if name not in self.networks:
+            return
+        if not self.queue.put_nowait((active, name, timestamp, details,
+                source)):
+            self.logger.warning('Event queue full, %s event dropped.', name)
+
+
+    async def on_network_connected(self, name, timestamp, details=None):
+        self.push_event(True, name, timestamp, details)
 
 
     async def on_network_disconnected(self, name, timestamp):
-        await self.queue.put((0, name, timestamp))
+        self.push_event(False, name, timestamp)
 
 
     async def execute(self):
+        """ sleeps on the queue, nothing runs while there are no events """
         while self.is_active:
-            await asyncio.sleep(self.settings['poll_interval'])
+            event = await self.queue.get()
             try:
-                await self._execute()
-            except:
-                self.logger.exception()
+                await self.handle_event(*event)
+            except: # pylint:disable=bare-except
+                self.logger.exception('Event error:')
 
 
-    async def _execute(self):
-        try:
-            while not self.queue.empty():
-                active, name, _ = await self.queue.get()
-
-                for network in self.networks:
-                    if network.interface_name == name:
-                        if active:
-                            await network.on_connect()
-                        else:
-                            await network.on_disconnect()
-                        self.reroute_timestamp = datetime.now()
-                        break
-
-        except asyncio.QueueEmpty:
-            pass
-
-        if self.reroute_timestamp is None:
+    async def handle_event(self, active, name, timestamp, details,
+            source=None):
+        network = self.networks.get(name)
+        if network is None:
             return
 
-        delta = datetime.now() - self.reroute_timestamp
-        delay = self.settings['route.delay']
-        if delta.seconds < delay:
-            self.logger.debug('Until reroute %i seconds.',
-                    delay - delta.seconds)
+        if source is not None:
+            kind, message = source
+            if message is None:
+                self.journal.record(kind, name=name, active=active,
+                        details=details)
+            else:
+                self.journal.record(kind, name=name, active=active,
+                        message=message)
+
+        if network.local_ip is not None:
+            self.stale_addresses.add(network.local_ip)
+
+        if active:
+            before = network.addressing()
+            await network.on_connect(details)
+            if network.addressing() != before:
+                self.plans = {}
+        else:
+            connected = network.connected
+            await network.on_disconnect()
+            if connected:
+                await self.apply_plan(name)
+        self.journal_link(network, 'event')
+
+        if not active and self.settings['route.fast_disconnect']:
+            self.schedule_reroute(0)
+        else:
+            self.schedule_reroute(self.settings['route.delay'])
+
+
+    def schedule_reroute(self, delay):
+        """ (re)arm the debounce timer, reroute `delay` after the last call """
+        self.reroute_timestamp = datetime.now()
+        if self.reroute_handle is not None:
+            self.reroute_handle.cancel()
+
+        self.logger.debug('Reroute in %i seconds.', delay)
+        self.reroute_handle = self.loop.call_later(delay,
+                self.on_reroute_timer)
+
+
+    def on_reroute_timer(self):
+        self.reroute_handle = None
+        self.loop.create_task(self.reroute())
+
+
+    async def reroute(self):
+        if self.is_defining_route:
+            # an event came in during the running reroute, go again after it
+            self.reroute_again = True
             return
 
         self.reroute_timestamp = None
 
+        if self.is_standby():
+            self.logger.debug('Standby, no reroute.')
+            return
+
+        if self.reroute_suppressed and not self.reroute_forced:
+            self.reroute_held = True
+            self.logger.info('Reroute suppressed.')
+            return
+        self.reroute_forced = False
+
         new_hash = await self.get_networking_hash()
         if self.networks_hash == new_hash:
             self.logger.info('Reroute canceled because same hash.')
@@ -114,221 +458,779 @@ class Application(object):
 
         self.logger.info('Defining route...')
         self.is_defining_route = True
+        self.plans = {}
+        self.reroute_plan = None
+        start = self.loop.time()
         try:
             await self.do_reroute()
             self.networks_hash = await self.get_networking_hash()
             self.logger.info('Route defined.')
+            result = 'success'
         except: # pylint:disable=bare-except
             self.logger.exception('Rerouting error:')
+            result = 'error'
+            # the kernel is somewhere in between, try again from scratch
+            self.networks_hash = None
+            self.schedule_reroute(self.settings['route.delay'])
+
+        duration = self.loop.time() - start
+        self.metrics.reroutes.inc(result)
+        self.metrics.reroute_duration.observe(duration)
+        self.metrics.reroute_commands.observe(self.reroute_commands)
+        self.journal.record('reroute', result=result, duration=duration,
+                commands=self.reroute_commands, table=self.multipath_table,
+                plan=self.reroute_plan)
 
         self.is_defining_route = False
 
+        if self.reroute_again:
+            self.reroute_again = False
+            self.schedule_reroute(0)
+
 
     async def do_reroute(self):
-        multipath_table = str(self.settings['route.multipath_table'])
-        base_table = self.settings['route.base_table']
+        actual = await read_state(self.commands, managed_tables(self.settings,
+                self.networks))
+
+        primary_table, standby_table = multipath_tables(self.settings)
+        live_table = live_multipath_table(actual, (primary_table,
+                standby_table))
+        if live_table == standby_table:
+            target_table = primary_table
+        else:
+            target_table = standby_table
+
+        desired = desired_state(self.networks, live_table or target_table)
+        keep_pending_routes(desired, actual, self.networks)
+
+        batch = RouteBatch(self.commands)
+
+        if live_table is not None and routes_in(desired, live_table) ==\
+                routes_in(actual, live_table):
+            self.logger.debug('Multipath table %s is still valid.',
+                    live_table)
+            reconcile(desired, actual, batch)
+            await batch.apply()
+            plan = batch.lines()
+            self.multipath_table = live_table
+        else:
+            desired = desired_state(self.networks, target_table)
+            keep_live_table(desired, actual, live_table, target_table)
+            keep_pending_routes(desired, actual, self.networks)
+
+            reconcile(desired, actual, batch)
+            await batch.apply()
+
+            built = await read_table(self.commands, target_table)
+            if built != routes_in(desired, target_table):
+                raise RuntimeError('Multipath table %s was not built, '
+                        'table %s stays live.' % (target_table, live_table))
+
+            switch = RouteBatch(self.commands)
+            switch_multipath_table(switch, actual, live_table,
+                    target_table)
+            await switch.apply()
+            plan = batch.lines() + switch.lines()
+            self.multipath_table = target_table
+
+            self.logger.info('Multipath table switched from %s to %s.',
+                    live_table, target_table)
+
+            batch.commands_issued += switch.commands_issued
+            batch.execs += switch.execs
+            batch.duration += switch.duration
+
+        self.logger.debug('Desired %r', desired)
+        self.logger.debug('Actual %r', actual)
+
+        self.reroute_commands = batch.commands_issued
+        self.reroute_duration = batch.duration
+        self.reroute_plan = plan
+        self.logger.info('Applied %i commands with %i execs in %.3f seconds.',
+                batch.commands_issued, batch.execs, batch.duration)
+
+        self.refresh_plans()
+        self.persist_state()
+        await self.flush_conntrack()
+
+        # see whether the new routes work
+        for network in self.networks:
+            self.scheduler.probe_soon(network.interface_name)
+
+
+    def is_standby(self):
+        """ the HA peer routes, this node only keeps up """
+        return self.ha is not None and not self.ha.active
+
+
+    def force_reroute(self):
+        """ rebuild the routes now, even if nothing seems to have changed """
+        self.plans = {}
+        self.networks_hash = None
+        self.reroute_forced = True
+        self.schedule_reroute(0)
+
+
+    def suppress_reroute(self, seconds=None):
+        """ hold reroutes until resumed, or for `seconds` """
+        if self.suppress_handle is not None:
+            self.suppress_handle.cancel()
+            self.suppress_handle = None
+        self.reroute_suppressed = True
+        if seconds:
+            self.suppress_handle = self.loop.call_later(seconds,
+                    self.resume_reroute)
+        self.logger.info('Reroutes suppressed %s.', 'for %.0f seconds' %
+                seconds if seconds else 'until resumed')
+
+
+    def resume_reroute(self):
+        if self.suppress_handle is not None:
+            self.suppress_handle.cancel()
+            self.suppress_handle = None
+        self.reroute_suppressed = False
+        self.logger.info('Reroutes resumed.')
+        if self.reroute_held:
+            self.reroute_held = False
+            self.schedule_reroute(0)
+
+
+    async def drain(self, network):
+        """ no new flows over `network`, its flows keep table and nat
+
+        Its conntrack entries get the mark of its table, the fwmark rule of
+        the table keeps their packets on it after it left the multipath
+        route. Returns the number of flows marked.
+        """
+        name = network.interface_name
+        network.draining = True
+        flows = 0
+        if network.connected:
+            result = await self.commands.run('conntrack', '-U', '-q',
+                    network.local_ip, '-m', table_mark(network.table_id))
+            match = CONNTRACK_UPDATED_RE.search(result.stderr + result.stdout)
+            if match is not None:
+                flows = int(match.group(1))
+
+        self.logger.info('Draining %s, %i flows stay on it.', name, flows)
+        self.journal.record('drain', name=name, flows=flows)
+        self.schedule_reroute(0)
+        return flows
+
+
+    def undrain(self, network):
+        network.draining = False
+        self.logger.info('%s takes new flows again.', network.interface_name)
+        self.journal.record('undrain', name=network.interface_name)
+        self.schedule_reroute(0)
+
+
+    def status(self):
+        """ live state for the control socket """
+        networks = {}
+        for network in self.networks:
+            health = network.health
+            networks[network.interface_name] = {
+                'connected': network.connected,
+                'usable': network.is_usable(),
+                'draining': network.draining,
+                'recovering': network.recovering,
+                'local_ip': network.local_ip,
+                'network': network.network,
+                'route': network.route,
+                'table_id': network.table_id,
+                'weight': network.nexthop_weight,
+                'health': health.state,
+                'flap_penalty': health.current_penalty(),
+                'flap_suppressed': health.is_suppressed(),
+                'probes': [result._asdict()
+                        for result in network.probe_results or ()],
+            }
+
+        return {
+            'networks': networks,
+            'scheduler': self.scheduler.status(),
+            'reroute': {
+                'multipath_table': self.multipath_table,
+                'running': self.is_defining_route,
+                'pending': self.reroute_handle is not None,
+                'suppressed': self.reroute_suppressed,
+                'held': self.reroute_held,
+                'commands': self.reroute_commands,
+                'duration': self.reroute_duration,
+            },
+            'flows': {
+                'dropped': self.flows_dropped,
+                'preserved': self.flows_preserved,
+            },
+            'commands': [trace._asdict() for trace in self.commands.trace],
+            'ha': None if self.ha is None else self.ha.status(),
+        }
+
+
+    def refresh_plans(self):
+        """ for every connected network, the delta that drops it """
+        self.plans = {}
+        hops = [network for network in self.networks if network.connected]
+        if not self.settings['route.failover_plans'] or\
+                self.multipath_table is None or\
+                len(hops) > self.settings['route.plan_limit']:
+            return
 
-        self.logger.debug('Clean routing table.')
+        current = desired_state(self.networks, self.multipath_table)
+        for network in hops:
+            survivors = [item for item in self.networks if item is not network]
+            plan = RouteBatch(self.commands)
+            reconcile(desired_state(survivors, self.multipath_table), current,
+                    plan)
+            self.plans[network.interface_name] = plan
 
-        count = len(self.networks)
-        if count < 100:
-            count = 100
 
-        for ii in range(count):
-            await self.purge_routing_table(str(base_table + ii + 1))
+    async def apply_plan(self, name):
+        plan = self.plans.pop(name, None)
+        if plan is None or self.is_defining_route or self.is_standby():
+            self.metrics.failover_plans.inc('missing')
+            return False
 
-        await self.purge_routing_table(multipath_table)
+        self.is_defining_route = True
+        try:
+            await plan.apply()
+        except: # pylint:disable=bare-except
+            self.logger.exception('Failover plan error:')
+            self.plans = {}
+            self.networks_hash = None
+            return False
+        finally:
+            self.is_defining_route = False
+            # the reroute after this event covers whatever came meanwhile
+            self.reroute_again = False
+
+        # routes no longer match the hash of the last reroute
+        self.networks_hash = None
+        self.metrics.failover_plans.inc('applied')
+        self.journal.record('failover', name=name, duration=plan.duration,
+                commands=plan.commands_issued,
+                plan=plan.lines())
+        self.logger.info('Failover plan of %s applied, %i commands with %i ' +\
+                'execs in %.3f seconds.', name, plan.commands_issued,
+                plan.execs, plan.duration)
+
+        # ready for the next loss
+        self.refresh_plans()
+        await self.flush_conntrack()
+        return True
+
+
+    async def flush_conntrack(self):
+        """ forget the flows of addresses no network holds any more """
+        in_use = set(network.local_ip for network in self.networks
+                if network.connected)
+        addresses = sorted(self.stale_addresses - in_use)
+        self.stale_addresses.clear()
+        if not addresses or not self.settings['route.conntrack_flush']:
+            return
 
-        self.logger.debug(' '.join(['iptables', '-t', 'nat',
-                '-F']))
-        process = await asyncio.create_subprocess_exec('iptables', '-t', 'nat',
-                '-F')
+        dropped = 0
+        for address in addresses:
+            # -q is the reply destination, the masqueraded source address
+            result = await self.commands.run('conntrack', '-D', '-q', address)
+            match = CONNTRACK_DELETED_RE.search(result.stderr + result.stdout)
+            if match is not None:
+                dropped += int(match.group(1))
 
-        await process.wait()
+        result = await self.commands.run('conntrack', '-C')
+        try:
+            preserved = int(result.stdout.strip())
+        except ValueError:
+            preserved = None
+
+        self.flows_dropped = dropped
+        self.flows_preserved = preserved
+        self.journal.record('conntrack', addresses=addresses, dropped=dropped,
+                preserved=preserved)
+        self.metrics.flows_dropped.inc(amount=dropped)
+        if preserved is not None:
+            self.metrics.flows_preserved.set(preserved)
+        self.logger.info('Dropped %i flows of %s, %s flows preserved.',
+                dropped, ', '.join(addresses), preserved)
+
+
+    async def check_network(self, name):
+        network = self.networks.get(name)
+        if network is None or self.is_defining_route or\
+                self.reroute_timestamp:
+            return None
+        return await network.check()
+
+
+    def on_health_changed(self, network, previous, was_usable):
+        name = network.interface_name
+        state = network.health.state
+        self.logger.info('Link %s went from %s to %s.', name, previous, state)
+        self.metrics.health_transitions.inc(name, state)
+        self.journal.record('health', name=name, previous=previous,
+                state=state, penalty=network.health.current_penalty())
+
+        if network.health.suppressed:
+            self.on_suppressed(network)
+        if network.is_usable() != was_usable:
+            # in or out of the multipath route, hysteresis already waited
+            self.plans = {}
+            self.schedule_reroute(0)
+
+
+    def on_suppressed(self, network):
+        delay = network.health.reuse_delay()
+        self.logger.warning('Link %s is flapping, kept out of the ' +\
+                'multipath route for %.0f seconds.', network.interface_name,
+                delay)
+        self.loop.call_later(delay + 1, self.on_reuse, network.interface_name)
+
+
+    def on_reuse(self, name):
+        network = self.networks.get(name)
+        if network is not None and network.is_usable():
+            self.logger.info('Link %s is stable again.', name)
+            self.plans = {}
+            self.schedule_reroute(0)
+
+
+    def on_probe_results(self, network, results):
+        name = network.interface_name
+        for result in results:
+            if result.success:
+                self.metrics.probes.inc(name, result.kind, 'success')
+                self.metrics.probe_latency.observe(result.latency, name,
+                        result.kind)
+            else:
+                self.metrics.probes.inc(name, result.kind, 'failure')
+        self.journal.record('probe', name=name, results=[(result.kind,
+                result.success, result.latency) for result in results])
+
+        self.weights.observe(network, results)
+        self.check_weights()
+
+
+    def check_weights(self):
+        if not self.settings['weights.enabled']:
+            return
 
-        # main table without default gateway
-        await self.run_until_error('ip', 'route', 'del', 'default')
+        hops = [network for network in self.networks if network.is_usable()]
+        if len(hops) > 1 and self.weights.drift(hops) >=\
+                self.settings['weights.threshold']:
+            self.loop.create_task(self.update_weights())
 
-        self.logger.debug('Create new routing table.')
 
-        for ii, network in enumerate(self.networks):
-            if not network.connected:
-                continue
+    async def update_weights(self):
+        """ replace the live multipath route, per-interface tables stay """
+        if self.is_defining_route or self.reroute_timestamp or\
+                self.multipath_table is None or self.is_standby():
+            return
 
-            table_id = str(base_table + ii + 1)
+        hops = [network for network in self.networks if network.is_usable()]
+        if len(hops) < 2 or not self.weights.step(hops):
+            return
 
-            self.logger.debug(' '.join(['ip', 'rule', 'add', 'prio', table_id,
-                    'from',
-                    network.local_ip, 'lookup', table_id]))
-            process = await asyncio.create_subprocess_exec(
-                    'ip', 'rule', 'add', 'prio', table_id, 'from',
-                    network.local_ip, 'lookup', table_id)
+        batch = RouteBatch(self.commands)
+        batch.ip('route', 'replace', *route_args(multipath_route(
+                self.networks, self.multipath_table)))
 
-            await process.wait()
+        # a reroute meanwhile would rebuild the standby table and flip the
+        # rule under us, it waits like it does for another reroute
+        self.is_defining_route = True
+        try:
+            await batch.apply()
+        except RuntimeError as exc:
+            self.logger.warning('Nexthop weights not updated: %s', exc)
+            self.networks_hash = None
+            self.reroute_again = True
+            return
+        finally:
+            self.is_defining_route = False
+            if self.reroute_again:
+                self.reroute_again = False
+                self.schedule_reroute(0)
+        self.metrics.weight_updates.inc()
+        self.refresh_plans()
+        self.persist_state()
+        self.logger.info('Nexthop weights updated in %.3f seconds.',
+                batch.duration)
 
-            self.logger.debug(' '.join([
-                    'ip', 'route', 'add', 'default',
-                    'src', network.local_ip, 'proto', 'static', 'table',
-                    table_id, *network.route.split(' ')]))
-            process = await asyncio.create_subprocess_exec(
-                    'ip', 'route', 'add', 'default',
-                    'src', network.local_ip, 'proto', 'static', 'table',
-                    table_id, *network.route.split(' '))
 
-            await process.wait()
+    async def on_syslog_connected(self):
+        await self.start_monitoring()
 
-            self.logger.debug(' '.join(['ip', 'route', 'append', 'prohibit',
-                    'default',
-                    'metric', '1', 'proto', 'static', 'table', table_id]))
-            process = await asyncio.create_subprocess_exec(
-                    'ip', 'route', 'append', 'prohibit', 'default',
-                    'metric', '1', 'proto', 'static', 'table', table_id)
 
-            await process.wait()
+    async def start_monitoring(self):
+        """ called on startup and by the first event source to come up """
+        if self.is_monitoring:
+            return
+        self.is_monitoring = True
+        self.journal.record('start', settings=redact_settings(self.settings))
 
-            self.logger.debug(' '.join(['iptables', '-t', 'nat', '-A',
-                    'POSTROUTING', '-o', network.interface_name, '-j',
-                    'MASQUERADE']))
-            process = await asyncio.create_subprocess_exec(
-                    'iptables', '-t', 'nat', '-A', 'POSTROUTING', '-o',
-                    network.interface_name, '-j', 'MASQUERADE')
+        warm = self.settings['startup.warm']
+        adopted = []
+        for name, settings in self.settings['monitored_networks'].items():
+            if not settings.get('active', True):
+                continue
 
-            await process.wait()
+            network = self.add_network(name, settings)
+            if network is None:
+                continue
 
-        self.logger.debug(' '.join(['ip', 'rule', 'del', 'prio', '32765']))
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'rule', 'del', 'prio', '32765',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
+            if warm:
+                adopted.append(network)
+            else:
+                self.loop.create_task(network.restart())
 
-        await process.wait()
+        if self.telemetry is not None:
+            self.telemetry.start()
 
-        self.logger.debug(' '.join(['ip', 'rule', 'add', 'prio', '32765',
-                'lookup', 'main']))
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'rule', 'add', 'prio', '32765', 'lookup', 'main')
+        if self.settings['reload.watch']:
+            self.watch_handle = self.loop.call_later(
+                    self.settings['reload.watch'], self.watch_config)
 
-        await process.wait()
+        self.execute_task = self.loop.create_task(self.execute())
 
-        self.logger.debug(' '.join(['ip', 'rule', 'del', 'prio', '32766']))
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'rule', 'del', 'prio', '32766',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
+        if adopted:
+            await self.adopt(adopted)
 
-        await process.wait()
 
-        self.logger.debug(' '.join(['ip', 'rule', 'add', 'prio', '32766',
-                'lookup', multipath_table]))
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'rule', 'add', 'prio', '32766', 'lookup', multipath_table)
+    async def adopt(self, networks):
+        await asyncio.gather(*[network.adopt() for network in networks])
+        for network in networks:
+            self.journal_link(network, 'adopt')
 
-        await process.wait()
+        if self.settings['startup.snapshot']:
+            snapshot = load_snapshot(self.snapshot_filename(),
+                    self.settings['startup.snapshot_max_age'])
+            if snapshot is not None:
+                self.restore_snapshot(snapshot)
 
-        load_balancing = ['ip', 'route', 'add', 'default', 'table',
-                multipath_table, 'proto', 'static']
+        self.logger.info('Warm start, %i of %i interfaces connected.',
+                len([network for network in networks if network.connected]),
+                len(networks))
 
-        hops = [network for network in self.networks if network.connected]
+        # take over the tables of the previous run, probing starts after
+        self.schedule_reroute(0)
 
-        self.logger.debug(repr(hops))
 
-        if len(hops) == 0:
-            load_balancing = None
-        elif len(hops) == 1:
-            load_balancing.extend(hops[0].route.split(' '))
-        else:
-            for network in hops:
-                load_balancing.append('nexthop')
-                load_balancing.extend(network.route.split(' '))
-                load_balancing.append('weight')
-                load_balancing.append(str(network.settings['weight']))
+    def journal_link(self, network, cause):
+        self.journal.record('link', name=network.interface_name, cause=cause,
+                connected=network.connected, local_ip=network.local_ip,
+                network=network.network, route=network.route)
 
-        if load_balancing:
-            self.logger.debug(' '.join(load_balancing))
-            process = await asyncio.create_subprocess_exec(*load_balancing)
-            await process.wait()
 
-        self.logger.debug(' '.join(['ip', 'route', 'flush', 'cache']))
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'route', 'flush', 'cache')
+    def snapshot_filename(self):
+        return os.path.join(self.state_dir, 'snapshot.json')
 
-        await process.wait()
 
+    def restore_snapshot(self, snapshot):
+        """ weights only carry over to links with the same addressing """
         for network in self.networks:
-            self.loop.create_task(network.ping())
+            saved = snapshot['networks'].get(network.interface_name)
+            if saved is None or not network.connected or\
+                    saved['local_ip'] != network.local_ip or\
+                    saved['route'] != network.route:
+                continue
+            network.nexthop_weight = saved['nexthop_weight']
 
 
-    async def on_syslog_connected(self):
-        for name, settings in self.settings['monitored_networks'].items():
-            if not settings['active']:
+    def persist_state(self):
+        if self.settings['startup.snapshot']:
+            save_snapshot(self.snapshot_filename(), take_snapshot(self))
+
+
+    def add_network(self, name, settings):
+        network = MonitoredNetwork(self, name, settings)
+        try:
+            self.networks.add(network)
+        except ValueError:
+            self.logger.exception('Cannot monitor %s:', name)
+            return None
+
+        # one pending event per interface has to fit
+        self.queue.maxsize = max(self.queue.maxsize, len(self.networks))
+
+        if self.telemetry is not None:
+            self.telemetry.track(name, network.settings['capacity'])
+        self.scheduler.add(name)
+        return network
+
+
+    def retire_network(self, name):
+        network = self.networks.remove(name)
+        if network is None:
+            return None
+
+        self.scheduler.remove(name)
+        self.weights.forget(network)
+        if self.telemetry is not None:
+            self.telemetry.untrack(name)
+        if network.local_ip is not None:
+            self.stale_addresses.add(network.local_ip)
+        self.plans.pop(name, None)
+        return network
+
+
+    def reload(self):
+        """ SIGHUP, apply what changed in the configuration files """
+        try:
+            settings = load_settings(DEFAULT_SETTINGS, self.user_settings)
+            validate_settings(settings, DEFAULT_SETTINGS, NETWORK_SETTINGS)
+        except Exception as exc: # pylint:disable=broad-except
+            self.logger.error('Configuration rejected, keeping the running ' +\
+                    'one: %s', exc)
+            self.metrics.reloads.inc('rejected')
+            self.journal.record('reload', result='rejected', error=str(exc))
+            return False
+
+        for key, value in settings.items():
+            if is_restart_setting(key) and value != self.settings.get(key):
+                self.logger.warning('%s only changes on restart.', key)
+                settings[key] = self.settings.get(key)
+
+        previous = self.settings['monitored_networks']
+        self.settings = settings
+        self.scheduler.configure(settings)
+        self.weights.configure(settings)
+        self.recovery.configure(settings)
+        self.profiler.configure(settings)
+        if self.loop_lag is not None:
+            self.loop_lag.threshold = settings['profile.lag_threshold']
+        if logging_configured():
+            configure_logging(settings)
+        for network in self.networks:
+            network.health.configure(settings)
+        self.metrics.reloads.inc('applied')
+        self.journal.record('reload', result='applied',
+                networks=redact_networks(settings['monitored_networks']))
+        self.logger.info('Configuration reloaded.')
+
+        if self.is_monitoring:
+            self.loop.create_task(self.apply_networks(previous,
+                    settings['monitored_networks']))
+        return True
+
+
+    async def apply_networks(self, previous, current):
+        """ create, retire or update only the networks that changed """
+        reroute = False
+        for network in list(self.networks):
+            name = network.interface_name
+            settings = current.get(name)
+            if settings is not None and settings.get('active', True):
                 continue
+            self.retire_network(name)
+            self.logger.info('Stopped monitoring %s.', name)
+            reroute = reroute or network.connected
 
-            network = MonitoredNetwork(self, name, settings)
-            self.networks.append(network)
+        for name, settings in current.items():
+            if not settings.get('active', True):
+                continue
+
+            network = self.networks.get(name)
+            if network is None:
+                network = self.add_network(name, settings)
+                if network is None:
+                    continue
+                self.logger.info('Started monitoring %s.', name)
+                await network.adopt()
+                reroute = reroute or network.connected
+
+            elif settings != previous.get(name):
+                network.configure(settings)
+                if self.telemetry is not None:
+                    self.telemetry.track(name, network.settings['capacity'])
+                self.scheduler.probe_soon(name)
+                self.logger.info('Updated settings of %s.', name)
+                reroute = reroute or network.connected
+
+        if reroute:
+            self.plans = {}
+            self.networks_hash = None
+            self.schedule_reroute(0)
+
+
+    def read_config_mtimes(self):
+        mtimes = {}
+        for filename in config_files_from_shell():
+            try:
+                mtimes[filename] = os.stat(filename).st_mtime
+            except OSError:
+                mtimes[filename] = None
+        return mtimes
 
-            await network.restart()
-            self.loop.create_task(network.ping())
 
-        self.loop.create_task(self.execute())
+    def watch_config(self):
+        mtimes = self.read_config_mtimes()
+        if mtimes != self.config_mtimes:
+            self.config_mtimes = mtimes
+            self.reload()
+        self.watch_handle = self.loop.call_later(self.settings['reload.watch'],
+                self.watch_config)
 
 
     def startup(self):
         self.future = self.loop.create_future()
 
-        syslog_handler = SyslogHandler(self)
-        server = self.loop.create_datagram_endpoint(syslog_handler,
-                ('127.0.0.1', 1979))
+        source = self.settings['events.source']
+        use_syslog = source in ('syslog', 'both')
+        if source in ('netlink', 'both'):
+            try:
+                sock = netlink_open_socket()
+            except OSError as exc:
+                self.logger.warning('Cannot listen to netlink, falling ' +\
+                        'back to syslog: %s', exc)
+                use_syslog = True
+            else:
+                self.loop.create_task(self.listen_netlink(sock))
+
+        if use_syslog:
+            self.loop.create_task(self.listen_syslog())
+
+        # no need to wait for the first event
+        self.loop.create_task(self.start_monitoring())
+
+        if self.settings['control.enabled']:
+            self.loop.create_task(self.listen_control())
+
+        if self.ha is not None:
+            self.loop.create_task(self.ha.start())
+
+        if self.settings['metrics.enabled']:
+            self.loop.create_task(self.listen_metrics())
+
+        # the watchdog lives as long as the process, reload only changes
+        # its threshold
+        if self.settings['metrics.enabled'] or\
+                self.settings['profile.lag_threshold']:
+            self.loop_lag = LoopLagMonitor(self.loop, self.metrics,
+                    self.settings['metrics.lag_interval'],
+                    self.settings['profile.lag_threshold'])
+            self.loop_lag.start()
 
-        self.loop.create_task(server)
-        self.syslog_handler = server
         return self.future
 
 
-    async def close(self):
-        self.syslog_handler.close()
+    async def listen_netlink(self, sock):
+        self.netlink_handler, _ = await self.loop.create_datagram_endpoint(
+                NetlinkHandler(self), sock=sock)
 
 
-    def shutdown(self):
-        self.is_active = False
-        self.future.set_result(None)
+    async def listen_syslog(self):
+        self.syslog_handler, self.syslog_protocol =\
+                await self.loop.create_datagram_endpoint(SyslogHandler(self),
+                (self.settings['events.syslog_address'],
+                self.settings['events.syslog_port']))
+
+
+    async def listen_metrics(self):
+        try:
+            self.metrics_server = await asyncio.start_server(
+                    MetricsServer(self.metrics).handle,
+                    self.settings['metrics.address'],
+                    self.settings['metrics.port'])
+        except OSError as exc:
+            self.logger.warning('Cannot serve metrics: %s', exc)
 
 
-    async def run_until_error(self, *args):
-        max_retry = 5
-        while max_retry:
-            process = await asyncio.create_subprocess_exec(
-                    *args,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE)
+    def control_path(self):
+        return self.settings['control.path'] or os.path.join(self.state_dir,
+                'control.sock')
+
+
+    async def listen_control(self):
+        path = self.control_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.control_server = await ControlServer(self).start(path)
+        except OSError as exc:
+            self.logger.warning('Cannot listen on %s: %s', path, exc)
+
+
+    def collect_metrics(self):
+        """ copy live state into gauges, runs per scrape only """
+        metrics = self.metrics
+        metrics.connected.clear()
+        metrics.usable.clear()
+        metrics.flap_penalty.clear()
+        for network in self.networks:
+            metrics.connected.set(int(network.connected),
+                    network.interface_name)
+            metrics.usable.set(int(network.is_usable()),
+                    network.interface_name)
+            metrics.flap_penalty.set(network.health.current_penalty(),
+                    network.interface_name)
+
+        if self.syslog_protocol is not None:
+            metrics.syslog.set(self.syslog_protocol.received, 'received')
+            metrics.syslog.set(self.syslog_protocol.parsed, 'parsed')
+            metrics.syslog.set(self.syslog_protocol.unparsed, 'unparsed')
+
+        metrics.events.set(self.queue.received, 'received')
+        metrics.events.set(self.queue.coalesced, 'coalesced')
+        metrics.events.set(self.queue.dropped, 'dropped')
+        metrics.queue_depth.set(self.queue.qsize())
+
+        status = self.scheduler.status()
+        metrics.probe_next.clear()
+        for name, slot in status['networks'].items():
+            if slot['next_probe'] is not None:
+                metrics.probe_next.set(slot['next_probe'], name)
+        metrics.probe_budget.set(status['budget']['remaining'])
+
+        if self.ha is not None:
+            metrics.ha_active.set(int(self.ha.active))
 
-            ret = await process.wait()
-            if ret:
-                break
-            max_retry -= 1
 
+    async def close(self):
+        if self.reroute_handle is not None:
+            self.reroute_handle.cancel()
+        if self.execute_task is not None:
+            self.execute_task.cancel()
+        if self.syslog_handler is not None:
+            self.syslog_handler.close()
+        if self.netlink_handler is not None:
+            self.netlink_handler.close()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        if self.loop_lag is not None:
+            self.loop_lag.stop()
+        self.scheduler.stop()
+        if self.watch_handle is not None:
+            self.watch_handle.cancel()
+        if self.suppress_handle is not None:
+            self.suppress_handle.cancel()
+        if self.ha is not None:
+            self.ha.close()
+        self.profiler.stop()
+        if self.control_server is not None:
+            self.control_server.close()
+            await self.control_server.wait_closed()
+            try:
+                os.remove(self.control_path())
+            except OSError:
+                pass
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        await self.journal.close()
 
-    async def purge_routing_table(self, table_id):
-        self.logger.debug(' '.join(['ip', 'rule', 'del', 'prio', table_id]))
-        await self.run_until_error('ip', 'rule', 'del', 'prio', table_id)
 
-        self.logger.debug(' '.join(['ip', 'route', 'del', 'all', 'table',
-                table_id]))
-        await self.run_until_error('ip', 'route', 'del', 'all', 'table',
-                table_id)
+    def shutdown(self):
+        self.is_active = False
+        self.future.set_result(None)
 
 
     async def get_networking_hash(self):
         new_hash = []
         for network in self.networks:
             new_hash.append((network.interface_name, network.connected,
-                    network.local_ip, network.network, network.route))
-
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'route', 'show',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-        out, err = await process.communicate()
-        out = out.decode('utf-8')
-        new_hash.extend(out.splitlines())
+                    network.is_usable(), network.local_ip, network.network,
+                    network.route))
+
+        result = await self.commands.run('ip', 'route', 'show')
+        new_hash.extend(result.stdout.splitlines())
 
         return hash(frozenset(new_hash))
@@ -0,0 +1,168 @@
+""" Every external command goes through here, so it can be replaced. """
+
+import asyncio
+from collections import deque, namedtuple
+from logging import getLogger
+import os
+import signal
+
+from .metrics import Counter, Histogram, DURATION_BUCKETS
+
+CommandResult = namedtuple('CommandResult', 'returncode stdout stderr ' +\
+        'duration')
+
+CommandTrace = namedtuple('CommandTrace', 'kind args returncode duration ' +\
+        'outcome')
+
+
+def command_kind(args):
+    """ program name, all init scripts are one kind """
+    if args[0].startswith('/etc/init.d/'):
+        return 'init.d'
+    return os.path.basename(args[0])
+
+
+class CommandBackend(object):
+    """ timeouts, concurrency limits and tracing around subprocesses
+
+    Subclasses replace `execute` to answer commands some other way.
+    """
+
+    loop = None
+    logger = None
+
+    count = 0
+    timeout = 30
+    concurrency = 8
+    # kind -> {'timeout': seconds, 'concurrency': n}
+    kinds = None
+    # only record commands, never execute them
+    dry_run = False
+    # list of (args, payload) when recording
+    recorded = None
+    # most recent CommandTrace records
+    trace = None
+
+    semaphore = None
+    kind_semaphores = None
+    durations = None
+    outcomes = None
+
+    def __init__(self, loop, settings=None):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.kinds = {}
+        trace_size = 100
+
+        if settings is not None:
+            self.timeout = settings['commands.timeout']
+            self.concurrency = settings['commands.concurrency']
+            self.kinds = settings['commands.kinds'] or {}
+            self.dry_run = settings['commands.dry_run']
+            if settings['commands.record'] or self.dry_run:
+                self.recorded = []
+            trace_size = settings['commands.trace_size']
+
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.kind_semaphores = {}
+        self.trace = deque(maxlen=trace_size)
+
+        self.durations = Histogram('monitor_command_duration_seconds',
+                'Time external commands took to run.', ('kind',),
+                DURATION_BUCKETS)
+        self.outcomes = Counter('monitor_commands_total',
+                'External commands by outcome.', ('kind', 'outcome'))
+
+
+    def metrics(self):
+        return [self.durations, self.outcomes]
+
+
+    def kind_setting(self, kind, name, default):
+        value = self.kinds.get(kind, {}).get(name)
+        return default if value is None else value
+
+
+    def kind_semaphore(self, kind):
+        if kind not in self.kind_semaphores:
+            limit = self.kind_setting(kind, 'concurrency', None)
+            self.kind_semaphores[kind] = None if limit is None else\
+                    asyncio.Semaphore(limit)
+        return self.kind_semaphores[kind]
+
+
+    async def run(self, *args, payload=None, timeout=None):
+        """ run command, `payload` is written to its stdin
+
+        Never raises for a failed command, a command that could not be
+        started exits with 127 and one that timed out is killed.
+        """
+        kind = command_kind(args)
+        if timeout is None:
+            timeout = self.kind_setting(kind, 'timeout', self.timeout)
+
+        if self.recorded is not None:
+            self.recorded.append((args, payload))
+
+        self.count += 1
+        if self.dry_run:
+            result = CommandResult(0, '', '', 0)
+            outcome = 'dry_run'
+        else:
+            kind_semaphore = self.kind_semaphore(kind)
+            async with self.semaphore:
+                if kind_semaphore is None:
+                    result, outcome = await self.guarded_execute(args,
+                            payload, timeout)
+                else:
+                    async with kind_semaphore:
+                        result, outcome = await self.guarded_execute(args,
+                                payload, timeout)
+
+        self.durations.observe(result.duration, kind)
+        self.outcomes.inc(kind, outcome)
+        self.trace.append(CommandTrace(kind, args, result.returncode,
+                result.duration, outcome))
+        self.logger.debug('exec kind=%s outcome=%s returncode=%s ' +\
+                'duration=%.3f argv=%r', kind, outcome, result.returncode,
+                result.duration, args)
+        return result
+
+
+    async def guarded_execute(self, args, payload, timeout):
+        start = self.loop.time()
+        try:
+            result = await self.execute(args, payload, timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning('%s killed after %s seconds.', args[0],
+                    timeout)
+            return CommandResult(-signal.SIGKILL, '', 'Timed out.',
+                    self.loop.time() - start), 'timeout'
+        except OSError as exc:
+            self.logger.warning('Cannot run %s: %s', args[0], exc)
+            return CommandResult(127, '', str(exc),
+                    self.loop.time() - start), 'error'
+
+        return result, 'ok' if result.returncode == 0 else 'error'
+
+
+    async def execute(self, args, payload, timeout):
+        """ raises asyncio.TimeoutError after killing a hung process """
+        start = self.loop.time()
+        process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=None if payload is None else asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+
+        try:
+            out, err = await asyncio.wait_for(process.communicate(
+                    None if payload is None else payload.encode('utf-8')),
+                    timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+
+        return CommandResult(process.returncode, out.decode('utf-8', 'replace'),
+                err.decode('utf-8', 'replace'), self.loop.time() - start)
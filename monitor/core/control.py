@@ -0,0 +1,117 @@
+""" Unix socket to query and steer the running monitor.
+
+One JSON object per line in, one per line out, see `monitorctl.py`:
+
+    {"command": "status"}
+    {"command": "reroute"}
+    {"command": "suppress", "seconds": 600}
+    {"command": "resume"}
+    {"command": "drain", "interface": "ppp0"}
+    {"command": "undrain", "interface": "ppp0"}
+
+Every answer has "ok", failed ones an "error" too.
+"""
+
+import asyncio
+from json import dumps as json_dumps, loads as json_loads
+from logging import getLogger
+import os
+
+
+class ControlServer(object):
+
+    app = None
+    logger = None
+
+    def __init__(self, app):
+        self.app = app
+        self.logger = getLogger(type(self).__name__)
+
+
+    async def start(self, path):
+        if os.path.exists(path):
+            # left over from a run that did not exit cleanly
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        # commands change routing, root only
+        os.chmod(path, 0o600)
+        return server
+
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self.dispatch(line)
+                writer.write((json_dumps(response, sort_keys=True,
+                        default=str) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError as exc:
+            self.logger.debug('Control connection failed: %r', exc)
+        finally:
+            writer.close()
+
+
+    async def dispatch(self, line):
+        try:
+            request = json_loads(line.decode('utf-8'))
+        except ValueError:
+            return {'ok': False, 'error': 'Request is not JSON.'}
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'Request must be an object.'}
+
+        command = request.get('command')
+        handler = getattr(self, 'do_%s' % command, None)
+        if handler is None:
+            return {'ok': False, 'error': 'Unknown command %r.' % (command,)}
+
+        try:
+            result = await handler(request)
+        except ValueError as exc:
+            return {'ok': False, 'error': str(exc)}
+        except: # pylint:disable=bare-except
+            self.logger.exception('Control command %s failed:', command)
+            return {'ok': False, 'error': 'Internal error.'}
+
+        self.logger.info('Control command %s done.', command)
+        response = {'ok': True}
+        response.update(result or {})
+        return response
+
+
+    def network(self, request):
+        name = request.get('interface')
+        network = self.app.networks.get(name)
+        if network is None:
+            raise ValueError('%r is not monitored.' % (name,))
+        return network
+
+
+    async def do_status(self, request):
+        return self.app.status()
+
+
+    async def do_reroute(self, request):
+        self.app.force_reroute()
+
+
+    async def do_suppress(self, request):
+        seconds = request.get('seconds')
+        if seconds is not None and (isinstance(seconds, bool) or
+                not isinstance(seconds, (int, float)) or seconds <= 0):
+            raise ValueError('seconds must be a positive number.')
+        self.app.suppress_reroute(seconds)
+
+
+    async def do_resume(self, request):
+        self.app.resume_reroute()
+
+
+    async def do_drain(self, request):
+        return {'flows': await self.app.drain(self.network(request))}
+
+
+    async def do_undrain(self, request):
+        self.app.undrain(self.network(request))
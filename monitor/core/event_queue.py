@@ -0,0 +1,75 @@
+""" Bounded link event queue keeping only the latest event per interface. """
+
+import asyncio
+from collections import OrderedDict
+
+
+class EventQueue(object):
+    """ (active, name, timestamp, details, source) events keyed by interface
+    name
+
+    A newer event for an interface that is still pending replaces the
+    older one, the reroute only cares about the final state anyway.
+    """
+
+    loop = None
+    maxsize = 0
+    pending = None
+    waiter = None
+
+    received = 0
+    coalesced = 0
+    dropped = 0
+
+    def __init__(self, loop, maxsize=256):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.pending = OrderedDict()
+
+
+    def qsize(self):
+        return len(self.pending)
+
+
+    def empty(self):
+        return not self.pending
+
+
+    def put_nowait(self, item):
+        """ never blocks, returns False if the event was dropped """
+        self.received += 1
+        name = item[1]
+        if name in self.pending:
+            self.coalesced += 1
+            # keep the interface's place in line
+            self.pending[name] = item
+        elif len(self.pending) >= self.maxsize:
+            self.dropped += 1
+            return False
+        else:
+            self.pending[name] = item
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        return True
+
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+
+    def get_nowait(self):
+        if not self.pending:
+            raise asyncio.QueueEmpty()
+        _, item = self.pending.popitem(last=False)
+        return item
+
+
+    async def get(self):
+        while not self.pending:
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.get_nowait()
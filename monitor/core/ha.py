@@ -0,0 +1,448 @@
+""" Active/standby pair of monitors on two gateways.
+
+Both nodes send a heartbeat to each other every `ha.interval` seconds over
+UDP, the active one with the health, addressing, weights and drain state of
+its links and the nexthops of its multipath route. The standby neither
+probes, reroutes nor restarts interfaces. It takes over the link health of
+the active node and keeps a RouteBatch ready, reconciled against its own
+kernel. When no heartbeat came for `ha.dead_interval` seconds it applies
+that batch and carries on as the active node.
+
+If both end up active, for example when the primary comes back, the one
+with the lower `ha.priority` steps down. With `ha.key` set, datagrams carry
+a HMAC-SHA256 and anything without a valid one is ignored. Heartbeats carry
+the sender's clock and a sequence number, a captured one cannot be replayed
+later nor within `ha.max_skew` seconds.
+"""
+
+import asyncio
+import hashlib
+import hmac
+from json import dumps as json_dumps, loads as json_loads
+from logging import getLogger
+import os
+import time
+
+from .reconciler import desired_state, keep_pending_routes
+from .reconciler import live_multipath_table, managed_tables
+from .reconciler import multipath_route, multipath_tables, read_state
+from .reconciler import reconcile
+from .route_batch import RouteBatch
+
+HA_VERSION = 1
+DIGEST_SIZE = 64
+
+# field -> accepted types, bool is no number here
+HEARTBEAT_FIELDS = (
+    ('node', str),
+    ('sequence', int),
+    ('time', (int, float)),
+    ('priority', (int, float)),
+    ('active', bool),
+)
+
+NETWORK_FIELDS = ('connected', 'local_ip', 'network', 'route', 'health',
+        'penalty', 'suppressed', 'weight', 'draining')
+
+# sequence numbers of this many peer nodes are remembered
+MAX_PEERS = 16
+
+
+def heartbeat_error(message):
+    """ what is wrong with a decoded heartbeat, None if nothing """
+    for field, types in HEARTBEAT_FIELDS:
+        value = message.get(field)
+        if not isinstance(value, types) or\
+                (types is not bool and isinstance(value, bool)):
+            return 'bad %s' % field
+
+    if not message['active']:
+        return None
+    networks = message.get('networks')
+    if not isinstance(networks, dict) or not all(isinstance(state, dict) and
+            all(field in state for field in NETWORK_FIELDS)
+            for state in networks.values()):
+        return 'bad networks'
+    if not isinstance(message.get('nexthops'), list):
+        return 'bad nexthops'
+    return None
+
+
+class HaNode(asyncio.DatagramProtocol):
+
+    app = None
+    loop = None
+    logger = None
+
+    node_id = None
+    priority = 100
+    address = None
+    port = None
+    peer = None
+    interval = 1
+    dead_interval = 3
+    key = None
+    max_skew = 30
+
+    active = False
+    transport = None
+    sequence = 0
+    heartbeat_handle = None
+    dead_handle = None
+
+    peer_id = None
+    peer_seen = None
+    peer_state = None
+    # node id -> last sequence number taken from it
+    sequences = None
+
+    takeover_plan = None
+    takeover_table = None
+    plan_inputs = None
+    preparing = False
+    takeovers = 0
+    takeover_time = None
+    rejected = 0
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = app.loop
+        self.logger = getLogger(type(self).__name__)
+        self.node_id = os.urandom(8).hex()
+        settings = app.settings
+        self.priority = settings['ha.priority']
+        if self.priority is None:
+            self.priority = 200 if settings['ha.role'] == 'primary' else 100
+        self.address = settings['ha.address']
+        self.port = settings['ha.port']
+        self.peer = (settings['ha.peer'], settings['ha.peer_port'])
+        self.interval = settings['ha.interval']
+        self.dead_interval = settings['ha.dead_interval']
+        if settings['ha.key']:
+            self.key = settings['ha.key'].encode('utf-8')
+        self.max_skew = settings['ha.max_skew']
+        self.active = settings['ha.role'] == 'primary'
+        self.sequences = {}
+
+
+    def __call__(self):
+        return self
+
+
+    async def start(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(self,
+                local_addr=(self.address, self.port))
+        self.logger.info('HA node %s starts %s.', self.node_id,
+                'active' if self.active else 'standby')
+        if not self.active:
+            self.app.scheduler.pause()
+            # no peer at all counts as a dead one
+            self.arm_dead_timer()
+        self.heartbeat_handle = self.loop.call_soon(self.tick)
+
+
+    def close(self):
+        for handle in (self.heartbeat_handle, self.dead_handle):
+            if handle is not None:
+                handle.cancel()
+        self.heartbeat_handle = None
+        self.dead_handle = None
+        if self.transport is not None:
+            self.transport.close()
+
+
+    def local_address(self):
+        return self.transport.get_extra_info('sockname')
+
+
+    def tick(self):
+        self.heartbeat_handle = self.loop.call_later(self.interval, self.tick)
+        try:
+            self.send_heartbeat()
+            if not self.active:
+                self.maybe_prepare()
+        except Exception: # pylint:disable=broad-except
+            self.logger.exception('Heartbeat error:')
+
+
+    def send_heartbeat(self):
+        if self.transport is None or not self.peer[0]:
+            return
+        self.sequence += 1
+        message = {
+            'version': HA_VERSION,
+            'node': self.node_id,
+            'sequence': self.sequence,
+            'time': time.time(),
+            'priority': self.priority,
+            'active': self.active,
+        }
+        if self.active:
+            message.update(self.link_state())
+        self.transport.sendto(self.encode(message), self.peer)
+
+
+    def link_state(self):
+        app = self.app
+        networks = {}
+        for network in app.networks:
+            health = network.health
+            networks[network.interface_name] = {
+                'connected': network.connected,
+                'local_ip': network.local_ip,
+                'network': network.network,
+                'route': network.route,
+                'health': health.state,
+                'penalty': health.current_penalty(),
+                'suppressed': health.suppressed,
+                'weight': network.nexthop_weight,
+                'draining': network.draining,
+            }
+
+        nexthops = []
+        if app.multipath_table is not None:
+            route = multipath_route(list(app.networks), app.multipath_table)
+            if route is not None:
+                by_gateway = dict((network.route, network.interface_name)
+                        for network in app.networks if network.connected)
+                nexthops = [(by_gateway.get('via ' + gateway), weight)
+                        for gateway, weight in route.gateways]
+
+        return {
+            'networks': networks,
+            'multipath_table': app.multipath_table,
+            'nexthops': nexthops,
+        }
+
+
+    def encode(self, message):
+        body = json_dumps(message, separators=(',', ':')).encode('utf-8')
+        if self.key is None:
+            return body
+        return self.digest(body) + b' ' + body
+
+
+    def digest(self, body):
+        return hmac.new(self.key, body, hashlib.sha256).hexdigest().encode(
+                'ascii')
+
+
+    def decode(self, data):
+        if self.key is not None:
+            digest, body = data[:DIGEST_SIZE], data[DIGEST_SIZE + 1:]
+            if not hmac.compare_digest(digest, self.digest(body)):
+                return None
+            data = body
+        try:
+            message = json_loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(message, dict) or\
+                message.get('version') != HA_VERSION:
+            return None
+        return message
+
+
+    def datagram_received(self, data, addr):
+        message = self.decode(data)
+        if message is None:
+            self.rejected += 1
+            self.logger.debug('Rejected HA datagram from %s.', addr)
+            return
+        error = heartbeat_error(message)
+        if error is None and message['node'] == self.node_id:
+            return
+        if error is None:
+            error = self.freshness_error(message)
+        if error is not None:
+            self.rejected += 1
+            self.logger.info('Ignoring HA heartbeat from %s, %s.', addr[0],
+                    error)
+            return
+
+        if self.peer_id != message['node']:
+            self.logger.info('HA peer %s at %s.', message['node'], addr[0])
+            self.peer_id = message['node']
+        self.peer_seen = self.loop.time()
+
+        if message['active']:
+            self.peer_state = message
+            if self.active and self.outranked_by(message):
+                self.step_down()
+            if not self.active:
+                self.mirror(message)
+                self.arm_dead_timer()
+
+        elif not self.active:
+            # two standbys, the higher priority one goes ahead
+            if not self.outranked_by(message):
+                self.loop.create_task(self.takeover('peer is standby too'))
+
+
+    def freshness_error(self, message):
+        """ replayed heartbeats, the sequence is checked per sender """
+        node = message['node']
+        last = self.sequences.get(node)
+        if last is not None and message['sequence'] <= last:
+            return 'sequence %i after %i' % (message['sequence'], last)
+        skew = time.time() - message['time']
+        if abs(skew) > self.max_skew:
+            return 'timestamp %.0f seconds off' % skew
+
+        if last is None and len(self.sequences) >= MAX_PEERS:
+            del self.sequences[next(iter(self.sequences))]
+        self.sequences[node] = message['sequence']
+        return None
+
+
+    def outranked_by(self, message):
+        return (message['priority'], message['node']) >\
+                (self.priority, self.node_id)
+
+
+    def arm_dead_timer(self):
+        if self.dead_handle is not None:
+            self.dead_handle.cancel()
+        self.dead_handle = self.loop.call_later(self.dead_interval,
+                self.on_peer_dead)
+
+
+    def on_peer_dead(self):
+        self.dead_handle = None
+        if not self.active:
+            self.loop.create_task(self.takeover('no heartbeat for %.1f ' %
+                    self.dead_interval + 'seconds'))
+
+
+    def mirror(self, message):
+        """ link health as the active node sees it """
+        now = self.loop.time()
+        for name, state in message.get('networks', {}).items():
+            network = self.app.networks.get(name)
+            if network is None:
+                continue
+            health = network.health
+            health.state = state['health']
+            health.penalty = state['penalty']
+            health.penalty_time = now
+            health.suppressed = state['suppressed']
+            network.nexthop_weight = state['weight']
+            network.draining = state['draining']
+
+
+    def maybe_prepare(self):
+        inputs = json_dumps([self.peer_state and
+                self.peer_state.get('networks'), [network.addressing()
+                for network in self.app.networks]], sort_keys=True)
+        if inputs == self.plan_inputs or self.preparing:
+            return
+        self.plan_inputs = inputs
+        self.preparing = True
+        self.loop.create_task(self.prepare())
+
+
+    async def prepare(self):
+        """ reconcile the kernel against the mirrored state, ahead of time """
+        app = self.app
+        try:
+            peers = (self.peer_state or {}).get('networks', {})
+            for network in app.networks:
+                peer = peers.get(network.interface_name)
+                if peer is not None and peer['connected'] and\
+                        not network.connected:
+                    # the link may be up here as well, without an event yet
+                    await network.adopt()
+
+            actual = await read_state(app.commands, managed_tables(
+                    app.settings, app.networks))
+            tables = multipath_tables(app.settings)
+            table = live_multipath_table(actual, tables)
+            if table is None:
+                peer_table = (self.peer_state or {}).get('multipath_table')
+                table = peer_table if peer_table in tables else tables[0]
+
+            desired = desired_state(app.networks, table)
+            keep_pending_routes(desired, actual, app.networks)
+            batch = RouteBatch(app.commands)
+            reconcile(desired, actual, batch)
+            self.takeover_plan = batch
+            self.takeover_table = table
+            self.logger.debug('Takeover plan of %i commands ready.',
+                    len(batch))
+        except: # pylint:disable=bare-except
+            self.logger.exception('Cannot prepare the takeover plan:')
+            self.plan_inputs = None
+        finally:
+            self.preparing = False
+
+
+    async def takeover(self, reason):
+        if self.active:
+            return
+        app = self.app
+        self.active = True
+        start = self.loop.time()
+        if self.dead_handle is not None:
+            self.dead_handle.cancel()
+            self.dead_handle = None
+
+        plan = self.takeover_plan
+        self.takeover_plan = None
+        self.plan_inputs = None
+        if plan is not None and not app.is_defining_route:
+            app.is_defining_route = True
+            try:
+                await plan.apply()
+                app.multipath_table = self.takeover_table
+            except: # pylint:disable=bare-except
+                self.logger.exception('Takeover plan error:')
+            finally:
+                app.is_defining_route = False
+
+        self.takeovers += 1
+        self.takeover_time = self.loop.time() - start
+        self.logger.warning('Taking over, %s. Routes applied in %.3f ' +\
+                'seconds.', reason, self.takeover_time)
+        app.metrics.ha_takeovers.inc()
+        app.journal.record('takeover', reason=reason,
+                duration=self.takeover_time,
+                commands=0 if plan is None else plan.commands_issued)
+
+        # verify with a full reroute, then run as usual
+        app.networks_hash = None
+        app.schedule_reroute(0)
+        app.scheduler.resume()
+        for network in app.networks:
+            app.scheduler.probe_soon(network.interface_name)
+
+
+    def step_down(self):
+        self.logger.warning('Peer %s outranks this node, standing by.',
+                self.peer_id)
+        self.active = False
+        self.app.scheduler.pause()
+        self.app.plans = {}
+        self.app.journal.record('step_down', peer=self.peer_id)
+        self.arm_dead_timer()
+
+
+    def status(self):
+        peer_age = None
+        if self.peer_seen is not None:
+            peer_age = self.loop.time() - self.peer_seen
+        return {
+            'node': self.node_id,
+            'active': self.active,
+            'priority': self.priority,
+            'peer': self.peer_id,
+            'peer_age': peer_age,
+            'peer_nexthops': (self.peer_state or {}).get('nexthops'),
+            'takeover_ready': self.takeover_plan is not None,
+            'takeovers': self.takeovers,
+            'takeover_time': self.takeover_time,
+            'rejected': self.rejected,
+        }
+
+
+    def error_received(self, exc):
+        self.logger.error(str(exc))
@@ -0,0 +1,137 @@
+""" Per-link health with hysteresis, probe quorum and flap damping.
+
+    up ------ failed round ----> suspect --- fail_threshold ---> down
+    up <----- ok round --------- suspect                           |
+    degraded: quorum met, some probe failed          restart ------+
+    up <---- success_threshold ok rounds ---- recovering <---------+
+
+Every flap adds `flap_penalty`, which halves every `half_life` seconds. A
+link whose penalty exceeds `suppress` stays out of the multipath route
+until the penalty decays below `reuse`.
+"""
+
+import math
+
+UP = 'up'
+DEGRADED = 'degraded'
+SUSPECT = 'suspect'
+DOWN = 'down'
+RECOVERING = 'recovering'
+
+STATES = (UP, DEGRADED, SUSPECT, DOWN, RECOVERING)
+
+
+def quorum_of(results, quorum=None):
+    """ successes needed, default a majority of the probes """
+    if quorum is None:
+        return len(results) // 2 + 1
+    return min(int(quorum), len(results))
+
+
+def quorum_met(results, quorum=None):
+    """ True if enough probes of the round succeeded """
+    successes = len([result for result in results if result.success])
+    return bool(results) and successes >= quorum_of(results, quorum)
+
+
+class LinkHealth(object):
+
+    clock = None
+    state = UP
+    consecutive_ok = 0
+    consecutive_failed = 0
+
+    fail_threshold = 3
+    success_threshold = 2
+    flap_penalty = 1000
+    suppress = 2000
+    reuse = 750
+    half_life = 60
+
+    penalty = 0.0
+    penalty_time = 0.0
+    suppressed = False
+
+    def __init__(self, clock, settings):
+        self.clock = clock
+        self.configure(settings)
+
+
+    def configure(self, settings):
+        self.fail_threshold = settings['health.fail_threshold']
+        self.success_threshold = settings['health.success_threshold']
+        self.flap_penalty = settings['health.flap_penalty']
+        self.suppress = settings['health.suppress']
+        self.reuse = settings['health.reuse']
+        self.half_life = settings['health.half_life']
+
+
+    def current_penalty(self):
+        elapsed = self.clock() - self.penalty_time
+        return self.penalty * 0.5 ** (elapsed / self.half_life)
+
+
+    def is_suppressed(self):
+        penalty = self.current_penalty()
+        if self.suppressed and penalty < self.reuse:
+            self.suppressed = False
+        elif not self.suppressed and penalty > self.suppress:
+            self.suppressed = True
+        return self.suppressed
+
+
+    def flap(self):
+        """ returns True if this flap suppressed the link """
+        self.penalty = self.current_penalty() + self.flap_penalty
+        self.penalty_time = self.clock()
+        was_suppressed = self.suppressed
+        return self.is_suppressed() and not was_suppressed
+
+
+    def reuse_delay(self):
+        """ seconds until a suppressed link may be used again """
+        penalty = self.current_penalty()
+        if penalty <= self.reuse:
+            return 0.0
+        return self.half_life * math.log(penalty / self.reuse, 2)
+
+
+    def is_usable(self):
+        return self.state not in (DOWN, RECOVERING) and\
+                not self.is_suppressed()
+
+
+    def observe(self, results, quorum=None):
+        """ feed one round of ProbeResult, returns the new state """
+        successes = len([result for result in results if result.success])
+        if quorum_met(results, quorum):
+            self.consecutive_ok += 1
+            self.consecutive_failed = 0
+            if self.state in (DOWN, RECOVERING):
+                if self.consecutive_ok >= self.success_threshold:
+                    self.state = UP
+            else:
+                self.state = UP if successes == len(results) else DEGRADED
+        else:
+            self.consecutive_failed += 1
+            self.consecutive_ok = 0
+            if self.state == RECOVERING:
+                pass
+            elif self.consecutive_failed >= self.fail_threshold:
+                if self.state != DOWN:
+                    self.flap()
+                self.state = DOWN
+            elif self.state != DOWN:
+                self.state = SUSPECT
+
+        return self.state
+
+
+    def recovering(self):
+        self.state = RECOVERING
+        self.consecutive_ok = 0
+
+
+    def recovery_failed(self):
+        if self.state == RECOVERING:
+            self.state = DOWN
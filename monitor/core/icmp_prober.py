@@ -0,0 +1,213 @@
+""" Echo requests sent from inside the event loop, no ping(8) process. """
+
+import asyncio
+from collections import namedtuple
+from logging import getLogger
+import os
+import socket
+import struct
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+PingResult = namedtuple('PingResult', 'address sent received rtts loss ' +\
+        'rtt jitter')
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%iH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(ident, seq, payload):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    check = checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, check, ident,
+            seq) + payload
+
+
+def parse_echo_reply(data, raw):
+    """ returns (ident, seq) of an echo reply or None """
+    if raw:
+        # raw sockets see the ip header as well
+        data = data[(data[0] & 0x0f) * 4:]
+    if len(data) < 8:
+        return None
+    kind, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+    if kind != ICMP_ECHO_REPLY:
+        return None
+    return ident, seq
+
+
+def summarize(address, sent, rtts):
+    received = len(rtts)
+    if sent:
+        loss = 1 - received / sent
+    else:
+        loss = 1.0
+
+    if rtts:
+        rtt = sum(rtts) / received
+    else:
+        rtt = None
+
+    if received > 1:
+        jitter = sum(abs(rtts[ii] - rtts[ii - 1])
+                for ii in range(1, received)) / (received - 1)
+    else:
+        jitter = 0.0
+
+    return PingResult(address, sent, received, tuple(rtts), loss, rtt,
+            jitter)
+
+
+class HostResolver(object):
+    """ getaddrinfo() with a small ttl cache, test_ip is usually a name """
+
+    loop = None
+    ttl = 300
+    cache = None
+
+    def __init__(self, loop, ttl=300):
+        self.loop = loop
+        self.ttl = ttl
+        self.cache = {}
+
+
+    async def resolve(self, host):
+        try:
+            socket.inet_aton(host)
+            return host
+        except OSError:
+            pass
+
+        now = self.loop.time()
+        cached = self.cache.get(host)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        infos = await self.loop.getaddrinfo(host, None,
+                family=socket.AF_INET, type=socket.SOCK_DGRAM)
+
+        address = infos[0][4][0]
+        self.cache[host] = (address, now + self.ttl)
+        return address
+
+
+class IcmpProber(object):
+
+    loop = None
+    logger = None
+    resolver = None
+
+    raw_socket = False
+    sequence = 0
+
+    def __init__(self, loop, resolver=None):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        if resolver is None:
+            resolver = HostResolver(loop)
+        self.resolver = resolver
+
+
+    def open_socket(self, interface=None):
+        if not self.raw_socket:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                        socket.IPPROTO_ICMP)
+            except PermissionError:
+                # net.ipv4.ping_group_range does not include us
+                self.logger.debug('Unprivileged ICMP denied, using raw.')
+                self.raw_socket = True
+
+        if self.raw_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                    socket.IPPROTO_ICMP)
+
+        try:
+            if interface:
+                sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE,
+                        interface.encode('utf-8'))
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+
+        return sock
+
+
+    async def probe(self, host, interface=None, count=2, interval=1.0,
+            timeout=5.0):
+        """ send `count` echo requests, wait `timeout` after the last one """
+        address = await self.resolver.resolve(host)
+        sock = self.open_socket(interface)
+
+        raw = self.raw_socket
+        ident = os.getpid() & 0xffff
+        sent_at = {}
+        rtts = []
+        done = self.loop.create_future()
+
+        def on_readable():
+            while True:
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as exc:
+                    if not done.done():
+                        done.set_exception(exc)
+                    return
+
+                reply = parse_echo_reply(data, raw)
+                if reply is None or addr[0] != address:
+                    continue
+                # unprivileged sockets get their ident rewritten by the
+                # kernel, which already filters replies for us
+                if raw and reply[0] != ident:
+                    continue
+
+                start = sent_at.pop(reply[1], None)
+                if start is None:
+                    continue
+                rtts.append(self.loop.time() - start)
+                if len(rtts) == count and not done.done():
+                    done.set_result(None)
+
+        self.loop.add_reader(sock.fileno(), on_readable)
+        sent = 0
+        try:
+            for ii in range(count):
+                if ii:
+                    await asyncio.sleep(interval)
+                self.sequence = (self.sequence + 1) & 0xffff
+                sent_at[self.sequence] = self.loop.time()
+                try:
+                    sock.sendto(echo_request(ident, self.sequence,
+                            b'internet-monitor'), (address, 0))
+                    sent += 1
+                except OSError as exc:
+                    sent_at.pop(self.sequence)
+                    self.logger.debug('Send to %s failed: %s', address, exc)
+
+            if sent:
+                try:
+                    await asyncio.wait_for(asyncio.shield(done), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+
+        if done.done() and done.exception() is not None:
+            self.logger.debug('Receive from %s failed: %s', address,
+                    done.exception())
+
+        return summarize(address, sent, rtts)
@@ -0,0 +1,138 @@
+""" Append-only JSONL record of what the monitor saw and did.
+
+Records are queued in memory and written by the default executor every
+`journal.flush_interval` seconds, the event loop never waits on the disk.
+The file rotates at `journal.max_bytes`, keeping `journal.backups` old ones
+as journal.jsonl.1, journal.jsonl.2 and so on.
+"""
+
+from json import dumps as json_dumps, loads as json_loads
+from logging import getLogger
+import os
+import time
+
+
+def journal_files(filename, backups):
+    """ oldest first """
+    files = ['%s.%i' % (filename, ii) for ii in range(backups, 0, -1)]
+    files.append(filename)
+    return [fname for fname in files if os.path.exists(fname)]
+
+
+def read_journal(filename, backups=9):
+    """ records of the journal and its rotated files, oldest first """
+    for fname in journal_files(filename, backups):
+        with open(fname, 'r') as filehandle:
+            for line in filehandle:
+                try:
+                    yield json_loads(line)
+                except ValueError:
+                    # torn last line of a crashed run
+                    continue
+
+
+class EventJournal(object):
+
+    loop = None
+    logger = None
+    filename = None
+
+    enabled = False
+    max_bytes = 4194304
+    backups = 3
+    flush_interval = 1
+    max_pending = 10000
+
+    pending = None
+    handle = None
+    writing = None
+    size = None
+    written = 0
+    dropped = 0
+
+    def __init__(self, loop, filename, settings):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.filename = filename
+        self.enabled = settings['journal.enabled']
+        self.max_bytes = settings['journal.max_bytes']
+        self.backups = settings['journal.backups']
+        self.flush_interval = settings['journal.flush_interval']
+        self.max_pending = settings['journal.max_pending']
+        self.pending = []
+
+
+    def record(self, kind, **fields):
+        """ cheap, the record is only serialized by the writer """
+        if not self.enabled:
+            return
+        if len(self.pending) >= self.max_pending:
+            # the disk cannot keep up, losing records beats growing memory
+            self.dropped += 1
+            return
+
+        fields['t'] = time.time()
+        fields['k'] = kind
+        self.pending.append(fields)
+        if self.handle is None:
+            self.handle = self.loop.call_later(self.flush_interval,
+                    self.flush)
+
+
+    def flush(self):
+        self.handle = None
+        if not self.pending:
+            return
+        if self.writing is not None and not self.writing.done():
+            self.handle = self.loop.call_later(self.flush_interval,
+                    self.flush)
+            return
+
+        records, self.pending = self.pending, []
+        self.writing = self.loop.run_in_executor(None, self.write, records)
+
+
+    def write(self, records):
+        """ runs in the executor, one call at a time """
+        data = ''.join(json_dumps(record, separators=(',', ':'),
+                sort_keys=True, default=str) + '\n' for record in records)
+        try:
+            if self.size is None:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                try:
+                    self.size = os.path.getsize(self.filename)
+                except OSError:
+                    self.size = 0
+
+            if self.size and self.size + len(data) > self.max_bytes:
+                self.rotate()
+
+            with open(self.filename, 'a') as filehandle:
+                filehandle.write(data)
+            self.size += len(data)
+            self.written += len(records)
+        except OSError as exc:
+            self.logger.warning('Cannot write %s: %s', self.filename, exc)
+
+
+    def rotate(self):
+        if self.backups:
+            for ii in range(self.backups - 1, 0, -1):
+                older = '%s.%i' % (self.filename, ii)
+                if os.path.exists(older):
+                    os.replace(older, '%s.%i' % (self.filename, ii + 1))
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self.size = 0
+
+
+    async def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.writing is not None:
+            await self.writing
+        if self.pending:
+            records, self.pending = self.pending, []
+            await self.loop.run_in_executor(None, self.write, records)
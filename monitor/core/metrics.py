@@ -0,0 +1,305 @@
+""" Counters, gauges and histograms in the Prometheus text format. """
+
+import asyncio
+from bisect import bisect_left
+from logging import getLogger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\',
+            '\\\\').replace('"', '\\"')) for name, value in zip(names, values))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+
+    kind = None
+    name = None
+    help = None
+    labelnames = ()
+    values = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+
+    def clear(self):
+        self.values.clear()
+
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, value in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name, format_labels(
+                    self.labelnames, labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def set(self, value, *labels):
+        """ copy a count kept elsewhere """
+        self.values[labels] = value
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+    buckets = LATENCY_BUCKETS
+
+    def __init__(self, name, help_text, labelnames=(), buckets=None):
+        super().__init__(name, help_text, labelnames)
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+
+
+    def observe(self, value, *labels):
+        """ [bucket counts..., sum, count] per label set """
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * (len(self.buckets) + 2)
+
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s %s' % (self.name, self.kind)]
+        names = self.labelnames + ('le',)
+        for labels, data in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets, data):
+                total += count
+                lines.append('%s_bucket%s %i' % (self.name, format_labels(
+                        names, labels + (format_value(float(bound)),)), total))
+            lines.append('%s_bucket%s %i' % (self.name, format_labels(names,
+                    labels + ('+Inf',)), data[-1]))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(
+                    self.labelnames, labels), format_value(data[-2])))
+            lines.append('%s_count%s %i' % (self.name, format_labels(
+                    self.labelnames, labels), data[-1]))
+        return lines
+
+
+class MetricsRegistry(object):
+
+    metrics = None
+    collectors = None
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(Counter(name, help_text, labelnames))
+
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(Gauge(name, help_text, labelnames))
+
+
+    def histogram(self, name, help_text, labelnames=(), buckets=None):
+        return self.add(Histogram(name, help_text, labelnames, buckets))
+
+
+    def render(self):
+        # gauges of live state are only filled in when somebody asks
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MonitorMetrics(MetricsRegistry):
+
+    def __init__(self):
+        super().__init__()
+        self.connected = self.gauge('monitor_interface_connected',
+                'Interface has a usable default route.', ('interface',))
+        self.usable = self.gauge('monitor_interface_usable',
+                'Interface is healthy and stable enough for the multipath ' +\
+                'route.', ('interface',))
+        self.flap_penalty = self.gauge('monitor_interface_flap_penalty',
+                'Decayed flap damping penalty.', ('interface',))
+        self.health_transitions = self.counter(
+                'monitor_health_transitions_total',
+                'Link health state changes, by the new state.',
+                ('interface', 'state'))
+        self.probes = self.counter('monitor_probes_total',
+                'Probes run.', ('interface', 'kind', 'result'))
+        self.probe_latency = self.histogram('monitor_probe_latency_seconds',
+                'Latency of successful probes.', ('interface', 'kind'))
+        self.probe_next = self.gauge('monitor_probe_next_seconds',
+                'Seconds until the next probe of the interface.',
+                ('interface',))
+        self.probe_budget = self.gauge('monitor_probe_budget_remaining',
+                'Probe rounds left in the current budget window.')
+        self.reroutes = self.counter('monitor_reroutes_total',
+                'Reroutes run.', ('result',))
+        self.reroute_duration = self.histogram(
+                'monitor_reroute_duration_seconds',
+                'Time spent in a reroute.', buckets=DURATION_BUCKETS)
+        self.reroute_commands = self.histogram('monitor_reroute_commands',
+                'Commands issued per reroute.', buckets=COUNT_BUCKETS)
+        self.failover_plans = self.counter('monitor_failover_plans_total',
+                'Disconnects handled by a precomputed plan, or not.',
+                ('result',))
+        self.flows_dropped = self.counter('monitor_conntrack_dropped_total',
+                'Conntrack entries dropped with the address of a lost link.')
+        self.flows_preserved = self.gauge('monitor_conntrack_preserved',
+                'Conntrack entries left after the last flush.')
+        self.reloads = self.counter('monitor_config_reloads_total',
+                'Configuration reloads.', ('result',))
+        self.ha_active = self.gauge('monitor_ha_active',
+                'This node of the HA pair routes.')
+        self.ha_takeovers = self.counter('monitor_ha_takeovers_total',
+                'Takeovers from the HA peer.')
+        self.weight_updates = self.counter('monitor_weight_updates_total',
+                'Multipath route replaced for new nexthop weights.')
+        self.recovery_actions = self.counter('monitor_recovery_actions_total',
+                'Recovery actions run.', ('interface', 'action', 'result'))
+        self.recovery_duration = self.histogram(
+                'monitor_recovery_duration_seconds',
+                'Time spent recovering an interface.', ('interface',),
+                DURATION_BUCKETS)
+        self.syslog = self.counter('monitor_syslog_datagrams_total',
+                'Syslog datagrams by outcome.', ('outcome',))
+        self.events = self.counter('monitor_events_total',
+                'Link events by outcome.', ('outcome',))
+        self.queue_depth = self.gauge('monitor_event_queue_depth',
+                'Link events waiting to be handled.')
+        self.loop_lag = self.gauge('monitor_event_loop_lag_seconds',
+                'How late the last event loop lag probe ran.')
+        self.loop_lag_histogram = self.histogram(
+                'monitor_event_loop_lag_histogram_seconds',
+                'How late event loop lag probes ran.')
+
+
+class LoopLagMonitor(object):
+    """ schedules itself every `interval` and records how late it ran """
+
+    loop = None
+    logger = None
+    interval = 1.0
+    # log stalls longer than this many seconds, 0 for never
+    threshold = 0
+    metrics = None
+    handle = None
+    expected = None
+    last_lag = 0.0
+    stalls = 0
+
+    def __init__(self, loop, metrics, interval=1.0, threshold=0):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+
+
+    def start(self):
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(self.expected, self._tick)
+
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+    def _tick(self):
+        now = self.loop.time()
+        self.last_lag = max(now - self.expected, 0.0)
+        self.metrics.loop_lag.set(self.last_lag)
+        self.metrics.loop_lag_histogram.observe(self.last_lag)
+        if self.threshold and self.last_lag > self.threshold:
+            self.stalls += 1
+            self.logger.warning('Event loop stalled for %.3f seconds.',
+                    self.last_lag)
+        self.expected = now + self.interval
+        self.handle = self.loop.call_at(self.expected, self._tick)
+
+
+class MetricsServer(object):
+    """ bare HTTP/1.0 responder for GET /metrics """
+
+    registry = None
+    logger = None
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.logger = getLogger(type(self).__name__)
+
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # skip the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            parts = request.decode('latin-1').split(' ')
+            if len(parts) >= 2 and parts[0] == 'GET' and\
+                    parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = self.registry.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+
+            writer.write(('HTTP/1.0 %s\r\n' % status +\
+                    'Content-Type: text/plain; version=0.0.4\r\n' +\
+                    'Content-Length: %i\r\n\r\n' % len(body)).encode(
+                    'latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as exc:
+            self.logger.debug('Metrics request failed: %r', exc)
+        finally:
+            writer.close()
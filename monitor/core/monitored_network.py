@@ -1,10 +1,11 @@
-import asyncio
 from copy import copy
 from datetime import datetime
+import ipaddress
 from logging import getLogger
 import re
 
 from misc.configuration import flatten_dict
+from .health import DEGRADED, DOWN, LinkHealth, UP
 
 DEFAULT_SETTINGS = {
     'active': True,
@@ -12,17 +13,27 @@ DEFAULT_SETTINGS = {
     'has_reconnect_thread': False,
     'weight': 1,
     'network_type': 'dhcp',
-    'num_of_tests': 5,
+    'probe_count': 2,
+    'probe_timeout': 5,
+    # list of {'type': 'icmp'|'tcp'|'dns'|'http', ...}, default is icmp to
+    # test_ip
+    'probes': None,
+    # link speed in Mbit/s, enables saturation detection
+    'capacity': None,
+    # recovery actions tried in order, default is recovery.ladder
+    'recovery': None,
+    # probes that must succeed for a round to count, default a majority
+    'quorum': None,
 }
 
-PING_SUCCESS_RE = re.compile(r'(?P<max>\d+)\s+packets\s+transmitted,\s+' +\
-        r'(?P<count>\d+)\s+received')
+DEFROUTE_RE = re.compile(r'^default\s.*?(?P<route>via \d+\.\d+\.\d+\.\d+)')
 
-DEFROUTE_RE = re.compile(r'^default\s+(?P<route>via \d+\.\d+\.\d+\.\d+)\s+' +\
-        r'src\s+(?P<local_ip>\d+\.\d+\.\d+\.\d+)')
+SRC_RE = re.compile(r'\ssrc\s+(?P<local_ip>\d+\.\d+\.\d+\.\d+)')
 
 NETWORK_RE = re.compile(r'^(?P<network>\d+\.\d+\.\d+\.\d+/\d+)')
 
+INET_RE = re.compile(r'^inet\s+(?P<address>\d+\.\d+\.\d+\.\d+/\d+)')
+
 
 class MonitoredNetwork(object):
 
@@ -31,61 +42,119 @@ class MonitoredNetwork(object):
     settings = None
     logger = None
 
+    table_id = None
     connected = False
     local_ip = None
     network = None
     route = None
 
-    ping_count = 0
+    probe_results = None
+    nexthop_weight = None
     last_restart = datetime.now()
     last_disconnect = None
+    recovering = False
+    # no new flows, see Application.drain
+    draining = False
+    health = None
 
     def __init__(self, app, name, user_settings):
         self.app = app
         self.interface_name = name
         self.logger = getLogger(type(self).__name__)
+        self.health = LinkHealth(app.loop.time, app.settings)
+        self.configure(user_settings)
+
 
+    def configure(self, user_settings):
         settings = copy(DEFAULT_SETTINGS)
         settings.update(user_settings)
         self.settings = dict(flatten_dict(None, settings))
 
 
-    async def on_connect(self):
+    async def on_connect(self, details=None):
         self.last_disconnect = None
         self.logger.info('Interface %s is connected.', self.interface_name)
 
-        process = await asyncio.create_subprocess_exec(
-                'ip', 'route', 'list', 'dev', self.interface_name,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-
-        out, _ = await process.communicate()
-        out = out.decode('utf-8')
-        lines = [line.strip() for line in out.splitlines()]
-        if len(lines) < 2:
-            self.logger.debug('Not connected, no default route.')
+        if details is not None:
+            # the event source already told us the addressing
+            self.route = details['route']
+            self.local_ip = details['local_ip']
+            self.network = details['network']
+            self.connected = True
             return
 
-        match = DEFROUTE_RE.search(lines[0])
-        if match is None:
-            self.logger.debug('Regex default route does not match.')
-            return
+        await self.read_addressing()
+
+
+    async def adopt(self):
+        """ warm start, take the addressing the kernel has right now """
+        await self.read_addressing()
+        self.logger.info('Interface %s adopted, %s.', self.interface_name,
+                'connected' if self.connected else 'not connected')
 
-        self.route = match.group('route')
-        self.local_ip = match.group('local_ip')
 
-        match = NETWORK_RE.search(lines[1])
-        if match is None:
-            self.logger.debug('Regex network does not match.')
+    async def read_lines(self, *args):
+        result = await self.app.commands.run(*args)
+        return [line.strip() for line in result.stdout.splitlines()]
+
+
+    async def read_addressing(self):
+        lines = await self.read_lines('ip', 'route', 'list', 'dev',
+                self.interface_name)
+        default = next((line for line in lines
+                if DEFROUTE_RE.search(line)), None)
+        network = next((match.group('network') for match in
+                (NETWORK_RE.search(line) for line in lines) if match), None)
+
+        if default is None and self.table_id is not None:
+            # the reconciler removes default routes from main, after a
+            # reroute the gateway is only in our own table
+            lines = await self.read_lines('ip', 'route', 'show', 'table',
+                    str(self.table_id))
+            default = next((line for line in lines
+                    if DEFROUTE_RE.search(line)), None)
+
+        if default is None:
+            self.logger.debug('Not connected, no default route.')
             return
 
-        self.network = match.group('network')
+        route = DEFROUTE_RE.search(default).group('route')
+        match = SRC_RE.search(default)
+        local_ip = match.group('local_ip') if match else None
+
+        if local_ip is None or network is None:
+            lines = await self.read_lines('ip', '-4', 'addr', 'show', 'dev',
+                    self.interface_name)
+            match = next((match for match in
+                    (INET_RE.search(line) for line in lines) if match), None)
+            if match is None:
+                self.logger.debug('Not connected, no address.')
+                return
+            address = ipaddress.ip_interface(match.group('address'))
+            local_ip = local_ip or str(address.ip)
+            network = network or str(address.network)
+
+        self.route = route
+        self.local_ip = local_ip
+        self.network = network
         self.connected = True
 
 
+    def addressing(self):
+        return (self.connected, self.local_ip, self.network, self.route)
+
+
+    def is_usable(self):
+        """ fit for the multipath route """
+        return self.connected and not self.draining and\
+                self.health.is_usable()
+
+
     async def on_disconnect(self):
         self.last_disconnect = datetime.now()
         self.logger.info('Interface %s is disconnected.', self.interface_name)
+        if self.connected and self.health.flap():
+            self.app.on_suppressed(self)
         self.connected = False
         self.local_ip = None
         self.network = None
@@ -93,58 +162,60 @@ class MonitoredNetwork(object):
 
 
     async def restart(self):
+        """ climb the recovery ladder, cheapest action first """
+        if self.recovering:
+            return
+        self.recovering = True
         self.last_restart = datetime.now()
         self.last_disconnect = None
-        await asyncio.sleep(5)
-        self.logger.info('Restart %s interface...', self.interface_name)
-        process = await asyncio.create_subprocess_exec(
-                '/etc/init.d/net.%s' % self.interface_name, 'restart',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-
-        await process.wait()
-        self.last_restart = datetime.now()
-        self.logger.info('Restart completed.')
-        self.app.loop.create_task(self.ping())
+        self.health.recovering()
+        recovered = False
+        try:
+            async with self.app.restart_semaphore:
+                recovered = await self.app.recovery.recover(self)
+        finally:
+            self.recovering = False
+            if not recovered:
+                self.health.recovery_failed()
+            self.app.journal.record('restart', name=self.interface_name,
+                    recovered=recovered)
 
-
-    async def ping(self):
-        if self.ping_count:
-            self.ping_count = self.settings['num_of_tests']
-            return
-
-        self.ping_count = self.settings['num_of_tests']
-        while self.ping_count > 0 and self.app.is_active:
-            await asyncio.sleep((1 / self.ping_count) * 300)
-            if self.app.is_defining_route or self.app.reroute_timestamp:
-                self.ping_count = 0
-                return
-
-            self.logger.info('Ping with %s interface...', self.interface_name)
-
-            process = await asyncio.create_subprocess_exec(
-                    'ping', '-qn', '-I', self.interface_name, '-c2', '-W5',
-                    '-w15', self.settings['test_ip'],
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE)
-
-            out, err = await process.communicate()
-            out = out.decode('utf-8')
-            match = PING_SUCCESS_RE.search(out)
-            success = len(err) == 0 and match is not None and \
-                    int(match.group('max')) and int(match.group('count'))
-
-            if success:
-                self.ping_count -= 1
-                self.logger.info('Ping success.')
-            else:
-                self.ping_count = 0
-                self.logger.error('Ping failed with %s.', out)
-                delta_restart = (datetime.now() - self.last_restart).seconds
-                if self.last_disconnect is not None:
-                    delta_disconn = (datetime.now() - self.last_disconnect).seconds
-                else:
-                    delta_disconn = 61
-
-                if delta_restart > 60 and delta_disconn > 60:
-                    self.app.loop.create_task(self.restart())
+        self.last_restart = datetime.now()
+        self.app.scheduler.probe_soon(self.interface_name)
+
+
+    async def check(self):
+        """ one round of probes, True if the link is up or degraded """
+        self.logger.info('Ping with %s interface...', self.interface_name)
+
+        results = await self.app.probe_engine.run(self)
+        self.probe_results = results
+        self.app.on_probe_results(self, results)
+
+        previous = self.health.state
+        was_usable = self.is_usable()
+        state = self.health.observe(results, self.settings['quorum'])
+        if state != previous:
+            self.app.on_health_changed(self, previous, was_usable)
+
+        if state in (UP, DEGRADED):
+            self.logger.info('Ping success, %s.', ', '.join(
+                    '%s %s' % (result.kind, 'ok' if result.success
+                    else 'failed') for result in results))
+            return True
+
+        self.logger.error('Ping failed with %r, link is %s.', results, state)
+        if state != DOWN:
+            # not yet, a few more rounds first
+            return False
+
+        delta_restart = (datetime.now() - self.last_restart).seconds
+        if self.last_disconnect is not None:
+            delta_disconn = (datetime.now() - self.last_disconnect).seconds
+        else:
+            delta_disconn = 61
+
+        if delta_restart > 60 and delta_disconn > 60 and\
+                not self.app.is_standby():
+            self.app.loop.create_task(self.restart())
+        return False
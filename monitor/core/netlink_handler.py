@@ -0,0 +1,263 @@
+""" Link, address and route events straight from the kernel (rtnetlink). """
+
+import asyncio
+from datetime import datetime
+from ipaddress import ip_interface
+from logging import getLogger
+import socket
+import struct
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+NLMSG_HEADER = struct.Struct('=IHHII')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTMSG = struct.Struct('=BBBBBBBBI')
+RTATTR = struct.Struct('=HH')
+
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PREFSRC = 7
+RTA_TABLE = 15
+
+IFF_LOWER_UP = 0x10000
+RT_TABLE_MAIN = 254
+
+
+def align(length):
+    return (length + 3) & ~3
+
+
+def parse_attributes(data, offset, end):
+    attrs = {}
+    while offset + RTATTR.size <= end:
+        length, kind = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[kind] = data[offset + RTATTR.size:offset + length]
+        offset += align(length)
+    return attrs
+
+
+def parse_messages(data):
+    """ parse a netlink datagram into a list of event dicts
+
+    Pure function, a recorded dump can be fed back in to test the parser.
+    """
+    events = []
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if length < NLMSG_HEADER.size:
+            break
+
+        body = offset + NLMSG_HEADER.size
+        end = offset + length
+        offset += align(length)
+
+        if kind in (RTM_NEWLINK, RTM_DELLINK):
+            _, _, index, flags, _ = IFINFOMSG.unpack_from(data, body)
+            attrs = parse_attributes(data, body + IFINFOMSG.size, end)
+            name = attrs.get(IFLA_IFNAME, b'').rstrip(b'\0').decode()
+            events.append({
+                'type': 'link',
+                'index': index,
+                'name': name,
+                'up': kind == RTM_NEWLINK and bool(flags & IFF_LOWER_UP),
+            })
+
+        elif kind in (RTM_NEWADDR, RTM_DELADDR):
+            family, prefixlen, _, _, index = IFADDRMSG.unpack_from(data, body)
+            if family != socket.AF_INET:
+                continue
+            attrs = parse_attributes(data, body + IFADDRMSG.size, end)
+            address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            events.append({
+                'type': 'addr',
+                'index': index,
+                'name': attrs.get(IFA_LABEL, b'').rstrip(b'\0').decode(),
+                'address': socket.inet_ntoa(address) if address else None,
+                'prefixlen': prefixlen,
+                'added': kind == RTM_NEWADDR,
+            })
+
+        elif kind in (RTM_NEWROUTE, RTM_DELROUTE):
+            family, dst_len, _, _, table, _, _, _, _ =\
+                    RTMSG.unpack_from(data, body)
+            if family != socket.AF_INET:
+                continue
+            attrs = parse_attributes(data, body + RTMSG.size, end)
+            if RTA_TABLE in attrs:
+                table = struct.unpack('=I', attrs[RTA_TABLE])[0]
+            gateway = attrs.get(RTA_GATEWAY)
+            prefsrc = attrs.get(RTA_PREFSRC)
+            oif = attrs.get(RTA_OIF)
+            events.append({
+                'type': 'route',
+                'index': struct.unpack('=i', oif)[0] if oif else None,
+                'table': table,
+                'default': dst_len == 0,
+                'gateway': socket.inet_ntoa(gateway) if gateway else None,
+                'prefsrc': socket.inet_ntoa(prefsrc) if prefsrc else None,
+                'added': kind == RTM_NEWROUTE,
+            })
+
+    return events
+
+
+def open_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_ROUTE)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        sock.setblocking(False)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+class NetlinkHandler(asyncio.DatagramProtocol):
+
+    app = None
+    logger = None
+
+    names = None
+    addresses = None
+    gateways = None
+    links_up = None
+
+
+    def connection_made(self, transport):
+        self.logger.debug('Connection made.')
+        self.app.loop.create_task(self.app.start_monitoring())
+
+
+    def datagram_received(self, data, addr):
+        """ received data from rtnetlink """
+        timestamp = datetime.now()
+        for event in parse_messages(data):
+            handler = getattr(self, 'on_' + event['type'])
+            handler(event, timestamp)
+
+
+    def interface_name(self, event):
+        name = event.get('name')
+        if name:
+            self.names[event['index']] = name
+            return name
+
+        name = self.names.get(event['index'])
+        if name is None and event['index']:
+            try:
+                name = socket.if_indextoname(event['index'])
+            except OSError:
+                return None
+            self.names[event['index']] = name
+        return name
+
+
+    def details(self, name):
+        address = self.addresses.get(name)
+        gateway = self.gateways.get(name)
+        if address is None or gateway is None:
+            return None
+
+        return {
+            'local_ip': address[0],
+            'network': str(ip_interface('%s/%i' % address).network),
+            'route': 'via ' + gateway,
+        }
+
+
+    def push_event(self, active, name, timestamp, details=None):
+        self.app.push_event(active, name, timestamp, details,
+                ('netlink', None))
+
+
+    def on_link(self, event, timestamp):
+        name = self.interface_name(event)
+        if not name:
+            return
+
+        # RTM_NEWLINK comes for any attribute change, only report
+        # transitions, or the first state seen
+        if self.links_up.get(name) == event['up']:
+            return
+
+        self.links_up[name] = event['up']
+        if event['up']:
+            # probably interface with static ip was connected
+            self.push_event(True, name, timestamp, self.details(name))
+
+        else:
+            self.addresses.pop(name, None)
+            self.gateways.pop(name, None)
+            self.push_event(False, name, timestamp)
+
+
+    def on_addr(self, event, timestamp):
+        name = self.interface_name(event)
+        if not name or not event['address']:
+            return
+
+        if event['added']:
+            self.addresses[name] = (event['address'], event['prefixlen'])
+            details = self.details(name)
+            if details is not None:
+                self.push_event(True, name, timestamp, details)
+
+        elif self.addresses.get(name, (event['address'],))[0] ==\
+                event['address']:
+            self.addresses.pop(name, None)
+            self.push_event(False, name, timestamp)
+
+
+    def on_route(self, event, timestamp):
+        # the monitor removes default routes from main itself, only the
+        # additions by dhcpcd and friends are interesting
+        if event['table'] != RT_TABLE_MAIN or not event['default'] or\
+                not event['added'] or not event['gateway']:
+            return
+
+        name = self.interface_name(event)
+        if not name:
+            return
+
+        self.gateways[name] = event['gateway']
+        if event['prefsrc'] and name not in self.addresses:
+            self.addresses[name] = (event['prefsrc'], 32)
+
+        self.push_event(True, name, timestamp, self.details(name))
+
+
+    def __init__(self, app):
+        self.app = app
+        self.logger = getLogger(__name__)
+        self.names = {}
+        self.addresses = {}
+        self.gateways = {}
+        self.links_up = {}
+
+
+    def __call__(self):
+        return self
+
+
+    def error_received(self, exc):
+        """ socket error handler, ENOBUFS when we fell behind """
+        self.logger.error(str(exc))
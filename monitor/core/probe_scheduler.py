@@ -0,0 +1,276 @@
+""" One timer drives the probes of every network.
+
+Due probes sit in a heap, a single `call_at` handle waits for the earliest
+one and everything due within `probe.coalesce` seconds of it starts in the
+same wakeup. Nothing sleeps per network between probes.
+"""
+
+import heapq
+from logging import getLogger
+import random
+
+HEALTHY = 'healthy'
+SUSPECT = 'suspect'
+RECOVERING = 'recovering'
+
+
+class ProbeSlot(object):
+
+    name = None
+    state = HEALTHY
+    failures = 0
+    interval = None
+    due = None
+    running = False
+    probes = 0
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+
+
+class ProbeScheduler(object):
+    """ `check(name)` is a coroutine returning True if the network is fine,
+    False if not and None if it could not be probed right now
+    """
+
+    loop = None
+    logger = None
+    check = None
+    random = None
+
+    interval = 60
+    jitter = 0.1
+    suspect_interval = 5
+    suspect_probes = 3
+    max_backoff = 600
+    coalesce = 0.5
+    budget = 120
+    budget_window = 60
+
+    slots = None
+    heap = None
+    sequence = 0
+    handle = None
+    handle_due = None
+    # nothing is probed while paused, due probes run on resume
+    paused = False
+
+    window_start = None
+    window_used = 0
+    deferred = 0
+
+    def __init__(self, loop, settings, check):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.check = check
+        self.random = random.Random()
+        self.slots = {}
+        self.heap = []
+        self.configure(settings)
+
+
+    def configure(self, settings):
+        """ new cadence applies from the next probe of each network """
+        self.interval = settings['probe.interval']
+        self.jitter = settings['probe.jitter']
+        self.suspect_interval = settings['probe.suspect_interval']
+        self.suspect_probes = settings['probe.suspect_probes']
+        self.max_backoff = settings['probe.max_backoff']
+        self.coalesce = settings['probe.coalesce']
+        self.budget = settings['probe.budget']
+        self.budget_window = settings['probe.budget_window']
+
+
+    def add(self, name):
+        if name in self.slots:
+            return
+        slot = self.slots[name] = ProbeSlot(name, self.interval)
+        # spread the first round over one interval
+        self.schedule(slot, self.loop.time() + self.random.uniform(0,
+                self.interval))
+
+
+    def remove(self, name):
+        """ its heap entry goes stale and is skipped """
+        self.slots.pop(name, None)
+
+
+    def probe_soon(self, name, delay=None):
+        """ probe within `delay` seconds, default the suspect interval """
+        slot = self.slots.get(name)
+        if slot is None or slot.running:
+            return
+        if delay is None:
+            delay = self.suspect_interval
+        due = self.loop.time() + self.jittered(delay)
+        if slot.due is None or due < slot.due:
+            self.schedule(slot, due)
+
+
+    def jittered(self, interval):
+        return interval * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+
+    def schedule(self, slot, due):
+        slot.due = due
+        self.sequence += 1
+        heapq.heappush(self.heap, (due, self.sequence, slot.name))
+        self.arm()
+
+
+    def is_stale(self, entry):
+        slot = self.slots.get(entry[2])
+        return slot is None or slot.running or slot.due != entry[0]
+
+
+    def pause(self):
+        self.paused = True
+        self.stop()
+
+
+    def resume(self):
+        self.paused = False
+        self.arm()
+
+
+    def arm(self):
+        if self.paused:
+            return
+        while self.heap and self.is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            self.stop()
+            return
+
+        due = self.heap[0][0]
+        if self.handle is not None:
+            if self.handle_due <= due:
+                return
+            self.handle.cancel()
+
+        self.handle_due = due
+        self.handle = self.loop.call_at(due, self.wake)
+
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            self.handle_due = None
+
+
+    def wake(self):
+        self.handle = None
+        self.handle_due = None
+
+        now = self.loop.time()
+        horizon = now + self.coalesce
+        deferred = []
+        while self.heap and self.heap[0][0] <= horizon:
+            entry = heapq.heappop(self.heap)
+            if self.is_stale(entry):
+                continue
+
+            slot = self.slots[entry[2]]
+            if not self.take_budget(now):
+                # pushed after the loop, the window may end within the
+                # horizon and the slot would be popped again right away
+                deferred.append(slot)
+                continue
+
+            slot.running = True
+            slot.due = None
+            self.loop.create_task(self.run(slot))
+
+        for slot in deferred:
+            self.deferred += 1
+            self.schedule(slot, self.window_start + self.budget_window)
+
+        self.arm()
+
+
+    def take_budget(self, now):
+        if self.window_start is None or\
+                now >= self.window_start + self.budget_window:
+            self.window_start = now
+            self.window_used = 0
+
+        if self.window_used >= self.budget:
+            return False
+        self.window_used += 1
+        return True
+
+
+    async def run(self, slot):
+        try:
+            result = await self.check(slot.name)
+        except: # pylint:disable=bare-except
+            self.logger.exception('Probe of %s failed:', slot.name)
+            result = False
+        finally:
+            slot.running = False
+
+        if self.slots.get(slot.name) is not slot:
+            return
+
+        if result is None:
+            # busy rerouting, come back soon
+            interval = self.suspect_interval
+        else:
+            slot.probes += 1
+            interval = self.next_interval(slot, result)
+
+        self.schedule(slot, self.loop.time() + self.jittered(interval))
+
+
+    def next_interval(self, slot, success):
+        if success:
+            slot.state = HEALTHY
+            slot.failures = 0
+            slot.interval = self.interval
+
+        else:
+            slot.failures += 1
+            if slot.failures <= self.suspect_probes:
+                slot.state = SUSPECT
+                slot.interval = self.suspect_interval
+            else:
+                # give a restarted link time, and do not hammer a dead one
+                slot.state = RECOVERING
+                slot.interval = min(self.max_backoff, self.suspect_interval *
+                        2 ** (slot.failures - self.suspect_probes))
+
+        return slot.interval
+
+
+    def status(self):
+        now = self.loop.time()
+        networks = {}
+        for name, slot in self.slots.items():
+            networks[name] = {
+                'state': slot.state,
+                'failures': slot.failures,
+                'interval': slot.interval,
+                'probes': slot.probes,
+                'running': slot.running,
+                'next_probe': None if slot.due is None else
+                        max(slot.due - now, 0.0),
+            }
+
+        if self.window_start is None or\
+                now >= self.window_start + self.budget_window:
+            used = 0
+        else:
+            used = self.window_used
+
+        return {
+            'networks': networks,
+            'budget': {
+                'limit': self.budget,
+                'window': self.budget_window,
+                'remaining': self.budget - used,
+                'deferred': self.deferred,
+            },
+        }
@@ -0,0 +1,191 @@
+""" Health probes of several protocols, run concurrently per network. """
+
+import asyncio
+from collections import namedtuple
+from logging import getLogger
+import random
+import socket
+import struct
+from urllib.parse import urlsplit
+
+ProbeResult = namedtuple('ProbeResult', 'kind target success latency loss ' +\
+        'jitter error')
+
+
+def dns_query(ident, name):
+    """ minimal A record query with recursion desired """
+    header = struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0)
+    question = b''.join(struct.pack('!B', len(label)) + label
+            for label in name.encode('idna').split(b'.') if label)
+
+    return header + question + b'\0' + struct.pack('!HH', 1, 1)
+
+
+def host_header(url):
+    """ Host of a split url, without the userinfo netloc may carry """
+    host = url.hostname
+    if ':' in host:
+        host = '[%s]' % host
+    if url.port is not None:
+        host += ':%i' % url.port
+    return host
+
+
+def bound_socket(kind, local_ip):
+    sock = socket.socket(socket.AF_INET, kind)
+    try:
+        sock.setblocking(False)
+        if local_ip:
+            sock.bind((local_ip, 0))
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+class ProbeEngine(object):
+
+    loop = None
+    logger = None
+    prober = None
+    semaphore = None
+
+    def __init__(self, loop, prober, concurrency=16):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.prober = prober
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+
+    def probe_specs(self, network):
+        specs = network.settings.get('probes')
+        if not specs:
+            specs = [{'type': 'icmp', 'host': network.settings['test_ip']}]
+        return specs
+
+
+    async def run(self, network):
+        """ run every probe of the network, returns list of ProbeResult """
+        tasks = [self.run_probe(network, spec)
+                for spec in self.probe_specs(network)]
+
+        return await asyncio.gather(*tasks)
+
+
+    async def run_probe(self, network, spec):
+        kind = spec.get('type', 'icmp')
+        timeout = spec.get('timeout', network.settings['probe_timeout'])
+        handler = getattr(self, 'probe_' + kind, None)
+        if handler is None:
+            return ProbeResult(kind, None, False, None, 1.0, None,
+                    'unknown probe type')
+
+        async with self.semaphore:
+            start = self.loop.time()
+            try:
+                return await handler(network, spec, timeout)
+            except (OSError, asyncio.TimeoutError, ValueError) as exc:
+                self.logger.debug('Probe %s of %s failed: %r', kind,
+                        network.interface_name, exc)
+
+                return ProbeResult(kind, self.target(spec), False,
+                        self.loop.time() - start, 1.0, None,
+                        str(exc) or type(exc).__name__)
+
+
+    def target(self, spec):
+        if 'url' in spec:
+            return spec['url']
+        if 'port' in spec:
+            return '%s:%s' % (spec.get('host'), spec['port'])
+        return spec.get('host') or spec.get('name')
+
+
+    async def probe_icmp(self, network, spec, timeout):
+        result = await self.prober.probe(spec['host'], network.interface_name,
+                count=spec.get('count', network.settings['probe_count']),
+                timeout=timeout)
+
+        return ProbeResult('icmp', spec['host'], result.received > 0,
+                result.rtt, result.loss, result.jitter, None)
+
+
+    async def probe_tcp(self, network, spec, timeout):
+        address = await self.prober.resolver.resolve(spec['host'])
+        sock = bound_socket(socket.SOCK_STREAM, network.local_ip)
+        try:
+            start = self.loop.time()
+            await asyncio.wait_for(self.loop.sock_connect(sock,
+                    (address, int(spec['port']))), timeout)
+
+            latency = self.loop.time() - start
+        finally:
+            sock.close()
+
+        return ProbeResult('tcp', self.target(spec), True, latency, 0.0, None,
+                None)
+
+
+    async def probe_dns(self, network, spec, timeout):
+        server = await self.prober.resolver.resolve(spec.get('server',
+                '8.8.8.8'))
+
+        name = spec.get('name', 'google.com')
+        ident = random.randint(0, 0xffff)
+
+        sock = bound_socket(socket.SOCK_DGRAM, network.local_ip)
+        try:
+            await self.loop.sock_connect(sock, (server,
+                    int(spec.get('port', 53))))
+
+            start = self.loop.time()
+            await self.loop.sock_sendall(sock, dns_query(ident, name))
+            data = await asyncio.wait_for(self.loop.sock_recv(sock, 512),
+                    timeout)
+
+            latency = self.loop.time() - start
+        finally:
+            sock.close()
+
+        if len(data) < 12:
+            raise ValueError('short dns reply')
+        reply_ident, flags = struct.unpack('!HH', data[:4])
+        success = reply_ident == ident and flags & 0x8000 and\
+                not flags & 0x000f
+
+        return ProbeResult('dns', name, bool(success), latency, 0.0, None,
+                None if success else 'rcode %i' % (flags & 0x000f))
+
+
+    async def probe_http(self, network, spec, timeout):
+        url = urlsplit(spec['url'])
+        secure = url.scheme == 'https'
+        port = url.port or (443 if secure else 80)
+        address = await self.prober.resolver.resolve(url.hostname)
+        local_addr = (network.local_ip, 0) if network.local_ip else None
+
+        start = self.loop.time()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                address, port, ssl=secure or None, local_addr=local_addr,
+                server_hostname=url.hostname if secure else None), timeout)
+
+        try:
+            request = ('HEAD %s HTTP/1.0\r\nHost: %s\r\n' +\
+                    'User-Agent: internet-monitor\r\n\r\n') % (
+                    url.path or '/', host_header(url))
+
+            writer.write(request.encode('latin-1'))
+
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            latency = self.loop.time() - start
+        finally:
+            writer.close()
+
+        parts = line.decode('latin-1').split(' ')
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ValueError('not a http response')
+
+        # anything but a server error proves the path works
+        status = int(parts[1])
+        return ProbeResult('http', spec['url'], status < 500, latency, 0.0,
+                None, None if status < 500 else 'status %i' % status)
@@ -0,0 +1,158 @@
+""" Logging setup and on-demand profiling of a running monitor.
+
+SIGUSR1 starts cProfile, the next SIGUSR1 stops it and writes the stats,
+SIGUSR2 does the same with tracemalloc. Files go to `profile.dir`, by
+default the state directory, and read back with the pstats browser:
+
+    python -m pstats cpu-....pstats
+    % sort cumtime
+    % stats 30
+"""
+
+import cProfile
+from logging import Formatter, getLevelName, getLogger, INFO
+from logging import StreamHandler
+import os
+import time
+import tracemalloc
+
+# per command and per batch debug lines, formatting them costs more than
+# the work itself on big tables
+HOT_PATH_LOGGERS = (
+    'CommandBackend',
+    'RouteBatch',
+    'WeightEngine',
+    'core.reconciler',
+)
+
+
+class MonitorHandler(StreamHandler):
+    """ the handler configure_logging owns, replaced on reload """
+
+
+def logging_configured():
+    return any(isinstance(handler, MonitorHandler)
+            for handler in getLogger().handlers)
+
+
+def configure_logging(settings):
+    root = getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, MonitorHandler):
+            root.removeHandler(handler)
+
+    handler = MonitorHandler()
+    handler.setFormatter(Formatter(settings['logging.format']))
+    root.addHandler(handler)
+    root.setLevel(settings['logging.level'])
+
+    levels = dict(settings['logging.levels'] or {})
+    for name in HOT_PATH_LOGGERS:
+        if settings['logging.hot_path_debug']:
+            levels.setdefault(name, None)
+        else:
+            # never below INFO, whatever the root level
+            levels.setdefault(name, max(INFO, root.level))
+    for name, level in levels.items():
+        getLogger(name).setLevel(0 if level is None else level)
+
+
+def is_level(value):
+    return isinstance(value, int) or isinstance(getLevelName(value), int)
+
+
+class Profiler(object):
+
+    loop = None
+    logger = None
+    directory = None
+    frames = 10
+
+    cpu = None
+    cpu_start = None
+    memory_start = None
+    # loop debug mode was turned on here, not by PYTHONASYNCIODEBUG
+    debug_mode = False
+
+    def __init__(self, loop, directory, settings):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.directory = directory
+        self.configure(settings)
+
+
+    def configure(self, settings):
+        self.frames = settings['profile.tracemalloc_frames']
+        if settings['profile.dir']:
+            self.directory = settings['profile.dir']
+
+        slow = settings['profile.slow_callback']
+        # asyncio logs callbacks slower than this, debug mode costs some
+        # speed, so only while asked for
+        if slow:
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = slow
+            self.debug_mode = True
+        elif self.debug_mode:
+            self.loop.set_debug(False)
+            self.debug_mode = False
+
+
+    def filename(self, prefix, ext):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '%s-%s.%s' % (prefix,
+                time.strftime('%Y%m%d-%H%M%S'), ext))
+
+
+    def toggle_cpu(self):
+        """ SIGUSR1 """
+        if self.cpu is None:
+            self.cpu = cProfile.Profile()
+            self.cpu_start = time.time()
+            self.cpu.enable()
+            self.logger.warning('CPU profiling started.')
+            return
+
+        self.cpu.disable()
+        profile, self.cpu = self.cpu, None
+        try:
+            filename = self.filename('cpu', 'pstats')
+            profile.dump_stats(filename)
+        except OSError as exc:
+            self.logger.error('Cannot write the CPU profile: %s', exc)
+            return
+        self.logger.warning('CPU profile of %.0f seconds written to %s.',
+                time.time() - self.cpu_start, filename)
+
+
+    def toggle_memory(self):
+        """ SIGUSR2 """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.memory_start = time.time()
+            self.logger.warning('Memory tracing started.')
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            filename = self.filename('memory', 'tracemalloc')
+            snapshot.dump(filename)
+        except OSError as exc:
+            self.logger.error('Cannot write the memory snapshot: %s', exc)
+            return
+
+        self.logger.warning('Memory snapshot of %.0f seconds written to ' +\
+                '%s, %i KiB traced, %i KiB peak.', time.time() -
+                self.memory_start, filename, current // 1024, peak // 1024)
+        for stat in snapshot.statistics('lineno')[:10]:
+            self.logger.warning('  %s', stat)
+
+
+    def stop(self):
+        if self.cpu is not None:
+            self.cpu.disable()
+            self.cpu = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
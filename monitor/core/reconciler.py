@@ -0,0 +1,358 @@
+""" Compare wanted routing state with the kernel's, emit only the changes. """
+
+from collections import namedtuple
+from json import loads as json_loads
+from logging import getLogger
+
+from .weighting import current_weight
+
+# `fwmark` is None for plain source rules
+Rule = namedtuple('Rule', 'prio src table fwmark')
+Rule.__new__.__defaults__ = (None,)
+
+# `gateways` is a tuple of (gateway, weight) pairs, weight is None for a
+# single path route, `dev` is only known for routes in main
+Route = namedtuple('Route', 'table type gateways src metric dev')
+Route.__new__.__defaults__ = (None,)
+
+MAIN_RULE_PRIO = 32765
+MULTIPATH_RULE_PRIO = 32766
+
+# every kernel boots with `32766: from all lookup main`, the multipath rule
+# takes its place
+STOCK_MAIN_RULE = Rule(MULTIPATH_RULE_PRIO, 'all', 'main')
+
+# lan packets of a connection carry its connmark, a drained link's flows are
+# marked with its table id and stay on it, replies are left alone
+RESTORE_MARK_RULE = '-A PREROUTING -m conntrack --ctdir ORIGINAL ' +\
+        '-j CONNMARK --restore-mark'
+
+
+def parse_gateway(route):
+    """ get gateway address from route string like 'via 10.0.0.1' """
+    tokens = route.split(' ')
+    if 'via' in tokens:
+        index = tokens.index('via') + 1
+        if index < len(tokens):
+            return tokens[index]
+    return None
+
+
+def route_key(route):
+    return (route.table, route.type, route.metric)
+
+
+class RouteState(object):
+
+    rules = None
+    routes = None
+    nat = None
+    mangle = None
+
+    def __init__(self):
+        self.rules = set()
+        self.routes = {}
+        self.nat = set()
+        self.mangle = set()
+
+
+    def add_route(self, route):
+        self.routes[route_key(route)] = route
+
+
+    def __repr__(self):
+        return 'RouteState(rules=%r, routes=%r, nat=%r, mangle=%r)' % (
+                sorted(self.rules), sorted(self.routes.values()),
+                sorted(self.nat), sorted(self.mangle))
+
+
+def multipath_tables(settings):
+    return (str(settings['route.multipath_table']),
+            str(settings['route.multipath_standby_table']))
+
+
+def managed_tables(settings, registry):
+    tables = [str(table) for table in registry.table_range()]
+    tables.extend(multipath_tables(settings))
+    return tables
+
+
+def live_multipath_table(state, tables):
+    """ which of our multipath `tables` the prio 32766 rule points to """
+    for rule in state.rules:
+        if rule.prio == MULTIPATH_RULE_PRIO and rule.table in tables:
+            return rule.table
+    return None
+
+
+def routes_in(state, table):
+    return set(route for route in state.routes.values()
+            if route.table == table)
+
+
+def keep_live_table(desired, actual, live_table, target_table):
+    """ leave the live multipath table alone while `target_table` is built
+
+    The prio 32766 rule keeps pointing at `live_table`, or at main on a
+    fresh boot, switching it over is the last step, see
+    `switch_multipath_table`.
+    """
+    desired.rules.discard(Rule(MULTIPATH_RULE_PRIO, 'all', target_table))
+    if STOCK_MAIN_RULE in actual.rules:
+        desired.rules.add(STOCK_MAIN_RULE)
+    if live_table is None:
+        return
+
+    desired.rules.add(Rule(MULTIPATH_RULE_PRIO, 'all', live_table))
+    for route in routes_in(actual, live_table):
+        desired.add_route(route)
+
+
+def keep_pending_routes(desired, actual, networks):
+    """ leave main default routes of links not connected yet alone
+
+    They are what `MonitoredNetwork.read_addressing` gets the gateway from,
+    the next reroute after the link connected removes them.
+    """
+    pending = set(network.interface_name for network in networks
+            if not network.connected)
+    for route in actual.routes.values():
+        if route.table == 'main' and route.dev in pending:
+            desired.add_route(route)
+
+
+def switch_multipath_table(batch, actual, live_table, target_table):
+    # both rules exist for a moment and both tables hold a default route,
+    # so lookups never fall through to nothing
+    batch.ip('rule', 'add', 'prio', str(MULTIPATH_RULE_PRIO), 'lookup',
+            target_table)
+    if STOCK_MAIN_RULE in actual.rules:
+        # main stays behind the prio 32765 rule, it is never flushed
+        batch.ip('rule', 'del', 'prio', str(MULTIPATH_RULE_PRIO), 'lookup',
+                'main')
+    if live_table is not None:
+        batch.ip('rule', 'del', 'prio', str(MULTIPATH_RULE_PRIO), 'lookup',
+                live_table)
+        # unreferenced now, start the next build from an empty table
+        batch.ip('route', 'flush', 'table', live_table)
+
+
+def table_mark(table_id):
+    return '0x%x' % int(table_id)
+
+
+def multipath_route(networks, multipath_table):
+    hops = [network for network in networks if network.is_usable()]
+    if not hops:
+        # unhealthy links still beat no route at all
+        hops = [network for network in networks if network.connected]
+    if len(hops) == 1:
+        return Route(multipath_table, 'unicast',
+                ((parse_gateway(hops[0].route), None),), None, None)
+
+    elif len(hops) > 1:
+        return Route(multipath_table, 'unicast',
+                tuple((parse_gateway(network.route), current_weight(network))
+                        for network in hops),
+                None, None)
+
+    return None
+
+
+def desired_state(networks, multipath_table):
+    state = RouteState()
+
+    for network in networks:
+        if not network.connected:
+            continue
+
+        table_id = str(network.table_id)
+
+        state.rules.add(Rule(int(table_id), network.local_ip, table_id))
+        state.rules.add(Rule(int(table_id), 'all', table_id,
+                table_mark(table_id)))
+        state.add_route(Route(table_id, 'unicast',
+                ((parse_gateway(network.route), None),), network.local_ip,
+                None))
+
+        state.add_route(Route(table_id, 'prohibit', (), None, 1))
+        state.nat.add('-A POSTROUTING -o %s -j MASQUERADE' %\
+                network.interface_name)
+        state.mangle.add(RESTORE_MARK_RULE)
+
+    state.rules.add(Rule(MAIN_RULE_PRIO, 'all', 'main'))
+    state.rules.add(Rule(MULTIPATH_RULE_PRIO, 'all', multipath_table))
+
+    route = multipath_route(networks, multipath_table)
+    if route is not None:
+        state.add_route(route)
+
+    return state
+
+
+async def _read_output(commands, *args):
+    result = await commands.run(*args)
+    return result.stdout
+
+
+def parse_rules(data, prios):
+    rules = set()
+    for item in json_loads(data or '[]'):
+        prio = item.get('priority')
+        if prio not in prios:
+            continue
+        fwmark = item.get('fwmark')
+        if fwmark is not None:
+            fwmark = '0x%x' % int(str(fwmark), 0)
+        rules.add(Rule(prio, item.get('src', 'all'),
+                str(item.get('table', 'main')), fwmark))
+    return rules
+
+
+def parse_routes(data, tables):
+    if isinstance(data, str):
+        data = json_loads(data or '[]')
+
+    routes = []
+    for item in data:
+        table = str(item.get('table', 'main'))
+        if item.get('dst') != 'default':
+            continue
+        # any default route in main shadows the multipath table, whoever
+        # added it
+        if table != 'main' and (table not in tables or
+                item.get('protocol') != 'static'):
+            continue
+
+        if 'nexthops' in item:
+            gateways = tuple((hop.get('gateway'), hop.get('weight'))
+                    for hop in item['nexthops'])
+        elif 'gateway' in item:
+            gateways = ((item['gateway'], None),)
+        else:
+            gateways = ()
+
+        routes.append(Route(table, item.get('type', 'unicast'), gateways,
+                item.get('prefsrc'), item.get('metric'),
+                item.get('dev') if table == 'main' else None))
+    return routes
+
+
+def parse_nat(data):
+    return set(line.strip() for line in data.splitlines()
+            if line.startswith('-A POSTROUTING') and 'MASQUERADE' in line)
+
+
+def parse_mangle(data):
+    # iptables -S adds the default masks, only ours is interesting
+    return set(RESTORE_MARK_RULE for line in data.splitlines()
+            if line.startswith('-A PREROUTING') and '--ctdir ORIGINAL' in line
+            and '--restore-mark' in line)
+
+
+async def read_table(commands, table):
+    out = await _read_output(commands, 'ip', '-json', 'route', 'show',
+            'table', table)
+    routes = []
+    for item in json_loads(out or '[]'):
+        # the table is implied by the query
+        item['table'] = table
+        routes.append(item)
+    return set(parse_routes(routes, set((table,))))
+
+
+async def read_state(commands, tables):
+    """ query the kernel once for rules, routes and nat """
+    state = RouteState()
+
+    prios = set(int(table) for table in tables)
+    prios.add(MAIN_RULE_PRIO)
+    prios.add(MULTIPATH_RULE_PRIO)
+
+    # prio 32766 rules into tables other than ours and main belong to
+    # someone else, leave them alone
+    out = await _read_output(commands, 'ip', '-json', 'rule', 'show')
+    state.rules = set(rule for rule in parse_rules(out, prios)
+            if rule.prio != MULTIPATH_RULE_PRIO or rule.table in tables or
+            rule == STOCK_MAIN_RULE)
+
+    out = await _read_output(commands, 'ip', '-json', 'route', 'show',
+            'table', 'all')
+    for route in parse_routes(out, set(tables)):
+        state.add_route(route)
+
+    out = await _read_output(commands, 'iptables', '-t', 'nat', '-S',
+            'POSTROUTING')
+    state.nat = parse_nat(out)
+
+    out = await _read_output(commands, 'iptables', '-t', 'mangle', '-S',
+            'PREROUTING')
+    state.mangle = parse_mangle(out)
+
+    return state
+
+
+def rule_args(rule):
+    args = ['prio', str(rule.prio), 'from', rule.src]
+    if rule.fwmark is not None:
+        args.extend(('fwmark', rule.fwmark))
+    args.extend(('lookup', rule.table))
+    return args
+
+
+def route_args(route):
+    args = ['default', 'table', route.table, 'proto', 'static']
+    if route.type != 'unicast':
+        args.insert(0, route.type)
+    if route.src:
+        args.extend(('src', route.src))
+    if route.metric is not None:
+        args.extend(('metric', str(route.metric)))
+
+    if len(route.gateways) == 1 and route.gateways[0][1] is None:
+        args.extend(('via', route.gateways[0][0]))
+    else:
+        for gateway, weight in route.gateways:
+            args.extend(('nexthop', 'via', gateway, 'weight', str(weight)))
+    return args
+
+
+def reconcile(desired, actual, batch):
+    """ queue commands turning `actual` into `desired` into the batch """
+    logger = getLogger(__name__)
+
+    for rule in actual.rules - desired.rules:
+        batch.ip('rule', 'del', *rule_args(rule))
+
+    for key, route in actual.routes.items():
+        if key in desired.routes:
+            continue
+        args = ['route', 'del', 'default', 'table', route.table]
+        if route.type != 'unicast':
+            args.insert(2, route.type)
+        if route.metric is not None:
+            args.extend(('metric', str(route.metric)))
+        batch.ip(*args)
+
+    for key, route in desired.routes.items():
+        if actual.routes.get(key) != route:
+            batch.ip('route', 'replace', *route_args(route))
+
+    for rule in sorted(desired.rules - actual.rules,
+            key=lambda rule: (rule.prio, rule.fwmark or '')):
+        batch.ip('rule', 'add', *rule_args(rule))
+
+    for line in actual.nat - desired.nat:
+        batch.nat('-D' + line[2:])
+
+    # no route cache flush, ipv4 has no route cache since linux 3.6 and
+    # route changes invalidate cached lookups by themselves
+    for line in sorted(desired.nat - actual.nat):
+        batch.nat(line)
+
+    for line in actual.mangle - desired.mangle:
+        batch.mangle('-D' + line[2:])
+    for line in sorted(desired.mangle - actual.mangle):
+        batch.mangle(line)
+
+    logger.debug('Reconcile needs %i commands.', len(batch))
@@ -0,0 +1,112 @@
+""" Bring a failing interface back with the cheapest action that works. """
+
+import asyncio
+from logging import getLogger
+
+from .health import quorum_met
+
+# action name -> commands, {interface} is replaced
+RECOVERY_ACTIONS = {
+    'dhcp_rebind': (
+        ('dhcpcd', '--rebind', '{interface}'),
+    ),
+    'link_bounce': (
+        ('ip', 'link', 'set', 'dev', '{interface}', 'down'),
+        ('ip', 'link', 'set', 'dev', '{interface}', 'up'),
+    ),
+    'wpa_reassociate': (
+        ('wpa_cli', '-i', '{interface}', 'reassociate'),
+    ),
+    'networkctl': (
+        ('networkctl', 'reconfigure', '{interface}'),
+    ),
+    'init_restart': (
+        ('/etc/init.d/net.{interface}', 'restart'),
+    ),
+}
+
+
+def action_commands(action, interface):
+    return [tuple(arg.format(interface=interface) for arg in command)
+            for command in RECOVERY_ACTIONS[action]]
+
+
+class RecoveryLadder(object):
+    """ runs the rungs in order, a probe decides whether to go on """
+
+    loop = None
+    logger = None
+    app = None
+
+    ladder = None
+    settle = 5
+    stagger = 5
+    next_start = 0
+
+    def __init__(self, app):
+        self.loop = app.loop
+        self.logger = getLogger(type(self).__name__)
+        self.app = app
+        self.configure(app.settings)
+
+
+    def configure(self, settings):
+        self.ladder = list(settings['recovery.ladder'])
+        self.settle = settings['recovery.settle']
+        self.stagger = settings['recovery.stagger']
+
+
+    async def wait_turn(self):
+        """ recoveries start at least `stagger` seconds apart """
+        now = self.loop.time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.stagger
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+    async def recover(self, network):
+        """ True once a probe after some rung succeeded """
+        name = network.interface_name
+        ladder = network.settings['recovery'] or self.ladder
+        metrics = self.app.metrics
+
+        await self.wait_turn()
+        start = self.loop.time()
+        recovered = False
+        for action in ladder:
+            self.logger.info('Recover %s with %s...', name, action)
+            if await self.run_action(action, name):
+                await asyncio.sleep(self.settle)
+                recovered = await self.verify(network)
+                result = 'recovered' if recovered else 'failed'
+            else:
+                result = 'error'
+
+            metrics.recovery_actions.inc(name, action, result)
+            self.app.journal.record('recovery', name=name, action=action,
+                    result=result)
+            if recovered:
+                self.logger.info('%s recovered with %s.', name, action)
+                break
+        else:
+            self.logger.error('%s did not recover, ladder exhausted.', name)
+
+        metrics.recovery_duration.observe(self.loop.time() - start, name)
+        return recovered
+
+
+    async def run_action(self, action, name):
+        for command in action_commands(action, name):
+            result = await self.app.commands.run(*command)
+            if result.returncode:
+                self.logger.warning('%s exited with %i: %s', command[0],
+                        result.returncode, result.stderr.strip())
+                return False
+        return True
+
+
+    async def verify(self, network):
+        """ the same quorum LinkHealth asks of a probe round """
+        results = await self.app.probe_engine.run(network)
+        return quorum_met(results, network.settings['quorum'])
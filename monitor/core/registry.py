@@ -0,0 +1,128 @@
+""" Monitored networks indexed by name, with stable routing table ids. """
+
+from json import dump as json_dump, load as json_load
+from logging import getLogger
+import os
+
+# default, main and local
+KERNEL_TABLES = frozenset((253, 254, 255))
+
+
+class NetworkRegistry(object):
+    """ iterates like the old list of networks, in configuration order
+
+    Routing table ids (also the rule priority) are remembered per interface
+    name in `filename`, so adding or removing a network never moves the
+    others to a different table.
+    """
+
+    logger = None
+    networks = None
+    by_name = None
+
+    base_table = 200
+    max_tables = 250
+    reserved = None
+
+    table_ids = None
+    filename = None
+
+    def __init__(self, base_table, max_tables, reserved=(), filename=None):
+        self.logger = getLogger(type(self).__name__)
+        self.networks = []
+        self.by_name = {}
+        self.base_table = base_table
+        self.max_tables = max_tables
+        self.reserved = KERNEL_TABLES.union(int(table) for table in reserved)
+        self.filename = filename
+        self.table_ids = {}
+        self.load()
+
+
+    def __iter__(self):
+        return iter(self.networks)
+
+
+    def __len__(self):
+        return len(self.networks)
+
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+
+    def add(self, network):
+        network.table_id = self.allocate(network.interface_name)
+        self.networks.append(network)
+        self.by_name[network.interface_name] = network
+
+
+    def remove(self, name):
+        """ forget the network, its table id stays reserved for it """
+        network = self.by_name.pop(name, None)
+        if network is not None:
+            self.networks.remove(network)
+        return network
+
+
+    def table_range(self):
+        return [table for table in range(self.base_table + 1,
+                self.base_table + self.max_tables + 1)
+                if table not in self.reserved]
+
+
+    def allocate(self, name):
+        table_id = self.table_ids.get(name)
+        if table_id is not None:
+            return table_id
+
+        used = set(self.table_ids.values())
+        for table_id in self.table_range():
+            if table_id not in used:
+                break
+        else:
+            # reuse the id of a network no longer configured
+            stale = [item for item in self.table_ids if item not in
+                    self.by_name]
+            if not stale:
+                raise ValueError('No routing table left for %s.' % name)
+            table_id = self.table_ids.pop(stale[0])
+
+        self.table_ids[name] = table_id
+        self.save()
+        return table_id
+
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+
+        try:
+            with open(self.filename, 'r') as filehandle:
+                table_ids = json_load(filehandle)
+        except (OSError, ValueError) as exc:
+            self.logger.warning('Cannot read %s: %s', self.filename, exc)
+            return
+
+        valid = set(self.table_range())
+        self.table_ids = dict((name, int(table_id))
+                for name, table_id in table_ids.items()
+                if int(table_id) in valid)
+
+
+    def save(self):
+        if not self.filename:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename + '.tmp', 'w') as filehandle:
+                json_dump(self.table_ids, filehandle, indent=4,
+                        sort_keys=True)
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError as exc:
+            self.logger.warning('Cannot write %s: %s', self.filename, exc)
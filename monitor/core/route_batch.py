@@ -0,0 +1,105 @@
+""" Collect routing and NAT changes, apply them with one exec per tool. """
+
+from logging import DEBUG, getLogger
+
+
+class RouteBatch(object):
+
+    loop = None
+    logger = None
+    commands = None
+
+    ip_commands = None
+    nat_rules = None
+    mangle_rules = None
+
+    commands_issued = 0
+    execs = 0
+    duration = 0
+
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.loop = commands.loop
+        self.logger = getLogger(type(self).__name__)
+        self.ip_commands = []
+        self.nat_rules = []
+        self.mangle_rules = []
+
+
+    def ip(self, *args):
+        """ queue `ip` command, without the leading `ip` """
+        self.ip_commands.append(' '.join(args))
+
+
+    def nat(self, *args):
+        """ queue iptables rule for the nat table, without `-t nat` """
+        self.nat_rules.append(' '.join(args))
+
+
+    def mangle(self, *args):
+        """ queue iptables rule for the mangle table """
+        self.mangle_rules.append(' '.join(args))
+
+
+    def ip_payload(self):
+        return ''.join(line + '\n' for line in self.ip_commands)
+
+
+    def nat_payload(self):
+        lines = []
+        for table, rules in (('mangle', self.mangle_rules),
+                ('nat', self.nat_rules)):
+            if rules:
+                lines.append('*' + table)
+                lines.extend(rules)
+                lines.append('COMMIT')
+        return ''.join(line + '\n' for line in lines)
+
+
+    def lines(self):
+        """ everything queued, for the journal """
+        return self.ip_commands + self.mangle_rules + self.nat_rules
+
+
+    def __len__(self):
+        return len(self.ip_commands) + len(self.nat_rules) +\
+                len(self.mangle_rules)
+
+
+    async def apply(self):
+        """ raises RuntimeError if any exec failed, after running them all """
+        start = self.loop.time()
+        failed = []
+
+        # the whole nat table is swapped in a single commit, so there is no
+        # window without MASQUERADE rules
+        if self.nat_rules or self.mangle_rules:
+            if await self._exec(['iptables-restore', '--noflush'],
+                    self.nat_payload()):
+                failed.append('iptables-restore')
+
+        # -force keeps going after an error, the exit status still tells
+        # whether every command made it
+        if self.ip_commands:
+            if await self._exec(['ip', '-force', '-batch', '-'],
+                    self.ip_payload()):
+                failed.append('ip -batch')
+
+        self.commands_issued = len(self)
+        self.duration = self.loop.time() - start
+        if failed:
+            raise RuntimeError('Batch not fully applied, %s failed.' %\
+                    ' and '.join(failed))
+
+
+    async def _exec(self, args, payload):
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.debug('%s <<EOF\n%sEOF', ' '.join(args), payload)
+        result = await self.commands.run(*args, payload=payload)
+        self.execs += 1
+        if result.returncode:
+            self.logger.warning('%s exited with %i: %s', args[0],
+                    result.returncode, result.stderr.strip())
+
+        return result.returncode
@@ -0,0 +1,58 @@
+""" What the monitor knew about its networks, kept across restarts. """
+
+from json import dump as json_dump, load as json_load
+from logging import getLogger
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+def take_snapshot(app):
+    networks = {}
+    for network in app.networks:
+        networks[network.interface_name] = {
+            'connected': network.connected,
+            'local_ip': network.local_ip,
+            'network': network.network,
+            'route': network.route,
+            'nexthop_weight': network.nexthop_weight,
+        }
+
+    return {
+        'version': SNAPSHOT_VERSION,
+        'timestamp': time.time(),
+        'multipath_table': app.multipath_table,
+        'networks': networks,
+    }
+
+
+def save_snapshot(filename, snapshot):
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + '.tmp', 'w') as filehandle:
+            json_dump(snapshot, filehandle, indent=4, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+    except OSError as exc:
+        getLogger(__name__).warning('Cannot write %s: %s', filename, exc)
+
+
+def load_snapshot(filename, max_age):
+    """ None if missing, unreadable or older than `max_age` seconds """
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename, 'r') as filehandle:
+            snapshot = json_load(filehandle)
+    except (OSError, ValueError) as exc:
+        getLogger(__name__).warning('Cannot read %s: %s', filename, exc)
+        return None
+
+    if not isinstance(snapshot, dict) or\
+            snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    if time.time() - snapshot.get('timestamp', 0) > max_age:
+        getLogger(__name__).info('Ignoring stale snapshot %s.', filename)
+        return None
+    return snapshot
@@ -1,16 +1,33 @@
 import asyncio
+from datetime import datetime
 from logging import getLogger
 import re
-from dateutil import parser as timeparser
 
-INTF_REMOVE_RE = re.compile(r'^(?P<intf>\w+): removing interface')
-WPA_REMOVE_RE = re.compile(r'^interface (?P<intf>\w+) DISCONNECTED')
+# one alternative per event, the group name tells which one matched
+DHCPCD_EVENTS = r'(?P<dhcpcd_add>\w+): (?:adding|changing) default route|' +\
+        r'(?P<intf_remove>\w+): removing interface'
 
-DHCPCD_ADD_RE = re.compile(r'^(?P<intf>\w+): (adding|changing) default ' +\
-        r'route (?P<route>.*)')
+WPA_EVENTS = r'interface (?P<wpa_remove>\w+) DISCONNECTED|' +\
+        r'interface (?P<wpa_add>\w+) CONNECTED'
 
-WPA_ADD_RE = re.compile(r'^interface (?P<intf>\w+) CONNECTED')
-KERNEL_ADD_RE = re.compile(r'^(?P<intf>\w+): link becomes ready')
+KERNEL_EVENTS = r'(?P<kernel_add>\w+): link becomes ready'
+
+DHCPCD_RE = re.compile('^(?:%s)' % DHCPCD_EVENTS)
+WPA_RE = re.compile('^(?:%s)' % WPA_EVENTS)
+KERNEL_RE = re.compile('^(?:%s)' % KERNEL_EVENTS)
+EVENT_RE = re.compile('^(?:%s|%s|%s)' % (DHCPCD_EVENTS, WPA_EVENTS,
+        KERNEL_EVENTS))
+
+# messages of these programs only need their own patterns, anything else is
+# tried against all of them in one go
+PROGRAM_RE = {
+    'dhcpcd': DHCPCD_RE,
+    'wpa_supplicant': WPA_RE,
+    'wpa_cli': WPA_RE,
+    'kernel': KERNEL_RE,
+}
+
+CONNECTED_EVENTS = frozenset(('dhcpcd_add', 'wpa_add', 'kernel_add'))
 
 SYSLOG_MESSAGE_RE = re.compile(r'<(?P<facility>\d+)>' +\
         r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+' +\
@@ -25,6 +42,13 @@ class SyslogHandler(asyncio.DatagramProtocol):
 
     connected = False
 
+    received = 0
+    parsed = 0
+    unparsed = 0
+
+    last_date = None
+    last_timestamp = None
+
 
     def connection_made(self, transport):
         self.logger.debug('Connection made.')
@@ -36,46 +60,44 @@ class SyslogHandler(asyncio.DatagramProtocol):
             self.connected = True
             self.app.loop.create_task(self.app.on_syslog_connected())
 
-        message = data.decode()
+        self.received += 1
+        message = data.decode('utf-8', 'replace')
         sysmatch = SYSLOG_MESSAGE_RE.match(message)
         if sysmatch is None:
-            self.logger.debug('Cannot parse syslog with regex: ' + message)
-            return
-
-        timestamp = timeparser.parse(sysmatch.group('date'))
-        message = sysmatch.group('msg')
-
-        match = DHCPCD_ADD_RE.search(message)
-        if match is not None:
-            self.app.loop.create_task(self.app.on_network_connected(
-                    match.group('intf'), timestamp))
-
+            self.unparsed += 1
+            self.logger.debug('Cannot parse syslog with regex: %s', message)
             return
 
-        match = INTF_REMOVE_RE.search(message)
-        if match is not None:
-            self.app.loop.create_task(self.app.on_network_disconnected(
-                    match.group('intf'), timestamp))
-
-            return
-
-        match = WPA_REMOVE_RE.search(message)
-        if match is not None:
-            self.app.loop.create_task(self.app.on_network_disconnected(
-                    match.group('intf'), timestamp))
-
-            return
-
-        match = WPA_ADD_RE.search(message)
+        self.parsed += 1
+        pattern = PROGRAM_RE.get(sysmatch.group('prog'), EVENT_RE)
+        match = pattern.match(sysmatch.group('msg'))
         if match is None:
-            match = KERNEL_ADD_RE.search(message)
-        if match is not None:
-            # probably interface with static ip was connected
-            self.app.loop.create_task(self.app.on_network_connected(
-                    match.group('intf'), timestamp))
-
             return
 
+        event = match.lastgroup
+        active = event in CONNECTED_EVENTS
+        name = match.group(event)
+        timestamp = self.parse_date(sysmatch.group('date'))
+        self.app.push_event(active, name, timestamp, None,
+                ('syslog', message))
+
+
+    def parse_date(self, text):
+        """ syslog dates without year, a burst mostly shares the same one """
+        if text == self.last_date:
+            return self.last_timestamp
+
+        try:
+            timestamp = datetime.strptime(' '.join(text.split()),
+                    '%b %d %H:%M:%S')
+            timestamp = timestamp.replace(year=datetime.now().year)
+        except ValueError:
+            timestamp = datetime.now()
+
+        self.last_date = text
+        self.last_timestamp = timestamp
+        return timestamp
+
 
     def __init__(self, app):
         self.app = app
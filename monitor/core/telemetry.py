@@ -0,0 +1,215 @@
+""" Per-interface traffic rates sampled from /sys/class/net statistics. """
+
+from array import array
+from logging import getLogger
+import os
+
+STATISTICS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets',
+        'rx_dropped', 'tx_dropped')
+
+RX_BYTES, TX_BYTES, RX_PACKETS, TX_PACKETS, RX_DROPPED, TX_DROPPED =\
+        range(len(STATISTICS))
+
+
+class InterfaceTraffic(object):
+    """ ring buffer of per-second rates, one row per sample
+
+    Everything is preallocated, a sample only overwrites numbers.
+    """
+
+    name = None
+    capacity = None
+    history = 0
+
+    fds = None
+    counters = None
+    rates = None
+    position = 0
+    count = 0
+    last_time = None
+
+    def __init__(self, name, history, capacity=None):
+        self.name = name
+        self.history = history
+        self.capacity = capacity
+        self.fds = [None] * len(STATISTICS)
+        self.counters = array('d', [0.0] * len(STATISTICS))
+        self.rates = array('d', [0.0] * (len(STATISTICS) * history))
+
+
+    def close(self):
+        for ii, fd in enumerate(self.fds):
+            if fd is not None:
+                os.close(fd)
+                self.fds[ii] = None
+
+
+    def read(self, sysfs_root, index):
+        fd = self.fds[index]
+        if fd is None:
+            fd = os.open(os.path.join(sysfs_root, self.name, 'statistics',
+                    STATISTICS[index]), os.O_RDONLY)
+            self.fds[index] = fd
+
+        # sysfs regenerates the value on every read from offset zero
+        return int(os.pread(fd, 32, 0))
+
+
+    def record(self, values, now):
+        """ store rates from new counter values, returns False on the first
+        sample """
+        if self.last_time is None:
+            elapsed = 0
+        else:
+            elapsed = now - self.last_time
+
+        self.last_time = now
+        offset = self.position * len(STATISTICS)
+        for ii, value in enumerate(values):
+            if elapsed > 0 and value >= self.counters[ii]:
+                self.rates[offset + ii] = (value - self.counters[ii]) /\
+                        elapsed
+            else:
+                # first sample, or counter wrapped/reset with the interface
+                self.rates[offset + ii] = 0.0
+            self.counters[ii] = value
+
+        if elapsed <= 0:
+            return False
+
+        self.position = (self.position + 1) % self.history
+        if self.count < self.history:
+            self.count += 1
+        return True
+
+
+    def rate(self, index, samples=1):
+        """ mean rate of the last `samples` samples """
+        samples = min(samples, self.count)
+        if not samples:
+            return 0.0
+
+        total = 0.0
+        for ii in range(samples):
+            row = (self.position - ii - 1) % self.history
+            total += self.rates[row * len(STATISTICS) + index]
+        return total / samples
+
+
+    def utilization(self, samples=1):
+        if not self.capacity:
+            return 0.0
+
+        # capacity is in Mbit/s, rates are bytes per second
+        capacity = self.capacity * 125000.0
+        return max(self.rate(RX_BYTES, samples),
+                self.rate(TX_BYTES, samples)) / capacity
+
+
+class TrafficSampler(object):
+
+    loop = None
+    logger = None
+
+    sysfs_root = '/sys/class/net'
+    interval = 2
+    history = 60
+    saturation = 0.9
+    window = 3
+
+    interfaces = None
+    saturated = None
+    handle = None
+    on_saturation_changed = None
+
+    def __init__(self, loop, settings, on_saturation_changed=None):
+        self.loop = loop
+        self.logger = getLogger(type(self).__name__)
+        self.sysfs_root = settings['telemetry.sysfs_root']
+        self.interval = settings['telemetry.interval']
+        self.history = settings['telemetry.history']
+        self.saturation = settings['telemetry.saturation']
+        self.window = settings['telemetry.window']
+        self.on_saturation_changed = on_saturation_changed
+        self.interfaces = {}
+        self.saturated = set()
+
+
+    def track(self, name, capacity=None):
+        if name not in self.interfaces:
+            self.interfaces[name] = InterfaceTraffic(name, self.history,
+                    capacity)
+        else:
+            self.interfaces[name].capacity = capacity
+
+
+    def untrack(self, name):
+        traffic = self.interfaces.pop(name, None)
+        if traffic is not None:
+            traffic.close()
+        self.saturated.discard(name)
+
+
+    def start(self):
+        if self.handle is None:
+            self.handle = self.loop.call_soon(self._tick)
+
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        for traffic in self.interfaces.values():
+            traffic.close()
+
+
+    def _tick(self):
+        self.handle = self.loop.call_later(self.interval, self._tick)
+        try:
+            self.sample()
+        except Exception: # pylint:disable=broad-except
+            self.logger.exception('Sampling error:')
+
+
+    def sample(self):
+        now = self.loop.time()
+        changed = False
+        values = [0] * len(STATISTICS)
+        for name, traffic in self.interfaces.items():
+            try:
+                for ii in range(len(STATISTICS)):
+                    values[ii] = traffic.read(self.sysfs_root, ii)
+            except (OSError, ValueError):
+                # interface is gone, ppp down for example, reopen later
+                traffic.close()
+                traffic.last_time = None
+                continue
+
+            if not traffic.record(values, now):
+                continue
+
+            saturated = traffic.utilization(self.window) >= self.saturation
+            if saturated != (name in self.saturated):
+                changed = True
+                if saturated:
+                    self.saturated.add(name)
+                    self.logger.info('Interface %s is saturated.', name)
+                else:
+                    self.saturated.discard(name)
+                    self.logger.info('Interface %s is no longer saturated.',
+                            name)
+
+        if changed and self.on_saturation_changed is not None:
+            self.on_saturation_changed()
+
+
+    def utilization(self, name):
+        traffic = self.interfaces.get(name)
+        if traffic is None:
+            return 0.0
+        return traffic.utilization(self.window)
+
+
+    def is_saturated(self, name):
+        return name in self.saturated
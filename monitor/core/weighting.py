@@ -0,0 +1,127 @@
+""" Turn measured latency and loss into multipath nexthop weights. """
+
+from logging import DEBUG, getLogger
+
+
+class WeightEngine(object):
+
+    logger = None
+
+    smoothing = 0.3
+    max_step = 2
+    threshold = 2
+    max_weight = 10
+    rtt_floor = 0.005
+    saturated_penalty = 0.25
+
+    rtt = None
+    loss = None
+    telemetry = None
+
+    def __init__(self, settings, telemetry=None):
+        self.logger = getLogger(type(self).__name__)
+        self.telemetry = telemetry
+        self.rtt = {}
+        self.loss = {}
+        self.configure(settings)
+
+
+    def configure(self, settings):
+        self.smoothing = settings['weights.smoothing']
+        self.max_step = settings['weights.max_step']
+        self.threshold = settings['weights.threshold']
+        self.max_weight = settings['weights.max_weight']
+        self.rtt_floor = settings['weights.rtt_floor']
+        self.saturated_penalty = settings['weights.saturated_penalty']
+
+
+    def _smooth(self, values, name, value):
+        previous = values.get(name)
+        if previous is None:
+            values[name] = value
+        else:
+            values[name] = previous + self.smoothing * (value - previous)
+
+
+    def observe(self, network, results):
+        """ feed one round of ProbeResult """
+        name = network.interface_name
+
+        rtts = [result.latency for result in results
+                if result.success and result.latency is not None]
+
+        if rtts:
+            self._smooth(self.rtt, name, sum(rtts) / len(rtts))
+
+        if results:
+            losses = [result.loss if result.loss is not None else
+                    float(not result.success) for result in results]
+
+            self._smooth(self.loss, name, sum(losses) / len(losses))
+
+
+    def forget(self, network):
+        self.rtt.pop(network.interface_name, None)
+        self.loss.pop(network.interface_name, None)
+
+
+    def target_weights(self, networks):
+        """ ideal weight of each network, best link gets `max_weight` """
+        quality = {}
+        for network in networks:
+            name = network.interface_name
+            rtt = self.rtt.get(name)
+            if rtt is None:
+                continue
+
+            loss = self.loss.get(name, 0.0)
+            quality[name] = float(network.settings['weight']) *\
+                    (1 - loss) ** 2 / max(rtt, self.rtt_floor)
+
+            if self.telemetry is not None and\
+                    self.telemetry.is_saturated(name):
+                quality[name] *= self.saturated_penalty
+
+        best = max(quality.values()) if quality else 0
+        targets = {}
+        for network in networks:
+            name = network.interface_name
+            if best <= 0 or name not in quality:
+                targets[name] = current_weight(network)
+                continue
+
+            weight = int(round(quality[name] / best * self.max_weight))
+            targets[name] = min(max(weight, 1), self.max_weight)
+        return targets
+
+
+    def drift(self, networks):
+        targets = self.target_weights(networks)
+        return max([abs(targets[network.interface_name] -
+                current_weight(network)) for network in networks] or [0])
+
+
+    def step(self, networks):
+        """ move weights toward their target, returns True if any changed """
+        targets = self.target_weights(networks)
+        changed = False
+        for network in networks:
+            current = current_weight(network)
+            delta = targets[network.interface_name] - current
+            delta = min(max(delta, -self.max_step), self.max_step)
+            if delta:
+                network.nexthop_weight = current + delta
+                changed = True
+
+        if changed and self.logger.isEnabledFor(DEBUG):
+            self.logger.debug('Nexthop weights %r.', dict(
+                    (network.interface_name, network.nexthop_weight)
+                    for network in networks))
+
+        return changed
+
+
+def current_weight(network):
+    if network.nexthop_weight is None:
+        return int(network.settings['weight'])
+    return network.nexthop_weight
@@ -1,25 +1,28 @@
 import asyncio
-from logging import basicConfig, DEBUG, INFO # pylint:disable=unused-import
 import os
-from signal import SIGINT, SIGTERM
+from signal import SIGHUP, SIGINT, SIGTERM, SIGUSR1, SIGUSR2
 
 from core.application import Application
-
-basicConfig(level=DEBUG)
+from core.profiling import configure_logging
 
 loop = asyncio.get_event_loop()
 try:
     base_dir = os.path.dirname(os.path.abspath(__file__))
     app = Application(loop, base_dir)
+    configure_logging(app.settings)
     try:
         loop.add_signal_handler(SIGINT, app.shutdown)
         loop.add_signal_handler(SIGTERM, app.shutdown)
+        loop.add_signal_handler(SIGHUP, app.reload)
+        loop.add_signal_handler(SIGUSR1, app.profiler.toggle_cpu)
+        loop.add_signal_handler(SIGUSR2, app.profiler.toggle_memory)
 
         loop.run_until_complete(app.startup())
     finally:
         loop.run_until_complete(app.close())
 
-    # wait all tasks
-    loop.run_until_complete(asyncio.gather(*asyncio.Task.all_tasks()))
+    # wait all tasks, Task.all_tasks is gone since python 3.9
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    loop.run_until_complete(asyncio.gather(*all_tasks(loop)))
 finally:
     loop.close()
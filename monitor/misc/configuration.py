@@ -1,7 +1,7 @@
 """ Helper functions """
 
 import os
-from collections import Mapping
+from collections.abc import Mapping
 from json import load as json_load
 
 
@@ -20,7 +20,8 @@ def flatten_dict(prefix, data, separator='.', exclude=None):
         if new_prefix in exclude:
             yield (new_prefix, item)
         elif isinstance(item, Mapping):
-            for child_item in flatten_dict(new_prefix, item):
+            for child_item in flatten_dict(new_prefix, item, separator,
+                    exclude):
                 yield child_item
         else:
             yield (new_prefix, item)
@@ -81,11 +82,17 @@ def load_files_from_shell(setter, adapter=None):
      * CONFIG_FILENAMES (OS dependent path-separator deliminated filenames)
      * CONFIG_KEY       (after the file loaded as object, pick this field)
     """
-    root_dir = os.environ.get('ROOT_DIR', '')
-    files = os.environ.get('CONFIG_FILENAMES', '').split(';')
+    files = config_files_from_shell()
     if len(files) == 0:
         return
 
-    files = [os.path.join(root_dir, fname.strip()) for fname in files]
     load_configuration_files(files, setter, os.environ.get('CONFIG_KEY'),
             adapter)
+
+
+def config_files_from_shell():
+    """ paths in CONFIG_FILENAMES, relative to ROOT_DIR """
+    root_dir = os.environ.get('ROOT_DIR', '')
+    files = [fname.strip() for fname in
+            os.environ.get('CONFIG_FILENAMES', '').split(';')]
+    return [os.path.join(root_dir, fname) for fname in files if fname]
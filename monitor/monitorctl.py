@@ -0,0 +1,64 @@
+""" Talk to the control socket of a running internet_monitor.py.
+
+    python monitorctl.py status
+    python monitorctl.py reroute
+    python monitorctl.py suppress [seconds]
+    python monitorctl.py resume
+    python monitorctl.py drain <interface>
+    python monitorctl.py undrain <interface>
+
+CONTROL_SOCKET overrides the socket path, by default the one of
+control.path left empty.
+"""
+
+from json import dumps as json_dumps, loads as json_loads
+import os
+import socket
+import sys
+
+
+def socket_path():
+    if 'CONTROL_SOCKET' in os.environ:
+        return os.environ['CONTROL_SOCKET']
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    root_dir = os.environ.get('ROOT_DIR', os.path.dirname(base_dir))
+    return os.path.join(root_dir, 'var', 'control.sock')
+
+
+def build_request(argv):
+    request = {'command': argv[0]}
+    if argv[0] == 'suppress' and len(argv) > 1:
+        request['seconds'] = float(argv[1])
+    elif argv[0] in ('drain', 'undrain'):
+        if len(argv) < 2:
+            raise ValueError('%s needs an interface.' % argv[0])
+        request['interface'] = argv[1]
+    return request
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 2
+
+    try:
+        request = build_request(argv[1:])
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path())
+        sock.sendall((json_dumps(request) + '\n').encode('utf-8'))
+        reader = sock.makefile('rb')
+        response = json_loads(reader.readline().decode('utf-8'))
+    finally:
+        sock.close()
+
+    print(json_dumps(response, indent=4, sort_keys=True))
+    return 0 if response.get('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
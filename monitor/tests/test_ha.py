@@ -0,0 +1,205 @@
+""" HA heartbeats: signing, replay protection and election. """
+
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from core.application import Application, DEFAULT_SETTINGS
+from core.ha import HaNode, heartbeat_error
+from bench.ha import Node, takeover
+
+ADDRESS = ('127.0.0.1', 1980)
+
+
+def ha_settings(**overrides):
+    settings = dict(DEFAULT_SETTINGS['ha'], enabled=True, key='secret')
+    settings.update(overrides)
+    return settings
+
+
+class Transport(object):
+
+    def __init__(self):
+        self.sent = []
+
+
+    def sendto(self, data, peer):
+        self.sent.append(data)
+
+
+    def close(self):
+        pass
+
+
+class HaNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.state_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        self.loop.close()
+
+
+    def node(self, **overrides):
+        app = Application(self.loop, os.getcwd(), {
+            'monitored_networks': {},
+            'state_dir': self.state_dir,
+            'ha': ha_settings(**overrides),
+        })
+        node = HaNode(app)
+        node.transport = Transport()
+        node.peer = ADDRESS
+        return node
+
+
+    def heartbeat(self, sender):
+        sender.send_heartbeat()
+        return sender.transport.sent[-1]
+
+
+    def message(self, sender, **fields):
+        message = {'version': 1, 'node': sender.node_id, 'sequence': 1,
+                'time': time.time(), 'priority': sender.priority,
+                'active': False}
+        message.update(fields)
+        return sender.encode(message)
+
+
+    def test_signed_round_trip(self):
+        node = self.node()
+        data = self.heartbeat(node)
+        message = node.decode(data)
+        self.assertEqual(message['node'], node.node_id)
+        self.assertIsNone(heartbeat_error(message))
+
+
+    def test_tampered_or_foreign_key(self):
+        node = self.node()
+        data = self.heartbeat(node)
+        self.assertIsNone(node.decode(data.replace(b'"sequence":1',
+                b'"sequence":9')))
+        self.assertIsNone(self.node(key='other').decode(data))
+        self.assertIsNone(self.node(key=None).decode(data))
+
+
+    def test_heartbeat_fields(self):
+        node = self.node()
+        message = node.decode(self.heartbeat(node))
+        self.assertIsNone(heartbeat_error(message))
+        for field in ('node', 'sequence', 'time', 'priority', 'active'):
+            broken = dict(message)
+            del broken[field]
+            self.assertEqual(heartbeat_error(broken), 'bad ' + field)
+        self.assertEqual(heartbeat_error(dict(message, priority=True)),
+                'bad priority')
+        self.assertEqual(heartbeat_error(dict(message, active=True,
+                networks=None)), 'bad networks')
+        self.assertEqual(heartbeat_error(dict(message, active=True,
+                networks={'eth0': {}})), 'bad networks')
+
+
+    def test_malformed_is_rejected(self):
+        node = self.node(role='standby')
+        sender = self.node()
+        node.datagram_received(sender.encode({'version': 1,
+                'node': sender.node_id}), ADDRESS)
+        self.assertEqual(node.rejected, 1)
+        self.assertIsNone(node.peer_id)
+
+
+    def test_replayed_sequence(self):
+        node = self.node(role='standby', priority=100)
+        sender = self.node(role='standby', priority=200)
+        data = self.heartbeat(sender)
+        node.datagram_received(data, ADDRESS)
+        self.assertEqual((node.rejected, node.peer_id), (0, sender.node_id))
+
+        node.datagram_received(data, ADDRESS)
+        self.assertEqual(node.rejected, 1)
+        node.datagram_received(self.heartbeat(sender), ADDRESS)
+        self.assertEqual(node.rejected, 1)
+
+
+    def test_stale_timestamp(self):
+        node = self.node(role='standby', max_skew=30)
+        sender = self.node()
+        node.datagram_received(self.message(sender, time=time.time() - 60),
+                ADDRESS)
+        self.assertEqual(node.rejected, 1)
+        node.datagram_received(self.message(sender, time=time.time() + 60),
+                ADDRESS)
+        self.assertEqual(node.rejected, 2)
+
+
+    def test_outranked_by(self):
+        node = self.node(priority=150)
+        self.assertTrue(node.outranked_by({'priority': 200,
+                'node': node.node_id}))
+        self.assertFalse(node.outranked_by({'priority': 100,
+                'node': node.node_id}))
+        # equal priorities, the node id decides
+        self.assertTrue(node.outranked_by({'priority': 150,
+                'node': node.node_id + 'x'}))
+
+
+    def test_active_steps_down_for_higher_priority(self):
+        node = self.node(role='primary', priority=100)
+        sender = self.node(role='primary', priority=200)
+        self.assertTrue(node.active)
+        node.datagram_received(self.heartbeat(sender), ADDRESS)
+        self.assertFalse(node.active)
+        self.assertIsNotNone(node.dead_handle)
+        node.close()
+
+
+    def test_active_keeps_running_for_lower_priority(self):
+        node = self.node(role='primary', priority=200)
+        sender = self.node(role='primary', priority=100)
+        node.datagram_received(self.heartbeat(sender), ADDRESS)
+        self.assertTrue(node.active)
+
+
+    def test_standby_mirrors_the_active_node(self):
+        node = self.node(role='standby')
+        sender = self.node(role='primary')
+        node.datagram_received(self.heartbeat(sender), ADDRESS)
+        self.assertFalse(node.active)
+        self.assertEqual(node.peer_state['node'], sender.node_id)
+        self.assertIsNotNone(node.dead_handle)
+        node.close()
+
+
+class TwoNodesTest(unittest.TestCase):
+    """ a pair on localhost, the standby takes over a silent primary """
+
+    def test_takeover(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with tempfile.TemporaryDirectory() as primary_dir,\
+                    tempfile.TemporaryDirectory() as standby_dir:
+                primary = Node(loop, 'primary', 2, 0.05, 0.2, primary_dir)
+                standby = Node(loop, 'standby', 2, 0.05, 0.2, standby_dir)
+                try:
+                    total, apply, _ = loop.run_until_complete(
+                            asyncio.wait_for(takeover(primary, standby, 2),
+                            20))
+                finally:
+                    primary.close()
+                    standby.close()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+        self.assertIsNotNone(total)
+        self.assertTrue(standby.app.ha.active)
+        self.assertEqual(standby.app.ha.takeovers, 1)
+        self.assertEqual(primary.app.ha.rejected, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+""" Echo request encoding and a few real pings over loopback. """
+
+import asyncio
+import struct
+import unittest
+
+from core.icmp_prober import checksum, echo_request, HostResolver
+from core.icmp_prober import IcmpProber, parse_echo_reply, summarize
+
+
+def can_ping():
+    prober = IcmpProber(None)
+    try:
+        prober.open_socket().close()
+    except OSError:
+        return False
+    return True
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_checksum_of_request_is_zero(self):
+        packet = echo_request(0x1234, 7, b'internet-monitor')
+        self.assertEqual(checksum(packet), 0)
+
+
+    def test_checksum_odd_length(self):
+        self.assertEqual(checksum(b'\x01'), checksum(b'\x01\x00'))
+
+
+    def test_parse_reply(self):
+        reply = b'\x00' + echo_request(0x1234, 7, b'payload')[1:]
+        self.assertEqual(parse_echo_reply(reply, False), (0x1234, 7))
+
+
+    def test_parse_reply_behind_ip_header(self):
+        reply = b'\x00' + echo_request(0x1234, 7, b'payload')[1:]
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(reply), 0,
+                0, 64, 1, 0, b'\x7f\0\0\x01', b'\x7f\0\0\x01')
+        self.assertEqual(parse_echo_reply(header + reply, True), (0x1234, 7))
+
+
+    def test_request_is_no_reply(self):
+        self.assertIsNone(parse_echo_reply(echo_request(1, 1, b''), False))
+        self.assertIsNone(parse_echo_reply(b'\x00\x00', False))
+
+
+    def test_summarize(self):
+        result = summarize('127.0.0.1', 4, [0.010, 0.020, 0.010])
+        self.assertEqual(result.received, 3)
+        self.assertAlmostEqual(result.loss, 0.25)
+        self.assertAlmostEqual(result.rtt, 0.040 / 3)
+        self.assertAlmostEqual(result.jitter, 0.010)
+
+
+    def test_summarize_nothing_sent(self):
+        result = summarize('127.0.0.1', 0, [])
+        self.assertEqual(result.loss, 1.0)
+        self.assertIsNone(result.rtt)
+
+
+class HostResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+
+    def tearDown(self):
+        self.loop.close()
+
+
+    def test_address_passes_through(self):
+        resolver = HostResolver(self.loop)
+        self.assertEqual(self.loop.run_until_complete(
+                resolver.resolve('127.0.0.1')), '127.0.0.1')
+        self.assertEqual(resolver.cache, {})
+
+
+    def test_name_is_cached(self):
+        resolver = HostResolver(self.loop)
+        address = self.loop.run_until_complete(resolver.resolve('localhost'))
+        self.assertEqual(address, '127.0.0.1')
+        self.assertIn('localhost', resolver.cache)
+
+
+@unittest.skipUnless(can_ping(), 'no ICMP socket, needs root or ' +\
+        'net.ipv4.ping_group_range')
+class LoopbackPingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.prober = IcmpProber(self.loop)
+
+
+    def tearDown(self):
+        self.loop.close()
+
+
+    def test_loopback_answers(self):
+        result = self.loop.run_until_complete(self.prober.probe('127.0.0.1',
+                'lo', count=3, interval=0.01, timeout=1.0))
+        self.assertEqual((result.sent, result.received), (3, 3))
+        self.assertEqual(result.loss, 0.0)
+        self.assertLess(result.rtt, 1.0)
+
+
+    def test_no_route_through_loopback(self):
+        # TEST-NET-3, bound to lo nothing comes back
+        result = self.loop.run_until_complete(self.prober.probe(
+                '203.0.113.1', 'lo', count=2, interval=0.01, timeout=0.2))
+        self.assertEqual(result.received, 0)
+        self.assertEqual(result.loss, 1.0)
+        self.assertIsNone(result.rtt)
+
+
+if __name__ == '__main__':
+    unittest.main()
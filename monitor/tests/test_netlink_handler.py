@@ -0,0 +1,152 @@
+""" rtnetlink parser and handler, fed with recorded datagrams. """
+
+import os
+import unittest
+
+from core.netlink_handler import NetlinkHandler, parse_messages
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def recorded_events():
+    """ [(command, [datagram, ...]), ...] from rtnetlink_events.txt """
+    sections = []
+    path = os.path.join(DATA_DIR, 'rtnetlink_events.txt')
+    with open(path, 'r') as filehandle:
+        for line in filehandle:
+            line = line.strip()
+            if line.startswith('# ip '):
+                sections.append((line[2:], []))
+            elif line and not line.startswith('#'):
+                sections[-1][1].append(bytes.fromhex(line))
+    return sections
+
+
+class RecordingApp(object):
+
+    def __init__(self):
+        self.events = []
+
+
+    def push_event(self, active, name, timestamp, details=None, source=None):
+        self.events.append((active, name, details))
+
+
+class ParseMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sections = dict(recorded_events())
+
+
+    def parsed(self, command):
+        events = []
+        for datagram in self.sections[command]:
+            events.extend(parse_messages(datagram))
+        return events
+
+
+    def test_link_up(self):
+        self.assertEqual(self.parsed('ip link set ifb0 up'), [
+            {'type': 'link', 'index': 2, 'name': 'ifb0', 'up': True}])
+
+
+    def test_link_down(self):
+        self.assertEqual(self.parsed('ip link set ifb0 down'), [
+            {'type': 'link', 'index': 2, 'name': 'ifb0', 'up': False}])
+
+
+    def test_address_added(self):
+        events = self.parsed('ip addr add 10.99.0.2/24 dev ifb0')
+        self.assertEqual(events[0], {'type': 'addr', 'index': 2,
+                'name': 'ifb0', 'address': '10.99.0.2', 'prefixlen': 24,
+                'added': True})
+        # the kernel adds the local, broadcast and subnet routes with it
+        routes = events[1:]
+        self.assertEqual(sorted(route['table'] for route in routes),
+                [254, 255, 255])
+        self.assertFalse(any(route['default'] for route in routes))
+
+
+    def test_address_removed(self):
+        events = self.parsed('ip addr del 10.99.0.2/24 dev ifb0')
+        self.assertEqual(events[0]['type'], 'addr')
+        self.assertFalse(events[0]['added'])
+        self.assertEqual(events[0]['address'], '10.99.0.2')
+
+
+    def test_default_route_in_table(self):
+        self.assertEqual(self.parsed(
+                'ip route add default via 10.99.0.1 dev ifb0 table 201'), [
+            {'type': 'route', 'index': 2, 'table': 201, 'default': True,
+                'gateway': '10.99.0.1', 'prefsrc': None, 'added': True}])
+        events = self.parsed(
+                'ip route del default via 10.99.0.1 dev ifb0 table 201')
+        self.assertFalse(events[0]['added'])
+
+
+    def test_default_route_in_main(self):
+        self.assertEqual(self.parsed(
+                'ip route add default via 10.99.0.1 dev ifb0 metric 900'), [
+            {'type': 'route', 'index': 2, 'table': 254, 'default': True,
+                'gateway': '10.99.0.1', 'prefsrc': None, 'added': True}])
+
+
+    def test_ipv6_is_skipped(self):
+        self.assertEqual(self.parsed('ip -6 addr add fd99::2/64 dev ifb0 ' +\
+                'nodad'), [])
+        self.assertEqual(self.parsed('ip -6 addr del fd99::2/64 dev ifb0'),
+                [])
+
+
+    def test_truncated(self):
+        datagram = self.sections['ip addr add 10.99.0.2/24 dev ifb0'][0]
+        self.assertEqual(parse_messages(datagram[:10]), [])
+        # a header claiming less than its own size ends the parse
+        self.assertEqual(parse_messages(b'\x04\x00\x00\x00' + datagram[4:]),
+                [])
+
+
+    def test_several_messages_in_one_datagram(self):
+        first = self.sections['ip link set ifb0 up'][0]
+        second = self.sections[
+                'ip route add default via 10.99.0.1 dev ifb0 table 201'][0]
+        events = parse_messages(first + second)
+        self.assertEqual([event['type'] for event in events],
+                ['link', 'route'])
+
+
+class NetlinkHandlerTest(unittest.TestCase):
+
+    def test_events(self):
+        app = RecordingApp()
+        handler = NetlinkHandler(app)
+        for _, datagrams in recorded_events():
+            for datagram in datagrams:
+                handler.datagram_received(datagram, None)
+
+        self.assertEqual(app.events, [
+            # link up, addressing not known yet
+            (True, 'ifb0', None),
+            # address plus the default route dhcpcd and friends add to main
+            (True, 'ifb0', {'local_ip': '10.99.0.2',
+                    'network': '10.99.0.0/24', 'route': 'via 10.99.0.1'}),
+            (False, 'ifb0', None),
+            (False, 'ifb0', None),
+        ])
+
+
+    def test_route_outside_main_is_ignored(self):
+        app = RecordingApp()
+        handler = NetlinkHandler(app)
+        sections = dict(recorded_events())
+        for command in ('ip link set ifb0 up',
+                'ip addr add 10.99.0.2/24 dev ifb0',
+                'ip route add default via 10.99.0.1 dev ifb0 table 201'):
+            for datagram in sections[command]:
+                handler.datagram_received(datagram, None)
+        self.assertEqual(app.events, [(True, 'ifb0', None)])
+        self.assertNotIn('ifb0', handler.gateways)
+
+
+if __name__ == '__main__':
+    unittest.main()
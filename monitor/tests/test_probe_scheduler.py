@@ -0,0 +1,120 @@
+""" Probe scheduling against a simulated clock. """
+
+import unittest
+
+from core.probe_scheduler import ProbeScheduler, ProbeSlot
+
+
+class Handle(object):
+
+    cancelled = False
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Loop(object):
+    """ only time passes, timers fire when the test says so """
+
+    now = 100.0
+
+    def __init__(self):
+        self.timers = []
+        self.started = []
+
+
+    def time(self):
+        return self.now
+
+
+    def call_at(self, when, callback):
+        handle = Handle(when, callback)
+        self.timers.append(handle)
+        return handle
+
+
+    def create_task(self, coroutine):
+        # the probe itself is not interesting here
+        coroutine.close()
+        self.started.append(self.now)
+
+
+    def advance(self, until):
+        """ fire timers in order up to `until` """
+        while True:
+            timers = [handle for handle in self.timers
+                    if not handle.cancelled and handle.when <= until]
+            if not timers:
+                break
+            handle = min(timers, key=lambda handle: handle.when)
+            self.timers.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.callback()
+        self.now = until
+
+
+def scheduler_settings(**overrides):
+    settings = {
+        'probe.interval': 60,
+        'probe.jitter': 0.1,
+        'probe.suspect_interval': 5,
+        'probe.suspect_probes': 3,
+        'probe.max_backoff': 600,
+        'probe.coalesce': 0.5,
+        'probe.budget': 120,
+        'probe.budget_window': 60,
+    }
+    settings.update(('probe.' + key, value)
+            for key, value in overrides.items())
+    return settings
+
+
+async def check(name):
+    return True
+
+
+class BudgetTest(unittest.TestCase):
+
+    def test_exhausted_near_window_edge(self):
+        loop = Loop()
+        scheduler = ProbeScheduler(loop, scheduler_settings(budget=1,
+                budget_window=1, coalesce=0.5), check)
+        self.assertTrue(scheduler.take_budget(100.0))
+
+        scheduler.slots['eth0'] = slot = ProbeSlot('eth0', 60)
+        loop.now = 100.5
+        scheduler.schedule(slot, 100.7)
+        # the window ends at 101.0, inside the coalesce horizon
+        scheduler.wake()
+
+        self.assertEqual(scheduler.deferred, 1)
+        self.assertEqual(slot.due, 101.0)
+        self.assertEqual(loop.started, [])
+
+        loop.advance(101.0)
+        self.assertEqual(loop.started, [101.0])
+        self.assertTrue(slot.running)
+
+
+    def test_fleet_stays_within_budget(self):
+        loop = Loop()
+        scheduler = ProbeScheduler(loop, scheduler_settings(), check)
+        for ii in range(200):
+            scheduler.add('ppp%i' % ii)
+
+        loop.advance(loop.now + 300)
+        self.assertTrue(scheduler.deferred)
+        # probes never finish here, every slot starts at most once
+        self.assertEqual(len(loop.started), 200)
+        first = min(loop.started)
+        self.assertEqual(len([start for start in loop.started
+                if start < first + 60]), 120)
+
+
+if __name__ == '__main__':
+    unittest.main()
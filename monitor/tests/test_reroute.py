@@ -0,0 +1,121 @@
+""" Reroutes against the in-memory kernel, starting from the stock rules. """
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from core.application import Application
+from core.reconciler import RouteState, Rule, STOCK_MAIN_RULE
+from core.reconciler import switch_multipath_table
+from core.route_batch import RouteBatch
+from bench.fake_kernel import FakeCommandBackend, FakeKernel
+
+
+class SwitchTest(unittest.TestCase):
+
+    def switch(self, rules, live_table, target_table):
+        actual = RouteState()
+        actual.rules = set(rules)
+        batch = RouteBatch(FakeCommandBackend(None))
+        switch_multipath_table(batch, actual, live_table, target_table)
+        return batch.lines()
+
+
+    def test_replaces_main_without_flush(self):
+        self.assertEqual(self.switch([STOCK_MAIN_RULE], None, '324'), [
+            'rule add prio 32766 lookup 324',
+            'rule del prio 32766 lookup main',
+        ])
+
+
+    def test_flushes_our_old_table(self):
+        self.assertEqual(self.switch([Rule(32766, 'all', '324')], '324',
+                '323'), [
+            'rule add prio 32766 lookup 323',
+            'rule del prio 32766 lookup 324',
+            'route flush table 324',
+        ])
+
+
+class StockRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.state_dir = tempfile.TemporaryDirectory()
+        # starts with the stock rules and the lan connected to main
+        self.kernel = FakeKernel()
+        self.kernel.link_up('ppp0', '10.0.0.2', 24, '10.0.0.1')
+        self.kernel.link_up('ppp1', '10.0.1.2', 24, '10.0.1.1')
+
+
+    def tearDown(self):
+        self.loop.close()
+        self.state_dir.cleanup()
+
+
+    def reroute(self):
+        app = Application(self.loop, os.getcwd(), {
+            'monitored_networks': {
+                'ppp0': {'active': True},
+                'ppp1': {'active': True},
+            },
+            'state_dir': self.state_dir.name,
+        }, commands=FakeCommandBackend(self.loop, self.kernel))
+
+        for name, settings in app.settings['monitored_networks'].items():
+            network = app.add_network(name, settings)
+            self.loop.run_until_complete(network.adopt())
+            self.assertTrue(network.connected)
+
+        self.loop.run_until_complete(app.do_reroute())
+        return app
+
+
+    def rules(self, prio):
+        return [rule['table'] for rule in self.kernel.rules
+                if rule['priority'] == prio and 'fwmark' not in rule and
+                rule['src'] == 'all']
+
+
+    def test_first_reroute_keeps_main(self):
+        app = self.reroute()
+        self.assertNotIn('route flush table main', app.reroute_plan)
+        self.assertEqual(self.rules(32766), [app.multipath_table])
+        self.assertEqual(self.rules(32765), ['main'])
+        self.assertEqual(self.rules(0), ['local'])
+        self.assertEqual(self.rules(32767), ['default'])
+        self.assertEqual(self.kernel.lan_gateways(),
+                frozenset(('10.0.0.1', '10.0.1.1')))
+        self.assertTrue(self.kernel.lan_connected())
+
+
+    def test_table_switch_keeps_main(self):
+        app = self.reroute()
+        first = app.multipath_table
+        self.kernel.link_down('ppp1')
+        app.networks.get('ppp1').connected = False
+        self.loop.run_until_complete(app.do_reroute())
+
+        self.assertNotEqual(app.multipath_table, first)
+        self.assertIn('route flush table %s' % first, app.reroute_plan)
+        self.assertNotIn('route flush table main', app.reroute_plan)
+        self.assertEqual(self.rules(32766), [app.multipath_table])
+        self.assertEqual(self.kernel.lan_gateways(), frozenset(('10.0.0.1',)))
+        self.assertTrue(self.kernel.lan_connected())
+
+
+    def test_foreign_rule_is_left_alone(self):
+        self.kernel.rules[1]['table'] = '100'
+        self.kernel.routes[('100', 'default', None)] = {'dst': 'default',
+                'protocol': 'static', 'table': '100', 'gateway': '10.9.0.1'}
+
+        app = self.reroute()
+        self.assertEqual(self.rules(32766), ['100', app.multipath_table])
+        self.assertIn(('100', 'default', None), self.kernel.routes)
+        self.assertFalse([line for line in app.reroute_plan
+                if line.endswith(' 100')])
+
+
+if __name__ == '__main__':
+    unittest.main()
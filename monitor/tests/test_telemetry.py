@@ -0,0 +1,165 @@
+""" Traffic sampling against a fake /sys/class/net in a temporary dir. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from core.telemetry import InterfaceTraffic, RX_BYTES, STATISTICS
+from core.telemetry import TrafficSampler, TX_BYTES
+
+
+class Clock(object):
+    """ stands in for the loop, the sampler only asks it for the time """
+
+    now = 100.0
+
+    def time(self):
+        return self.now
+
+
+def sampler_settings(sysfs_root, **overrides):
+    settings = {
+        'telemetry.sysfs_root': sysfs_root,
+        'telemetry.interval': 2,
+        'telemetry.history': 4,
+        'telemetry.saturation': 0.9,
+        'telemetry.window': 1,
+    }
+    settings.update(('telemetry.' + key, value)
+            for key, value in overrides.items())
+    return settings
+
+
+class SysfsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.clock = Clock()
+        self.changes = 0
+        self.sampler = TrafficSampler(self.clock,
+                sampler_settings(self.root), self.on_change)
+
+
+    def tearDown(self):
+        self.sampler.stop()
+        shutil.rmtree(self.root)
+
+
+    def on_change(self):
+        self.changes += 1
+
+
+    def write(self, name, **values):
+        directory = os.path.join(self.root, name, 'statistics')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for statistic in STATISTICS:
+            # truncated in place like sysfs, open descriptors see the update
+            with open(os.path.join(directory, statistic), 'w') as filehandle:
+                filehandle.write('%i\n' % values.get(statistic, 0))
+
+
+    def sample_after(self, seconds, name, **values):
+        self.clock.now += seconds
+        self.write(name, **values)
+        self.sampler.sample()
+
+
+    def test_rates(self):
+        self.sampler.track('ppp0')
+        self.sample_after(0, 'ppp0', rx_bytes=1000, tx_bytes=500)
+        self.assertEqual(self.sampler.interfaces['ppp0'].count, 0)
+
+        self.sample_after(2, 'ppp0', rx_bytes=3000, tx_bytes=1500)
+        traffic = self.sampler.interfaces['ppp0']
+        self.assertEqual(traffic.rate(RX_BYTES), 1000.0)
+        self.assertEqual(traffic.rate(TX_BYTES), 500.0)
+
+
+    def test_counter_reset(self):
+        self.sampler.track('ppp0')
+        self.sample_after(0, 'ppp0', rx_bytes=5000)
+        self.sample_after(2, 'ppp0', rx_bytes=10)
+        self.assertEqual(self.sampler.interfaces['ppp0'].rate(RX_BYTES), 0.0)
+
+
+    def test_saturation(self):
+        # 1 Mbit/s is 125000 bytes per second
+        self.sampler.track('ppp0', capacity=1)
+        self.sample_after(0, 'ppp0')
+        self.sample_after(2, 'ppp0', rx_bytes=240000)
+        self.assertTrue(self.sampler.is_saturated('ppp0'))
+        self.assertAlmostEqual(self.sampler.utilization('ppp0'), 0.96)
+        self.assertEqual(self.changes, 1)
+
+        self.sample_after(2, 'ppp0', rx_bytes=240000)
+        self.assertFalse(self.sampler.is_saturated('ppp0'))
+        self.assertEqual(self.changes, 2)
+
+
+    def test_no_capacity_never_saturates(self):
+        self.sampler.track('ppp0')
+        self.sample_after(0, 'ppp0')
+        self.sample_after(2, 'ppp0', rx_bytes=10 ** 9)
+        self.assertFalse(self.sampler.is_saturated('ppp0'))
+        self.assertEqual(self.changes, 0)
+
+
+    def test_interface_goes_away(self):
+        self.sampler.track('ppp0')
+        self.sample_after(0, 'ppp0', rx_bytes=1000)
+        # sysfs fails reads of a removed device, a plain file would still
+        # hand out its old content through the open descriptors
+        directory = os.path.join(self.root, 'ppp0', 'statistics')
+        for statistic in STATISTICS:
+            open(os.path.join(directory, statistic), 'w').close()
+        shutil.rmtree(os.path.join(self.root, 'ppp0'))
+        self.clock.now += 2
+        self.sampler.sample()
+        traffic = self.sampler.interfaces['ppp0']
+        self.assertEqual(traffic.fds, [None] * len(STATISTICS))
+        self.assertIsNone(traffic.last_time)
+
+        # back again, the first sample after only sets the counters
+        self.sample_after(2, 'ppp0', rx_bytes=50)
+        self.assertEqual(traffic.count, 0)
+        self.sample_after(2, 'ppp0', rx_bytes=250)
+        self.assertEqual(traffic.rate(RX_BYTES), 100.0)
+
+
+    def test_untrack_closes(self):
+        self.sampler.track('ppp0')
+        self.sample_after(0, 'ppp0')
+        fds = list(self.sampler.interfaces['ppp0'].fds)
+        self.sampler.untrack('ppp0')
+        self.assertNotIn('ppp0', self.sampler.interfaces)
+        for fd in fds:
+            self.assertRaises(OSError, os.fstat, fd)
+
+
+class InterfaceTrafficTest(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        traffic = InterfaceTraffic('ppp0', 3)
+        values = [0] * len(STATISTICS)
+        traffic.record(values, 0)
+        for second, rx_bytes in enumerate((100, 300, 600, 1000), 1):
+            values[RX_BYTES] = rx_bytes
+            self.assertTrue(traffic.record(values, second))
+
+        # the oldest of the four rates, 100, fell out
+        self.assertEqual(traffic.count, 3)
+        self.assertEqual(traffic.rate(RX_BYTES), 400.0)
+        self.assertEqual(traffic.rate(RX_BYTES, 3), 300.0)
+        self.assertEqual(traffic.rate(RX_BYTES, 10), 300.0)
+
+
+    def test_empty(self):
+        traffic = InterfaceTraffic('ppp0', 3, capacity=10)
+        self.assertEqual(traffic.rate(RX_BYTES), 0.0)
+        self.assertEqual(traffic.utilization(), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()